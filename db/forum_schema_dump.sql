@@ -7,6 +7,12 @@ CREATE TABLE IF NOT EXISTS users(
   lastLogin INTEGER,
   timesviewed INTEGER,
   UNIQUE(user_id, nickname));
+/*
+Covering indexes of the user listings (Connection.get_users_page). The
+nicknames are sorted case insensitive and then by their exact value.
+*/
+CREATE INDEX IF NOT EXISTS users_nickname_nocase ON users(nickname COLLATE NOCASE, nickname, regDate);
+CREATE INDEX IF NOT EXISTS users_registration ON users(regDate, nickname);
 CREATE TABLE IF NOT EXISTS users_profile(
   user_id INTEGER PRIMARY KEY,
   firstname TEXT,
@@ -52,7 +58,426 @@ CREATE TABLE IF NOT EXISTS messages (
   editor_nickname TEXT,
   FOREIGN KEY(reply_to) REFERENCES messages(message_id) ON DELETE CASCADE,
   FOREIGN KEY(user_id, user_nickname) REFERENCES users(user_id, nickname) ON DELETE CASCADE);
+/*
+Covering indexes of the listings (Connection.get_messages): they include all
+the columns the listings read, so the rows of messages are not read.
+*/
+CREATE INDEX IF NOT EXISTS messages_listing_timestamp ON messages(timestamp, user_nickname, title);
+CREATE INDEX IF NOT EXISTS messages_listing_nickname ON messages(user_nickname, timestamp, title);
+/*
+Messages of the threads archived by Engine.archive_messages. A thread is
+archived as a whole when its last activity is older than the cutoff stored
+in archive_info, so the messages table and its indexes only hold the recent
+threads.
+*/
+CREATE TABLE IF NOT EXISTS messages_archive (
+  message_id INTEGER PRIMARY KEY,
+  title TEXT,
+  body TEXT,
+  timestamp INTEGER,
+  ip TEXT,
+  timesviewed INTEGER,
+  reply_to INTEGER,
+  user_nickname TEXT,
+  user_id INTEGER,
+  editor_nickname TEXT,
+  FOREIGN KEY(reply_to) REFERENCES messages_archive(message_id) ON DELETE CASCADE,
+  FOREIGN KEY(user_id, user_nickname) REFERENCES users(user_id, nickname) ON DELETE CASCADE);
+CREATE INDEX IF NOT EXISTS messages_archive_listing_timestamp ON messages_archive(timestamp, user_nickname, title);
+CREATE INDEX IF NOT EXISTS messages_archive_listing_nickname ON messages_archive(user_nickname, timestamp, title);
+CREATE INDEX IF NOT EXISTS messages_archive_reply_to ON messages_archive(reply_to);
+CREATE INDEX IF NOT EXISTS messages_archive_user_timestamp ON messages_archive(user_id, timestamp);
+CREATE TABLE IF NOT EXISTS archive_info(
+  archive_id INTEGER PRIMARY KEY CHECK(archive_id = 0),
+  cutoff INTEGER);
+/*
+Per user aggregates maintained by triggers, so that the number of messages
+and the time of the last message of a user are read without scanning
+messages.
+*/
+CREATE TABLE IF NOT EXISTS user_stats(
+  user_id INTEGER PRIMARY KEY,
+  message_count INTEGER NOT NULL DEFAULT 0,
+  last_post INTEGER);
+CREATE INDEX IF NOT EXISTS messages_user_timestamp ON messages(user_id, timestamp);
+CREATE TRIGGER IF NOT EXISTS user_stats_message_insert AFTER INSERT ON messages
+WHEN new.user_id IS NOT NULL
+BEGIN
+  INSERT INTO user_stats(user_id, message_count, last_post)
+  VALUES(new.user_id, 1, new.timestamp)
+  ON CONFLICT(user_id) DO UPDATE SET
+    message_count = message_count + 1,
+    last_post = MAX(IFNULL(last_post, excluded.last_post), excluded.last_post);
+END;
+CREATE TRIGGER IF NOT EXISTS user_stats_message_delete AFTER DELETE ON messages
+WHEN old.user_id IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  UPDATE user_stats SET
+    message_count = message_count - 1,
+    last_post = NULLIF(MAX(
+      IFNULL((SELECT MAX(timestamp) FROM messages
+              WHERE user_id = old.user_id), 0),
+      IFNULL((SELECT MAX(timestamp) FROM messages_archive
+              WHERE user_id = old.user_id), 0)), 0)
+  WHERE user_id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_stats_archive_delete AFTER DELETE ON messages_archive
+WHEN old.user_id IS NOT NULL
+BEGIN
+  UPDATE user_stats SET
+    message_count = message_count - 1,
+    last_post = NULLIF(MAX(
+      IFNULL((SELECT MAX(timestamp) FROM messages
+              WHERE user_id = old.user_id), 0),
+      IFNULL((SELECT MAX(timestamp) FROM messages_archive
+              WHERE user_id = old.user_id), 0)), 0)
+  WHERE user_id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_stats_user_delete AFTER DELETE ON users
+BEGIN
+  DELETE FROM user_stats WHERE user_id = old.user_id;
+END;
+/*
+Thread summaries maintained by triggers. message_threads stores the root
+message (reply_to IS NULL) of every message, threads the aggregates of each
+root message and thread_participants the number of messages of each
+nickname in a thread.
+*/
+CREATE TABLE IF NOT EXISTS message_threads(
+  message_id INTEGER PRIMARY KEY,
+  root_id INTEGER NOT NULL,
+  timestamp INTEGER);
+CREATE INDEX IF NOT EXISTS message_threads_root ON message_threads(root_id, timestamp);
+CREATE TABLE IF NOT EXISTS threads(
+  root_id INTEGER PRIMARY KEY,
+  reply_count INTEGER NOT NULL DEFAULT 0,
+  participant_count INTEGER NOT NULL DEFAULT 0,
+  last_reply INTEGER,
+  last_activity INTEGER);
+CREATE INDEX IF NOT EXISTS threads_last_activity ON threads(last_activity, root_id);
+CREATE TABLE IF NOT EXISTS thread_participants(
+  root_id INTEGER,
+  nickname TEXT,
+  message_count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(root_id, nickname));
+CREATE TRIGGER IF NOT EXISTS threads_message_insert AFTER INSERT ON messages
+BEGIN
+  INSERT INTO message_threads(message_id, root_id, timestamp)
+  VALUES(new.message_id,
+         IFNULL((SELECT root_id FROM message_threads
+                 WHERE message_id = new.reply_to), new.message_id),
+         new.timestamp);
+  INSERT INTO threads(root_id, last_activity)
+  SELECT new.message_id, new.timestamp WHERE new.reply_to IS NULL;
+  UPDATE threads SET
+    reply_count = reply_count + 1,
+    last_reply = MAX(IFNULL(last_reply, new.timestamp), new.timestamp),
+    last_activity = MAX(IFNULL(last_activity, new.timestamp), new.timestamp)
+  WHERE new.reply_to IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = new.message_id);
+  UPDATE threads SET participant_count = participant_count + 1
+  WHERE new.user_nickname IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = new.message_id)
+  AND NOT EXISTS (SELECT 1 FROM thread_participants
+                  WHERE root_id = threads.root_id
+                  AND nickname = new.user_nickname);
+  INSERT INTO thread_participants(root_id, nickname, message_count)
+  SELECT root_id, new.user_nickname, 1 FROM message_threads
+  WHERE message_id = new.message_id AND new.user_nickname IS NOT NULL
+  ON CONFLICT(root_id, nickname) DO UPDATE SET
+    message_count = message_count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS threads_message_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  UPDATE threads SET participant_count = participant_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND EXISTS (SELECT 1 FROM thread_participants
+              WHERE root_id = threads.root_id
+              AND nickname = old.user_nickname AND message_count <= 1);
+  UPDATE thread_participants SET message_count = message_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname;
+  DELETE FROM thread_participants
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname AND message_count <= 0;
+  UPDATE threads SET
+    reply_count = reply_count - 1,
+    last_reply = (SELECT MAX(timestamp) FROM message_threads
+                  WHERE root_id = threads.root_id
+                  AND message_id NOT IN (threads.root_id, old.message_id)),
+    last_activity = (SELECT MAX(timestamp) FROM message_threads
+                     WHERE root_id = threads.root_id
+                   AND message_id != old.message_id)
+  WHERE old.reply_to IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id);
+  DELETE FROM message_threads WHERE message_id = old.message_id;
+  DELETE FROM threads WHERE root_id = old.message_id;
+  DELETE FROM thread_participants WHERE root_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS threads_archive_delete AFTER DELETE ON messages_archive
+BEGIN
+  UPDATE threads SET participant_count = participant_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND EXISTS (SELECT 1 FROM thread_participants
+              WHERE root_id = threads.root_id
+              AND nickname = old.user_nickname AND message_count <= 1);
+  UPDATE thread_participants SET message_count = message_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname;
+  DELETE FROM thread_participants
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname AND message_count <= 0;
+  UPDATE threads SET
+    reply_count = reply_count - 1,
+    last_reply = (SELECT MAX(timestamp) FROM message_threads
+                  WHERE root_id = threads.root_id
+                  AND message_id NOT IN (threads.root_id, old.message_id)),
+    last_activity = (SELECT MAX(timestamp) FROM message_threads
+                     WHERE root_id = threads.root_id
+                   AND message_id != old.message_id)
+  WHERE old.reply_to IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id);
+  DELETE FROM message_threads WHERE message_id = old.message_id;
+  DELETE FROM threads WHERE root_id = old.message_id;
+  DELETE FROM thread_participants WHERE root_id = old.message_id;
+END;
+/*
+Version of every message and user profile, used as ETag by the HTTP layer.
+A change gives the row the next number of version_sequence, shared by both
+tables, so "changed since version X" is an index range. The rows of
+version_sequence are deleted at once: AUTOINCREMENT never hands out a number
+again, even after the row holding the greatest version is deleted.
+*/
+CREATE TABLE IF NOT EXISTS version_sequence(
+  version INTEGER PRIMARY KEY AUTOINCREMENT);
+CREATE TABLE IF NOT EXISTS message_versions(
+  message_id INTEGER PRIMARY KEY,
+  version INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS message_versions_version ON message_versions(version);
+CREATE TABLE IF NOT EXISTS profile_versions(
+  user_id INTEGER PRIMARY KEY,
+  version INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS profile_versions_version ON profile_versions(version);
+CREATE TRIGGER IF NOT EXISTS message_versions_insert AFTER INSERT ON messages
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  INSERT OR REPLACE INTO message_versions(message_id, version)
+  VALUES(new.message_id, last_insert_rowid());
+  DELETE FROM version_sequence;
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE message_versions SET version = last_insert_rowid()
+  WHERE message_id = new.message_id;
+  DELETE FROM version_sequence;
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  DELETE FROM message_versions WHERE message_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_archive_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages_archive
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE message_versions SET version = last_insert_rowid()
+  WHERE message_id = new.message_id;
+  DELETE FROM version_sequence;
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_archive_delete
+AFTER DELETE ON messages_archive
+BEGIN
+  DELETE FROM message_versions WHERE message_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_insert AFTER INSERT ON users_profile
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  INSERT OR REPLACE INTO profile_versions(user_id, version)
+  VALUES(new.user_id, last_insert_rowid());
+  DELETE FROM version_sequence;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_update AFTER UPDATE ON users_profile
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE profile_versions SET version = last_insert_rowid()
+  WHERE user_id = new.user_id;
+  DELETE FROM version_sequence;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_user_update
+AFTER UPDATE OF nickname, regDate ON users
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE profile_versions SET version = last_insert_rowid()
+  WHERE user_id = new.user_id;
+  DELETE FROM version_sequence;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_delete AFTER DELETE ON users_profile
+BEGIN
+  DELETE FROM profile_versions WHERE user_id = old.user_id;
+END;
 
+/*
+Append-only log of the changes of messages, users, users_profile and
+friends, used by incremental consumers (Connection.read_changes). seq never
+goes back, even after the log is compacted by Engine.compact_changelog.
+Moving a thread to messages_archive is not a change. The changes of users,
+users_profile and friends keep the nicknames, which are needed to apply a
+delete. The view user_nicknames gives the nickname of a user id: the users
+row is already deleted when its cascaded deletes are logged, so they take
+the nickname from the last logged change of the user.
+*/
+CREATE TABLE IF NOT EXISTS changelog(
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  table_name TEXT NOT NULL,
+  operation TEXT NOT NULL,
+  row_id INTEGER NOT NULL,
+  friend_id INTEGER,
+  timestamp INTEGER NOT NULL,
+  nickname TEXT,
+  friend_nickname TEXT);
+CREATE INDEX IF NOT EXISTS changelog_row ON changelog(table_name, row_id, friend_id, seq);
+CREATE TABLE IF NOT EXISTS changelog_info(
+  changelog_id INTEGER PRIMARY KEY CHECK(changelog_id = 0),
+  purged_seq INTEGER NOT NULL);
+CREATE VIEW IF NOT EXISTS user_nicknames AS
+SELECT user_id, nickname FROM users
+UNION ALL
+SELECT row_id, nickname FROM changelog AS logged
+WHERE table_name = 'users' AND friend_id IS NULL AND nickname IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM users WHERE user_id = logged.row_id)
+AND seq = (SELECT MAX(seq) FROM changelog
+           WHERE table_name = 'users' AND row_id = logged.row_id
+           AND friend_id IS NULL AND nickname IS NOT NULL);
+CREATE TRIGGER IF NOT EXISTS changelog_message_insert AFTER INSERT ON messages
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'insert', new.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_message_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'update', new.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_message_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'delete', old.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_archive_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages_archive
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'update', new.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_archive_delete
+AFTER DELETE ON messages_archive
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'delete', old.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_user_insert AFTER INSERT ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users', 'insert', new.user_id, new.nickname, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_user_update AFTER UPDATE ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users', 'update', new.user_id, new.nickname, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_user_delete AFTER DELETE ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users', 'delete', old.user_id, old.nickname, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_insert AFTER INSERT ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users_profile', 'insert', new.user_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_update AFTER UPDATE ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users_profile', 'update', new.user_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_delete AFTER DELETE ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users_profile', 'delete', old.user_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.user_id),
+         strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_insert AFTER INSERT ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'insert', new.user_id, new.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.friend_id),
+         strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_update AFTER UPDATE ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'delete', old.user_id, old.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.friend_id),
+         strftime('%s', 'now'));
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'insert', new.user_id, new.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.friend_id),
+         strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_delete AFTER DELETE ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'delete', old.user_id, old.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.friend_id),
+         strftime('%s', 'now'));
+END;
+/*
+Bodies longer than MAX_INLINE_BODY bytes (forum/database.py). The body
+column of their row in messages or messages_archive is NULL, so the listings
+which scan messages do not read them.
+*/
+CREATE TABLE IF NOT EXISTS message_bodies(
+  message_id INTEGER PRIMARY KEY,
+  body);
+CREATE TRIGGER IF NOT EXISTS message_bodies_message_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  DELETE FROM message_bodies WHERE message_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS message_bodies_archive_delete
+AFTER DELETE ON messages_archive
+BEGIN
+  DELETE FROM message_bodies WHERE message_id = old.message_id;
+END;
 
 COMMIT;
 PRAGMA foreign_keys=ON;
\ No newline at end of file
@@ -0,0 +1,234 @@
+/*
+Schema of the archive, user statistics and thread summaries, for databases
+created before the migrations existed (such as the db/forum.db shipped
+with the code). The statistics and summaries are filled from the messages
+already in the database. Databases created from forum_schema_dump.sql
+already include it.
+
+The script is not batched: the tables are filled and then the triggers
+which maintain them are created in the same transaction, so no message can
+be written between the backfill and the triggers. The rows which already
+exist are kept, so the script can be run again.
+
+The indexes which later migrations replace are not created here: 0005
+creates the listing indexes of messages and messages_archive.
+*/
+/*
+Messages of the threads archived by Engine.archive_messages. A thread is
+archived as a whole when its last activity is older than the cutoff stored
+in archive_info, so the messages table and its indexes only hold the recent
+threads.
+*/
+CREATE TABLE IF NOT EXISTS messages_archive (
+  message_id INTEGER PRIMARY KEY,
+  title TEXT,
+  body TEXT,
+  timestamp INTEGER,
+  ip TEXT,
+  timesviewed INTEGER,
+  reply_to INTEGER,
+  user_nickname TEXT,
+  user_id INTEGER,
+  editor_nickname TEXT,
+  FOREIGN KEY(reply_to) REFERENCES messages_archive(message_id) ON DELETE CASCADE,
+  FOREIGN KEY(user_id, user_nickname) REFERENCES users(user_id, nickname) ON DELETE CASCADE);
+CREATE INDEX IF NOT EXISTS messages_archive_reply_to ON messages_archive(reply_to);
+CREATE INDEX IF NOT EXISTS messages_archive_user_timestamp ON messages_archive(user_id, timestamp);
+CREATE TABLE IF NOT EXISTS archive_info(
+  archive_id INTEGER PRIMARY KEY CHECK(archive_id = 0),
+  cutoff INTEGER);
+/*
+Per user aggregates maintained by triggers, so that the number of messages
+and the time of the last message of a user are read without scanning
+messages.
+*/
+CREATE TABLE IF NOT EXISTS user_stats(
+  user_id INTEGER PRIMARY KEY,
+  message_count INTEGER NOT NULL DEFAULT 0,
+  last_post INTEGER);
+CREATE INDEX IF NOT EXISTS messages_user_timestamp ON messages(user_id, timestamp);
+/*
+Thread summaries maintained by triggers. message_threads stores the root
+message (reply_to IS NULL) of every message, threads the aggregates of each
+root message and thread_participants the number of messages of each
+nickname in a thread.
+*/
+CREATE TABLE IF NOT EXISTS message_threads(
+  message_id INTEGER PRIMARY KEY,
+  root_id INTEGER NOT NULL,
+  timestamp INTEGER);
+CREATE INDEX IF NOT EXISTS message_threads_root ON message_threads(root_id, timestamp);
+CREATE TABLE IF NOT EXISTS threads(
+  root_id INTEGER PRIMARY KEY,
+  reply_count INTEGER NOT NULL DEFAULT 0,
+  participant_count INTEGER NOT NULL DEFAULT 0,
+  last_reply INTEGER,
+  last_activity INTEGER);
+CREATE INDEX IF NOT EXISTS threads_last_activity ON threads(last_activity, root_id);
+CREATE TABLE IF NOT EXISTS thread_participants(
+  root_id INTEGER,
+  nickname TEXT,
+  message_count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(root_id, nickname));
+/*
+The root of every message is found with a recursive query over a copy of
+the replies indexed by reply_to, which the messages table does not have.
+*/
+CREATE TEMP TABLE baseline_replies AS
+SELECT message_id, reply_to, timestamp FROM messages;
+CREATE INDEX temp.baseline_replies_reply_to ON baseline_replies(reply_to);
+INSERT OR IGNORE INTO message_threads(message_id, root_id, timestamp)
+WITH RECURSIVE tree(message_id, root_id, timestamp) AS (
+  SELECT message_id, message_id, timestamp
+  FROM baseline_replies WHERE reply_to IS NULL
+  UNION ALL
+  SELECT baseline_replies.message_id, tree.root_id, baseline_replies.timestamp
+  FROM baseline_replies, tree
+  WHERE baseline_replies.reply_to = tree.message_id)
+SELECT * FROM tree;
+DROP TABLE temp.baseline_replies;
+INSERT OR IGNORE INTO user_stats(user_id, message_count, last_post)
+SELECT user_id, COUNT(*), MAX(timestamp) FROM messages
+WHERE user_id IS NOT NULL
+GROUP BY user_id;
+INSERT OR IGNORE INTO thread_participants(root_id, nickname, message_count)
+SELECT message_threads.root_id, messages.user_nickname, COUNT(*)
+FROM message_threads, messages
+WHERE messages.message_id = message_threads.message_id
+AND messages.user_nickname IS NOT NULL
+GROUP BY message_threads.root_id, messages.user_nickname;
+INSERT OR IGNORE INTO threads(root_id, reply_count, participant_count,
+                              last_reply, last_activity)
+SELECT root_id, COUNT(*) - 1,
+       (SELECT COUNT(*) FROM thread_participants
+        WHERE thread_participants.root_id = message_threads.root_id),
+       MAX(CASE WHEN message_id != root_id THEN timestamp END),
+       MAX(timestamp)
+FROM message_threads
+GROUP BY root_id;
+CREATE TRIGGER IF NOT EXISTS user_stats_message_insert AFTER INSERT ON messages
+WHEN new.user_id IS NOT NULL
+BEGIN
+  INSERT INTO user_stats(user_id, message_count, last_post)
+  VALUES(new.user_id, 1, new.timestamp)
+  ON CONFLICT(user_id) DO UPDATE SET
+    message_count = message_count + 1,
+    last_post = MAX(IFNULL(last_post, excluded.last_post), excluded.last_post);
+END;
+CREATE TRIGGER IF NOT EXISTS user_stats_message_delete AFTER DELETE ON messages
+WHEN old.user_id IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  UPDATE user_stats SET
+    message_count = message_count - 1,
+    last_post = NULLIF(MAX(
+      IFNULL((SELECT MAX(timestamp) FROM messages
+              WHERE user_id = old.user_id), 0),
+      IFNULL((SELECT MAX(timestamp) FROM messages_archive
+              WHERE user_id = old.user_id), 0)), 0)
+  WHERE user_id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_stats_archive_delete AFTER DELETE ON messages_archive
+WHEN old.user_id IS NOT NULL
+BEGIN
+  UPDATE user_stats SET
+    message_count = message_count - 1,
+    last_post = NULLIF(MAX(
+      IFNULL((SELECT MAX(timestamp) FROM messages
+              WHERE user_id = old.user_id), 0),
+      IFNULL((SELECT MAX(timestamp) FROM messages_archive
+              WHERE user_id = old.user_id), 0)), 0)
+  WHERE user_id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS user_stats_user_delete AFTER DELETE ON users
+BEGIN
+  DELETE FROM user_stats WHERE user_id = old.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS threads_message_insert AFTER INSERT ON messages
+BEGIN
+  INSERT INTO message_threads(message_id, root_id, timestamp)
+  VALUES(new.message_id,
+         IFNULL((SELECT root_id FROM message_threads
+                 WHERE message_id = new.reply_to), new.message_id),
+         new.timestamp);
+  INSERT INTO threads(root_id, last_activity)
+  SELECT new.message_id, new.timestamp WHERE new.reply_to IS NULL;
+  UPDATE threads SET
+    reply_count = reply_count + 1,
+    last_reply = MAX(IFNULL(last_reply, new.timestamp), new.timestamp),
+    last_activity = MAX(IFNULL(last_activity, new.timestamp), new.timestamp)
+  WHERE new.reply_to IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = new.message_id);
+  UPDATE threads SET participant_count = participant_count + 1
+  WHERE new.user_nickname IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = new.message_id)
+  AND NOT EXISTS (SELECT 1 FROM thread_participants
+                  WHERE root_id = threads.root_id
+                  AND nickname = new.user_nickname);
+  INSERT INTO thread_participants(root_id, nickname, message_count)
+  SELECT root_id, new.user_nickname, 1 FROM message_threads
+  WHERE message_id = new.message_id AND new.user_nickname IS NOT NULL
+  ON CONFLICT(root_id, nickname) DO UPDATE SET
+    message_count = message_count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS threads_message_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  UPDATE threads SET participant_count = participant_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND EXISTS (SELECT 1 FROM thread_participants
+              WHERE root_id = threads.root_id
+              AND nickname = old.user_nickname AND message_count <= 1);
+  UPDATE thread_participants SET message_count = message_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname;
+  DELETE FROM thread_participants
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname AND message_count <= 0;
+  UPDATE threads SET
+    reply_count = reply_count - 1,
+    last_reply = (SELECT MAX(timestamp) FROM message_threads
+                  WHERE root_id = threads.root_id
+                  AND message_id NOT IN (threads.root_id, old.message_id)),
+    last_activity = (SELECT MAX(timestamp) FROM message_threads
+                     WHERE root_id = threads.root_id
+                     AND message_id != old.message_id)
+  WHERE old.reply_to IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id);
+  DELETE FROM message_threads WHERE message_id = old.message_id;
+  DELETE FROM threads WHERE root_id = old.message_id;
+  DELETE FROM thread_participants WHERE root_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS threads_archive_delete AFTER DELETE ON messages_archive
+BEGIN
+  UPDATE threads SET participant_count = participant_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND EXISTS (SELECT 1 FROM thread_participants
+              WHERE root_id = threads.root_id
+              AND nickname = old.user_nickname AND message_count <= 1);
+  UPDATE thread_participants SET message_count = message_count - 1
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname;
+  DELETE FROM thread_participants
+  WHERE root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id)
+  AND nickname = old.user_nickname AND message_count <= 0;
+  UPDATE threads SET
+    reply_count = reply_count - 1,
+    last_reply = (SELECT MAX(timestamp) FROM message_threads
+                  WHERE root_id = threads.root_id
+                  AND message_id NOT IN (threads.root_id, old.message_id)),
+    last_activity = (SELECT MAX(timestamp) FROM message_threads
+                     WHERE root_id = threads.root_id
+                     AND message_id != old.message_id)
+  WHERE old.reply_to IS NOT NULL AND root_id =
+    (SELECT root_id FROM message_threads WHERE message_id = old.message_id);
+  DELETE FROM message_threads WHERE message_id = old.message_id;
+  DELETE FROM threads WHERE root_id = old.message_id;
+  DELETE FROM thread_participants WHERE root_id = old.message_id;
+END;
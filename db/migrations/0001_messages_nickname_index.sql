@@ -0,0 +1,5 @@
+/*
+Index used by get_messages(nickname), which scanned the messages table.
+Databases created from forum_schema_dump.sql already include it.
+*/
+CREATE INDEX IF NOT EXISTS messages_nickname_timestamp ON messages(user_nickname, timestamp);
@@ -0,0 +1,82 @@
+/*
+Versions of messages and user profiles (ETags). The versions of the rows
+which already exist are backfilled in batches with version 1.
+*/
+CREATE TABLE IF NOT EXISTS message_versions(
+  message_id INTEGER PRIMARY KEY,
+  version INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS message_versions_version ON message_versions(version);
+CREATE TABLE IF NOT EXISTS profile_versions(
+  user_id INTEGER PRIMARY KEY,
+  version INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS profile_versions_version ON profile_versions(version);
+CREATE TRIGGER IF NOT EXISTS message_versions_insert AFTER INSERT ON messages
+BEGIN
+  INSERT OR REPLACE INTO message_versions(message_id, version)
+  VALUES(new.message_id,
+         IFNULL((SELECT MAX(version) FROM message_versions), 0) + 1);
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages
+BEGIN
+  UPDATE message_versions
+  SET version = (SELECT MAX(version) FROM message_versions) + 1
+  WHERE message_id = new.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  DELETE FROM message_versions WHERE message_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_archive_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages_archive
+BEGIN
+  UPDATE message_versions
+  SET version = (SELECT MAX(version) FROM message_versions) + 1
+  WHERE message_id = new.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS message_versions_archive_delete
+AFTER DELETE ON messages_archive
+BEGIN
+  DELETE FROM message_versions WHERE message_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_insert AFTER INSERT ON users_profile
+BEGIN
+  INSERT OR REPLACE INTO profile_versions(user_id, version)
+  VALUES(new.user_id,
+         IFNULL((SELECT MAX(version) FROM profile_versions), 0) + 1);
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_update AFTER UPDATE ON users_profile
+BEGIN
+  UPDATE profile_versions
+  SET version = (SELECT MAX(version) FROM profile_versions) + 1
+  WHERE user_id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_user_update
+AFTER UPDATE OF nickname, regDate ON users
+BEGIN
+  UPDATE profile_versions
+  SET version = (SELECT MAX(version) FROM profile_versions) + 1
+  WHERE user_id = new.user_id;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_versions_delete AFTER DELETE ON users_profile
+BEGIN
+  DELETE FROM profile_versions WHERE user_id = old.user_id;
+END;
+-- batch
+INSERT OR IGNORE INTO message_versions(message_id, version)
+SELECT message_id, 1 FROM messages
+WHERE message_id NOT IN (SELECT message_id FROM message_versions)
+LIMIT :batch_size;
+-- batch
+INSERT OR IGNORE INTO message_versions(message_id, version)
+SELECT message_id, 1 FROM messages_archive
+WHERE message_id NOT IN (SELECT message_id FROM message_versions)
+LIMIT :batch_size;
+-- batch
+INSERT OR IGNORE INTO profile_versions(user_id, version)
+SELECT user_id, 1 FROM users_profile
+WHERE user_id NOT IN (SELECT user_id FROM profile_versions)
+LIMIT :batch_size;
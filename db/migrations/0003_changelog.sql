@@ -0,0 +1,128 @@
+/*
+Changelog of messages, users, users_profile and friends. The rows which
+already exist are backfilled in batches as inserts, so a consumer reading
+from seq 0 receives every row.
+*/
+CREATE TABLE IF NOT EXISTS changelog(
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  table_name TEXT NOT NULL,
+  operation TEXT NOT NULL,
+  row_id INTEGER NOT NULL,
+  friend_id INTEGER,
+  timestamp INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS changelog_row ON changelog(table_name, row_id, friend_id, seq);
+CREATE TABLE IF NOT EXISTS changelog_info(
+  changelog_id INTEGER PRIMARY KEY CHECK(changelog_id = 0),
+  purged_seq INTEGER NOT NULL);
+CREATE TRIGGER IF NOT EXISTS changelog_message_insert AFTER INSERT ON messages
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'insert', new.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_message_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'update', new.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_message_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'delete', old.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_archive_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages_archive
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'update', new.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_archive_delete
+AFTER DELETE ON messages_archive
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('messages', 'delete', old.message_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_user_insert AFTER INSERT ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('users', 'insert', new.user_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_user_update AFTER UPDATE ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('users', 'update', new.user_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_user_delete AFTER DELETE ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('users', 'delete', old.user_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_insert AFTER INSERT ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('users_profile', 'insert', new.user_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_update AFTER UPDATE ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('users_profile', 'update', new.user_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_delete AFTER DELETE ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, timestamp)
+  VALUES('users_profile', 'delete', old.user_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_insert AFTER INSERT ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, timestamp)
+  VALUES('friends', 'insert', new.user_id, new.friend_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_update AFTER UPDATE ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, timestamp)
+  VALUES('friends', 'delete', old.user_id, old.friend_id, strftime('%s', 'now'));
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, timestamp)
+  VALUES('friends', 'insert', new.user_id, new.friend_id, strftime('%s', 'now'));
+END;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_delete AFTER DELETE ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, timestamp)
+  VALUES('friends', 'delete', old.user_id, old.friend_id, strftime('%s', 'now'));
+END;
+-- batch
+INSERT INTO changelog(table_name, operation, row_id, timestamp)
+SELECT 'messages', 'insert', message_id, strftime('%s', 'now') FROM messages
+WHERE NOT EXISTS (SELECT 1 FROM changelog WHERE table_name = 'messages'
+                  AND row_id = messages.message_id)
+LIMIT :batch_size;
+-- batch
+INSERT INTO changelog(table_name, operation, row_id, timestamp)
+SELECT 'messages', 'insert', message_id, strftime('%s', 'now')
+FROM messages_archive
+WHERE NOT EXISTS (SELECT 1 FROM changelog WHERE table_name = 'messages'
+                  AND row_id = messages_archive.message_id)
+LIMIT :batch_size;
+-- batch
+INSERT INTO changelog(table_name, operation, row_id, timestamp)
+SELECT 'users', 'insert', user_id, strftime('%s', 'now') FROM users
+WHERE NOT EXISTS (SELECT 1 FROM changelog WHERE table_name = 'users'
+                  AND row_id = users.user_id)
+LIMIT :batch_size;
+-- batch
+INSERT INTO changelog(table_name, operation, row_id, timestamp)
+SELECT 'users_profile', 'insert', user_id, strftime('%s', 'now')
+FROM users_profile
+WHERE NOT EXISTS (SELECT 1 FROM changelog WHERE table_name = 'users_profile'
+                  AND row_id = users_profile.user_id)
+LIMIT :batch_size;
+-- batch
+INSERT INTO changelog(table_name, operation, row_id, friend_id, timestamp)
+SELECT 'friends', 'insert', user_id, friend_id, strftime('%s', 'now')
+FROM friends
+WHERE NOT EXISTS (SELECT 1 FROM changelog WHERE table_name = 'friends'
+                  AND row_id = friends.user_id
+                  AND friend_id = friends.friend_id)
+LIMIT :batch_size;
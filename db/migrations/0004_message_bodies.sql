@@ -0,0 +1,46 @@
+/*
+Move the bodies longer than 1024 bytes (MAX_INLINE_BODY) to message_bodies.
+The bodies are copied first and then removed from the messages whose body
+has not changed meanwhile. Removing a body counts as a modification for the
+versions and the changelog.
+*/
+CREATE TABLE IF NOT EXISTS message_bodies(
+  message_id INTEGER PRIMARY KEY,
+  body);
+CREATE TRIGGER IF NOT EXISTS message_bodies_message_delete AFTER DELETE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM messages_archive WHERE message_id = old.message_id)
+BEGIN
+  DELETE FROM message_bodies WHERE message_id = old.message_id;
+END;
+CREATE TRIGGER IF NOT EXISTS message_bodies_archive_delete
+AFTER DELETE ON messages_archive
+BEGIN
+  DELETE FROM message_bodies WHERE message_id = old.message_id;
+END;
+-- batch
+INSERT INTO message_bodies(message_id, body)
+SELECT message_id, body FROM messages
+WHERE LENGTH(CAST(body AS BLOB)) > 1024
+AND message_id NOT IN (SELECT message_id FROM message_bodies)
+LIMIT :batch_size;
+-- batch
+UPDATE messages SET body = NULL
+WHERE message_id IN (SELECT messages.message_id
+                     FROM messages JOIN message_bodies
+                         ON message_bodies.message_id = messages.message_id
+                     WHERE messages.body = message_bodies.body
+                     LIMIT :batch_size);
+-- batch
+INSERT INTO message_bodies(message_id, body)
+SELECT message_id, body FROM messages_archive
+WHERE LENGTH(CAST(body AS BLOB)) > 1024
+AND message_id NOT IN (SELECT message_id FROM message_bodies)
+LIMIT :batch_size;
+-- batch
+UPDATE messages_archive SET body = NULL
+WHERE message_id IN (SELECT messages_archive.message_id
+                     FROM messages_archive JOIN message_bodies
+                         ON message_bodies.message_id =
+                            messages_archive.message_id
+                     WHERE messages_archive.body = message_bodies.body
+                     LIMIT :batch_size);
@@ -0,0 +1,12 @@
+/*
+Covering indexes for the listings of messages and users. The listing
+indexes of messages start with the columns of the indexes they replace.
+*/
+CREATE INDEX IF NOT EXISTS messages_listing_timestamp ON messages(timestamp, user_nickname, title);
+DROP INDEX IF EXISTS messages_timestamp;
+CREATE INDEX IF NOT EXISTS messages_listing_nickname ON messages(user_nickname, timestamp, title);
+DROP INDEX IF EXISTS messages_nickname_timestamp;
+CREATE INDEX IF NOT EXISTS messages_archive_listing_timestamp ON messages_archive(timestamp, user_nickname, title);
+DROP INDEX IF EXISTS messages_archive_timestamp;
+CREATE INDEX IF NOT EXISTS messages_archive_listing_nickname ON messages_archive(user_nickname, timestamp, title);
+CREATE INDEX IF NOT EXISTS users_listing ON users(nickname, regDate);
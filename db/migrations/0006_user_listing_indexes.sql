@@ -0,0 +1,7 @@
+/*
+Indexes of the paginated user listings. users_nickname_nocase also covers
+get_users, so it replaces users_listing.
+*/
+CREATE INDEX IF NOT EXISTS users_nickname_nocase ON users(nickname COLLATE NOCASE, nickname, regDate);
+CREATE INDEX IF NOT EXISTS users_registration ON users(regDate, nickname);
+DROP INDEX IF EXISTS users_listing;
@@ -0,0 +1,67 @@
+/*
+The versions of messages and user profiles are taken from version_sequence
+instead of the greatest version of the table plus one, which handed out the
+version of a deleted row again. The sequence starts after the greatest
+version already given.
+*/
+CREATE TABLE IF NOT EXISTS version_sequence(
+  version INTEGER PRIMARY KEY AUTOINCREMENT);
+INSERT INTO version_sequence(version)
+SELECT MAX(version) FROM (SELECT MAX(version) AS version FROM message_versions
+                          UNION ALL
+                          SELECT MAX(version) FROM profile_versions)
+WHERE version IS NOT NULL;
+DELETE FROM version_sequence;
+DROP TRIGGER IF EXISTS message_versions_insert;
+CREATE TRIGGER IF NOT EXISTS message_versions_insert AFTER INSERT ON messages
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  INSERT OR REPLACE INTO message_versions(message_id, version)
+  VALUES(new.message_id, last_insert_rowid());
+  DELETE FROM version_sequence;
+END;
+DROP TRIGGER IF EXISTS message_versions_update;
+CREATE TRIGGER IF NOT EXISTS message_versions_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE message_versions SET version = last_insert_rowid()
+  WHERE message_id = new.message_id;
+  DELETE FROM version_sequence;
+END;
+DROP TRIGGER IF EXISTS message_versions_archive_update;
+CREATE TRIGGER IF NOT EXISTS message_versions_archive_update
+AFTER UPDATE OF title, body, reply_to, user_nickname, user_id, editor_nickname
+ON messages_archive
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE message_versions SET version = last_insert_rowid()
+  WHERE message_id = new.message_id;
+  DELETE FROM version_sequence;
+END;
+DROP TRIGGER IF EXISTS profile_versions_insert;
+CREATE TRIGGER IF NOT EXISTS profile_versions_insert AFTER INSERT ON users_profile
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  INSERT OR REPLACE INTO profile_versions(user_id, version)
+  VALUES(new.user_id, last_insert_rowid());
+  DELETE FROM version_sequence;
+END;
+DROP TRIGGER IF EXISTS profile_versions_update;
+CREATE TRIGGER IF NOT EXISTS profile_versions_update AFTER UPDATE ON users_profile
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE profile_versions SET version = last_insert_rowid()
+  WHERE user_id = new.user_id;
+  DELETE FROM version_sequence;
+END;
+DROP TRIGGER IF EXISTS profile_versions_user_update;
+CREATE TRIGGER IF NOT EXISTS profile_versions_user_update
+AFTER UPDATE OF nickname, regDate ON users
+BEGIN
+  INSERT INTO version_sequence(version) VALUES(NULL);
+  UPDATE profile_versions SET version = last_insert_rowid()
+  WHERE user_id = new.user_id;
+  DELETE FROM version_sequence;
+END;
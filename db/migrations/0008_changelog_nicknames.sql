@@ -0,0 +1,125 @@
+/*
+The changes of users, users_profile and friends record the nickname of the
+user, and of the friend, so consumers can apply them after the user has
+been deleted. The view user_nicknames gives the nickname of a user id: the
+one of the users row or, once the row is deleted (the cascaded deletes of
+its profile and friends are logged afterwards), the one of the last logged
+change of the user.
+
+The entries already logged are filled in batches only when they are newer
+than the logged insert of the current user with that id. An older entry may
+belong to a deleted user whose id was reused, and the insert may have been
+removed by Engine.compact_changelog, so the other entries are left NULL.
+*/
+ALTER TABLE changelog ADD COLUMN nickname TEXT;
+ALTER TABLE changelog ADD COLUMN friend_nickname TEXT;
+CREATE VIEW IF NOT EXISTS user_nicknames AS
+SELECT user_id, nickname FROM users
+UNION ALL
+SELECT row_id, nickname FROM changelog AS logged
+WHERE table_name = 'users' AND friend_id IS NULL AND nickname IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM users WHERE user_id = logged.row_id)
+AND seq = (SELECT MAX(seq) FROM changelog
+           WHERE table_name = 'users' AND row_id = logged.row_id
+           AND friend_id IS NULL AND nickname IS NOT NULL);
+DROP TRIGGER IF EXISTS changelog_user_insert;
+CREATE TRIGGER IF NOT EXISTS changelog_user_insert AFTER INSERT ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users', 'insert', new.user_id, new.nickname, strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_user_update;
+CREATE TRIGGER IF NOT EXISTS changelog_user_update AFTER UPDATE ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users', 'update', new.user_id, new.nickname, strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_user_delete;
+CREATE TRIGGER IF NOT EXISTS changelog_user_delete AFTER DELETE ON users
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users', 'delete', old.user_id, old.nickname, strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_profile_insert;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_insert AFTER INSERT ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users_profile', 'insert', new.user_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_profile_update;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_update AFTER UPDATE ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users_profile', 'update', new.user_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_profile_delete;
+CREATE TRIGGER IF NOT EXISTS changelog_profile_delete AFTER DELETE ON users_profile
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, nickname, timestamp)
+  VALUES('users_profile', 'delete', old.user_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.user_id),
+         strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_friend_insert;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_insert AFTER INSERT ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'insert', new.user_id, new.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.friend_id),
+         strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_friend_update;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_update AFTER UPDATE ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'delete', old.user_id, old.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.friend_id),
+         strftime('%s', 'now'));
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'insert', new.user_id, new.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = new.friend_id),
+         strftime('%s', 'now'));
+END;
+DROP TRIGGER IF EXISTS changelog_friend_delete;
+CREATE TRIGGER IF NOT EXISTS changelog_friend_delete AFTER DELETE ON friends
+BEGIN
+  INSERT INTO changelog(table_name, operation, row_id, friend_id, nickname,
+                        friend_nickname, timestamp)
+  VALUES('friends', 'delete', old.user_id, old.friend_id,
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.user_id),
+         (SELECT nickname FROM user_nicknames WHERE user_id = old.friend_id),
+         strftime('%s', 'now'));
+END;
+-- batch
+UPDATE changelog
+SET nickname = (SELECT nickname FROM users WHERE user_id = changelog.row_id)
+WHERE seq IN (SELECT seq FROM changelog AS logged
+              WHERE table_name IN ('users', 'users_profile', 'friends')
+              AND nickname IS NULL
+              AND row_id IN (SELECT user_id FROM users)
+              AND seq >= (SELECT MAX(seq) FROM changelog
+                          WHERE table_name = 'users' AND operation = 'insert'
+                          AND row_id = logged.row_id AND friend_id IS NULL)
+              LIMIT :batch_size);
+-- batch
+UPDATE changelog
+SET friend_nickname = (SELECT nickname FROM users
+                       WHERE user_id = changelog.friend_id)
+WHERE seq IN (SELECT seq FROM changelog AS logged
+              WHERE table_name = 'friends' AND friend_nickname IS NULL
+              AND friend_id IN (SELECT user_id FROM users)
+              AND seq >= (SELECT MAX(seq) FROM changelog
+                          WHERE table_name = 'users' AND operation = 'insert'
+                          AND row_id = logged.friend_id
+                          AND friend_id IS NULL)
+              LIMIT :batch_size);
@@ -0,0 +1,249 @@
+'''
+Created on 19.10.2026
+
+Parallel analytics over the messages of the forum.
+
+The messages (including the archived ones) are split in ``message_id``
+ranges which are scanned by a pool of processes. Each worker opens its own
+read-only connection to the database file and returns partial counters
+which are merged by the caller.
+
+:Example:
+
+>>> from forum import analytics
+>>> analytics.posts_per_user('db/forum.db')
+{u'AxelW': 2, u'Jack': 1, ...}
+'''
+
+from collections import Counter
+import time, sqlite3, os, urllib, multiprocessing
+
+from forum.database import DEFAULT_DB_PATH, decode_body
+
+#Number of message_id ranges scanned by each process. More ranges than
+#processes balance the load when the ids are not evenly distributed.
+DEFAULT_RANGES_PER_PROCESS = 4
+
+#Columns read by the workers. root_id is the id of the root of the thread.
+#Long bodies are stored in message_bodies.
+SCAN_QUERY = 'SELECT %(table)s.message_id, %(table)s.timestamp, \
+                     %(table)s.user_nickname, \
+                     COALESCE(message_bodies.body, %(table)s.body) AS body, \
+                     message_threads.root_id \
+              FROM %(table)s LEFT JOIN message_threads \
+                  ON message_threads.message_id = %(table)s.message_id \
+              LEFT JOIN message_bodies \
+                  ON message_bodies.message_id = %(table)s.message_id \
+              WHERE %(table)s.message_id BETWEEN ? AND ?'
+
+
+#KEY FUNCTIONS OF THE BUILT-IN AGGREGATIONS
+#Each one receives a row of SCAN_QUERY and the keywords of the scan and
+#returns the list of keys whose counter is incremented.
+def _user_keys(row, keywords):
+    return [row['user_nickname']]
+
+
+def _day_keys(row, keywords):
+    return [time.strftime('%Y-%m-%d', time.gmtime(row['timestamp']))]
+
+
+def _thread_keys(row, keywords):
+    root_id = row['root_id']
+    if root_id is None:
+        root_id = row['message_id']
+    return ['msg-' + str(root_id)]
+
+
+def _keyword_keys(row, keywords):
+    body = (decode_body(row['body']) or '').lower()
+    return [keyword for keyword in keywords if keyword.lower() in body]
+
+#Name of each aggregation and its key function
+AGGREGATIONS = {'posts_per_user': _user_keys,
+                'posts_per_day': _day_keys,
+                'posts_per_thread': _thread_keys,
+                'keywords': _keyword_keys}
+
+
+def _connect_read_only(db_path):
+    '''
+    Open a read-only connection to a database file.
+
+    '''
+    uri = 'file:%s?mode=ro' % urllib.pathname2url(os.path.abspath(db_path))
+    con = sqlite3.connect(uri)
+    con.execute('PRAGMA query_only = ON')
+    return con
+
+
+def _message_tables(cur):
+    '''
+    :return: the tables which contain messages.
+
+    '''
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' \
+                 AND name IN ('messages', 'messages_archive') \
+                 ORDER BY name")
+    return [row[0] for row in cur.fetchall()]
+
+
+def _scan_range(task):
+    '''
+    Worker of the pool. Scan the messages in a ``message_id`` range.
+
+    :param tuple task: ``(db_path, tables, first_id, last_id, names,
+        keywords)``.
+    :return: a dictionary with a Counter for each aggregation name.
+
+    '''
+    db_path, tables, first_id, last_id, names, keywords = task
+    counters = dict((name, Counter()) for name in names)
+    con = _connect_read_only(db_path)
+    con.row_factory = sqlite3.Row
+    try:
+        cur = con.cursor()
+        for table in tables:
+            cur.execute(SCAN_QUERY % {'table': table}, (first_id, last_id))
+            for row in cur:
+                for name in names:
+                    counters[name].update(AGGREGATIONS[name](row, keywords))
+    finally:
+        con.close()
+    return counters
+
+
+def split_ranges(db_path, count):
+    '''
+    Split the ``message_id`` space of a database in ranges of the same size.
+
+    :param str db_path: path of the database file.
+    :param int count: number of ranges.
+    :return: a list of tuples ``(first_id, last_id)``, both inclusive. The
+        list is empty if there are no messages.
+
+    '''
+    con = _connect_read_only(db_path)
+    try:
+        cur = con.cursor()
+        bounds = []
+        for table in _message_tables(cur):
+            cur.execute('SELECT MIN(message_id), MAX(message_id) FROM %s'
+                        % table)
+            row = cur.fetchone()
+            if row[0] is not None:
+                bounds.append(row)
+    finally:
+        con.close()
+    if not bounds:
+        return []
+    first = min(row[0] for row in bounds)
+    last = max(row[1] for row in bounds)
+    size = max(1, -(-(last - first + 1) // count))
+    return [(start, min(start + size - 1, last))
+            for start in range(first, last + 1, size)]
+
+
+def scan(db_path=None, aggregations=None, keywords=None, processes=None,
+         ranges_per_process=DEFAULT_RANGES_PER_PROCESS):
+    '''
+    Compute several aggregations in one parallel scan of the messages.
+
+    :param str db_path: default None. Path of the database file. If None
+        *db/forum.db* is used. In-memory databases cannot be scanned because
+        they are not visible from the worker processes.
+    :param list aggregations: default None. Names of the aggregations from
+        :py:data:`AGGREGATIONS`. If None, all the aggregations except
+        ``keywords`` are computed.
+    :param list keywords: default None. Words counted by the ``keywords``
+        aggregation, case insensitive. Each message counts once per word.
+    :param int processes: default None. Size of the process pool. If None
+        the number of CPUs is used. With 1 the scan runs in the calling
+        process.
+    :param int ranges_per_process: number of ``message_id`` ranges scanned
+        by each process.
+    :return: a dictionary with the name of each aggregation as key and a
+        dictionary ``{key: number_of_messages}`` as value.
+    :raises ValueError: if an aggregation is unknown.
+
+    '''
+    if db_path is None:
+        db_path = DEFAULT_DB_PATH
+    if aggregations is None:
+        aggregations = [name for name in AGGREGATIONS if name != 'keywords']
+    for name in aggregations:
+        if name not in AGGREGATIONS:
+            raise ValueError("Unknown aggregation %s" % name)
+    keywords = list(keywords or [])
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    con = _connect_read_only(db_path)
+    try:
+        tables = _message_tables(con.cursor())
+    finally:
+        con.close()
+    tasks = [(db_path, tables, first_id, last_id, aggregations, keywords)
+             for first_id, last_id in split_ranges(
+                 db_path, processes * ranges_per_process)]
+    if processes == 1:
+        partials = [_scan_range(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            partials = pool.map(_scan_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    #Merge the partial aggregates
+    results = dict((name, Counter()) for name in aggregations)
+    for partial in partials:
+        for name, counter in partial.items():
+            results[name].update(counter)
+    return dict((name, dict(counter)) for name, counter in results.items())
+
+
+def posts_per_user(db_path=None, processes=None):
+    '''
+    Count the messages sent by each nickname.
+
+    :return: a dictionary ``{nickname: number_of_messages}``.
+
+    '''
+    return scan(db_path, ['posts_per_user'],
+                processes=processes)['posts_per_user']
+
+
+def posts_per_day(db_path=None, processes=None):
+    '''
+    Count the messages sent each day (UTC).
+
+    :return: a dictionary ``{'YYYY-MM-DD': number_of_messages}``.
+
+    '''
+    return scan(db_path, ['posts_per_day'],
+                processes=processes)['posts_per_day']
+
+
+def posts_per_thread(db_path=None, processes=None):
+    '''
+    Count the messages of each thread, including its root message.
+
+    :return: a dictionary ``{root_messageid: number_of_messages}``. The id
+        of the root message has the format ``msg-\d{1,3}``.
+
+    '''
+    return scan(db_path, ['posts_per_thread'],
+                processes=processes)['posts_per_thread']
+
+
+def keyword_counts(keywords, db_path=None, processes=None):
+    '''
+    Count the messages whose body contains each keyword.
+
+    :param list keywords: the words to search, case insensitive.
+    :return: a dictionary ``{keyword: number_of_messages}``. The keywords
+        which do not appear in any message are not included.
+
+    '''
+    return scan(db_path, ['keywords'], keywords,
+                processes=processes)['keywords']
@@ -9,12 +9,578 @@ Provides the database API to access the forum persistent data.
 @author: mika oja
 '''
 
+from collections import OrderedDict
 from datetime import datetime
-import time, sqlite3, re, os
+import time, sqlite3, re, os, sys, threading, csv, json, shutil, itertools
+import bisect, functools, inspect, hashlib, zlib, weakref
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 #Default paths for .db and .sql files to create and populate the database.
 DEFAULT_DB_PATH = 'db/forum.db'
 DEFAULT_SCHEMA = "db/forum_schema_dump.sql"
 DEFAULT_DATA_DUMP = "db/forum_data_dump.sql"
+#Default directory of the migration scripts and rows changed by each
+#transaction of a batched migration statement.
+DEFAULT_MIGRATIONS = "db/migrations"
+DEFAULT_MIGRATION_BATCH = 1000
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+#Default maximum number of nicknames kept in the nickname->user_id cache.
+DEFAULT_USER_ID_CACHE_SIZE = 4096
+#Default number of pages copied in each step of an online backup and seconds
+#slept between steps, so that writers can use the database meanwhile.
+DEFAULT_BACKUP_PAGES = 256
+DEFAULT_BACKUP_SLEEP = 0.05
+#Default number of rows inserted in each transaction by the bulk loader.
+DEFAULT_BULK_BATCH = 50000
+#File extensions of the formats understood by the bulk loader and exporter.
+BULK_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.bin': 'binary'}
+#Default number of rows read from the database at a time when exporting.
+DEFAULT_EXPORT_CHUNK = 1000
+#Upper bounds in seconds of the latency histogram buckets.
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                           0.1, 0.25, 0.5, 1.0, 2.5)
+#Public Connection methods which are not recorded in the metrics, because
+#they are called internally by the rest of methods, or, like close, when
+#the thread which owns the connection is exiting.
+UNINSTRUMENTED_METHODS = ('check_foreign_keys_status',
+                          'set_foreign_keys_support',
+                          'unset_foreign_keys_support', 'close')
+#Join which adds the body stored in message_bodies as stored_body
+STORED_BODY_JOIN = ' LEFT JOIN message_bodies \
+                    ON message_bodies.message_id = %(table)s.message_id'
+#Columns of messages, in the order of the table, with the body read from
+#message_bodies if it is stored there. Used with STORED_BODY_JOIN.
+WHOLE_MESSAGE_COLUMNS = 'messages.message_id, messages.title, \
+    COALESCE(message_bodies.body, messages.body) AS body, \
+    messages.timestamp, messages.ip, messages.timesviewed, \
+    messages.reply_to, messages.user_nickname, messages.user_id, \
+    messages.editor_nickname'
+#Sources that can be exported. Each one has the query, the default watermark
+#and the columns that can be used as watermark for incremental exports.
+EXPORT_SOURCES = {
+    'messages': ('SELECT %s FROM messages' % WHOLE_MESSAGE_COLUMNS +
+                 STORED_BODY_JOIN % {'table': 'messages'}, 'message_id',
+                 {'message_id': 'messages.message_id',
+                  'timestamp': 'messages.timestamp'}),
+    'users': ('SELECT * FROM users', 'user_id',
+              {'user_id': 'user_id', 'regDate': 'regDate'}),
+    'users_profile': ('SELECT * FROM users_profile', 'user_id',
+                      {'user_id': 'user_id'}),
+    #Messages with the registration data of the sender
+    'messages_users': ('SELECT %s, users.regDate, users.lastLogin \
+                        FROM messages LEFT JOIN users \
+                        ON users.user_id = messages.user_id' %
+                       WHOLE_MESSAGE_COLUMNS +
+                       STORED_BODY_JOIN % {'table': 'messages'},
+                       'message_id',
+                       {'message_id': 'messages.message_id',
+                        'timestamp': 'messages.timestamp'}),
+    #Users with their profile
+    'users_profiles': ('SELECT users.*, users_profile.firstname, \
+                               users_profile.lastname, users_profile.email, \
+                               users_profile.website, users_profile.picture, \
+                               users_profile.mobile, users_profile.skype, \
+                               users_profile.age, users_profile.residence, \
+                               users_profile.gender, users_profile.signature, \
+                               users_profile.avatar \
+                        FROM users JOIN users_profile \
+                        ON users_profile.user_id = users.user_id',
+                       'user_id',
+                       {'user_id': 'users.user_id',
+                        'regDate': 'users.regDate'})}
+
+#Returned by UserIdCache.get when the nickname is not in the cache. None
+#cannot be used because it is cached for nicknames that are not users.
+NOT_CACHED = object()
+#Returned by the conditional reads of Connection when the version of the
+#row is the version given by the caller.
+NOT_MODIFIED = object()
+#Returned by the modifications of Connection when the version of the row is
+#not the version expected by the caller.
+VERSION_CONFLICT = object()
+#Maximum number of ids in the IN (...) list of a statement.
+MAX_IDS_PER_STATEMENT = 500
+
+#Columns read by the message listings, which do not need the body. They
+#are included in the listing indexes, so the listings do not read the
+#messages table.
+MESSAGE_LIST_COLUMNS = 'message_id, title, timestamp, user_nickname'
+#Columns used by Connection._create_message_object
+MESSAGE_OBJECT_COLUMNS = '%(table)s.message_id, %(table)s.title, \
+    %(table)s.body, %(table)s.timestamp, %(table)s.reply_to, \
+    %(table)s.user_nickname, %(table)s.editor_nickname'
+#Columns used by Connection._create_user_object and the user_id cache
+USER_OBJECT_COLUMNS = 'users.user_id, users.nickname, users.regDate, \
+    users_profile.firstname, users_profile.lastname, users_profile.email, \
+    users_profile.website, users_profile.picture, users_profile.mobile, \
+    users_profile.skype, users_profile.age, users_profile.residence, \
+    users_profile.gender, users_profile.signature, users_profile.avatar'
+#Bodies longer than this number of bytes (once encoded) are stored in the
+#message_bodies table, so the rows of messages stay small. It must match
+#db/migrations/0004_message_bodies.sql.
+MAX_INLINE_BODY = 1024
+
+
+def encode_body(body, threshold=None):
+    '''
+    Prepare the body of a message to be stored. Bodies of at least
+    ``threshold`` bytes (encoded in UTF-8) are compressed with zlib and
+    stored as a BLOB. Plain bodies are stored as TEXT, so both can be
+    mixed in the same table.
+
+    :param body: the text of the message. It can be None.
+    :param int threshold: default None. Minimum size of the compressed
+        bodies. If None the body is never compressed.
+    :return: the value to store in the ``body`` column.
+
+    '''
+    if threshold is None or body is None:
+        return body
+    data = body.encode('utf-8') if isinstance(body, unicode) else body
+    if len(data) < threshold:
+        return body
+    compressed = zlib.compress(data)
+    #Incompressible bodies are not worth the decompression
+    if len(compressed) >= len(data):
+        return body
+    return buffer(compressed)
+
+
+def _body_size(body):
+    '''
+    :return: the number of bytes stored for a value of the ``body`` column.
+
+    '''
+    if isinstance(body, unicode):
+        return len(body.encode('utf-8'))
+    return len(body) if body is not None else 0
+
+
+def _split_body(body):
+    '''
+    Decide where an encoded body is stored.
+
+    :param body: a value returned by :py:func:`encode_body`.
+    :return: a tuple ``(inline, stored)``. ``inline`` is the value of the
+        ``body`` column of the message and ``stored`` the value for
+        ``message_bodies``, or None if the body is stored inline.
+
+    '''
+    if _body_size(body) > MAX_INLINE_BODY:
+        return None, body
+    return body, None
+
+
+def decode_body(body):
+    '''
+    Return the text of a value read from the ``body`` column, decompressing
+    it if it was stored by :py:func:`encode_body` as a BLOB.
+
+    '''
+    if isinstance(body, buffer):
+        return zlib.decompress(body).decode('utf-8')
+    return body
+
+
+class UserIdCache(object):
+    '''
+    Bounded cache that maps nicknames to the ``user_id`` in the ``users``
+    table. Only the nicknames of users are cached: a nickname which is not a
+    user may be registered at any time by another Engine or process, which
+    would not invalidate the entry of this cache.
+
+    The least recently used nickname is discarded when the cache is full.
+    The cache is shared by all the connections of an :py:class:`Engine` and
+    it is safe to use it from several threads.
+
+    :param int capacity: maximum number of nicknames stored.
+
+    '''
+    def __init__(self, capacity=DEFAULT_USER_ID_CACHE_SIZE):
+        super(UserIdCache, self).__init__()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, nickname):
+        '''
+        :return: the cached user_id or :py:data:`NOT_CACHED` if the
+            nickname is not cached.
+
+        '''
+        with self._lock:
+            user_id = self._entries.pop(nickname, NOT_CACHED)
+            if user_id is not NOT_CACHED:
+                #Move it to the end, it is the most recently used now.
+                self._entries[nickname] = user_id
+                self.hits += 1
+            else:
+                self.misses += 1
+            return user_id
+
+    def put(self, nickname, user_id):
+        '''
+        Store the user_id of a nickname. None, the user_id of a nickname which
+        is not a user, is not stored.
+
+        '''
+        if user_id is None:
+            return
+        with self._lock:
+            self._entries.pop(nickname, None)
+            self._entries[nickname] = user_id
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def update(self, pairs):
+        '''
+        Store several ``(nickname, user_id)`` pairs at once.
+
+        '''
+        for nickname, user_id in pairs:
+            self.put(nickname, user_id)
+
+    def invalidate(self, nickname):
+        '''
+        Remove a nickname from the cache.
+
+        '''
+        with self._lock:
+            self._entries.pop(nickname, None)
+
+    def clear(self):
+        '''
+        Remove all the nicknames from the cache.
+
+        '''
+        with self._lock:
+            self._entries.clear()
+
+
+class _ThreadToken(object):
+    '''
+    Placeholder stored in the ``threading.local`` of a thread. The local
+    values of a thread are released when the thread exits, so a weak
+    reference to the token tells when the connection of the thread must be
+    closed. The token has no references and no ``__del__`` method, so it
+    can never be kept alive by a reference cycle or left in ``gc.garbage``.
+
+    '''
+    __slots__ = ('__weakref__',)
+
+
+class ThreadConnections(object):
+    '''
+    Hands each thread its own long-lived Connection. A sqlite3 connection
+    can only be used by the thread which created it and a
+    :py:class:`Connection` modifies the state of its sqlite3 connection in
+    every call, so connections must not be shared by threads.
+
+    The connection of a thread is closed when the thread exits or when it
+    calls :py:meth:`close`.
+
+    :param connect: function without arguments that creates a Connection,
+        for instance :py:meth:`Engine.connect`.
+
+    '''
+    def __init__(self, connect):
+        super(ThreadConnections, self).__init__()
+        self.connect = connect
+        self._local = threading.local()
+        #Weak reference to the token of each thread -> Connection
+        self._live = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._live)
+
+    def get(self):
+        '''
+        :return: the Connection of the current thread, created in the first
+            call.
+
+        '''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connect()
+            token = _ThreadToken()
+            with self._lock:
+                self._live[weakref.ref(token, self._release)] = connection
+            self._local.token = token
+            self._local.connection = connection
+        return connection
+
+    def _release(self, ref):
+        '''
+        Weak reference callback: close the connection of a thread whose
+        token has been released.
+
+        '''
+        with self._lock:
+            connection = self._live.pop(ref, None)
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except sqlite3.Error:
+            #The database may have been removed meanwhile or the thread
+            #state may be released by another thread
+            pass
+
+    def close(self):
+        '''
+        Close the Connection of the current thread, if it has one. The next
+        call to :py:meth:`get` from this thread creates a new one.
+
+        '''
+        token = getattr(self._local, 'token', None)
+        if token is None:
+            return
+        self._release(weakref.ref(token))
+        del self._local.token
+        del self._local.connection
+
+
+class MetricsRegistry(object):
+    '''
+    Counts the calls, errors and rows of the public methods of the
+    connections and keeps a latency histogram for each method. It also
+    exposes gauges, such as the size of the caches, which are read when the
+    metrics are exported.
+
+    Each thread updates its own counters, so recording a call does not take
+    any lock. The counters of all the threads are added when the metrics are
+    exported with :py:meth:`snapshot` or :py:meth:`prometheus`. The counters
+    of a thread are added to a shared total when the thread exits.
+
+    :param buckets: upper bounds in seconds of the latency histogram
+        buckets. Default :py:data:`DEFAULT_LATENCY_BUCKETS`.
+
+    '''
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        super(MetricsRegistry, self).__init__()
+        self.buckets = tuple(sorted(buckets))
+        self._local = threading.local()
+        #Weak reference to the token of each running thread -> counters
+        self._counters = {}
+        #Counters of the threads which exited
+        self._exited = {}
+        self._gauges = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _thread_counters(self):
+        counters = getattr(self._local, 'counters', None)
+        if counters is None:
+            counters = {}
+            token = _ThreadToken()
+            with self._lock:
+                self._counters[weakref.ref(token, self._thread_exited)] = \
+                    counters
+            self._local.token = token
+            self._local.counters = counters
+        return counters
+
+    def _thread_exited(self, ref):
+        '''
+        Weak reference callback: add the counters of a thread which exited
+        to the shared total.
+
+        '''
+        with self._lock:
+            counters = self._counters.pop(ref, None)
+            if counters is not None:
+                self._add(self._exited, counters)
+
+    def _add(self, totals, counters):
+        '''
+        Add the counters of a thread to ``totals``.
+
+        '''
+        for operation, entry in counters.items():
+            total = totals.get(operation)
+            if total is None:
+                total = totals[operation] = \
+                    [0, 0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+            for i in range(4):
+                total[i] += entry[i]
+            for i, count in enumerate(entry[4]):
+                total[4][i] += count
+
+    def observe(self, operation, seconds, rows=0, error=False):
+        '''
+        Record a call.
+
+        :param str operation: name of the method.
+        :param float seconds: duration of the call.
+        :param int rows: number of rows returned or modified.
+        :param bool error: True if the call raised an exception.
+
+        '''
+        counters = self._thread_counters()
+        entry = counters.get(operation)
+        if entry is None:
+            #calls, errors, rows, seconds and the count of each bucket
+            entry = counters[operation] = [0, 0, 0, 0.0,
+                                           [0] * (len(self.buckets) + 1)]
+        entry[0] += 1
+        if error:
+            entry[1] += 1
+        entry[2] += rows
+        entry[3] += seconds
+        entry[4][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def register(self, name, function, description='', kind='gauge'):
+        '''
+        Add a value read when the metrics are exported.
+
+        :param str name: name of the metric.
+        :param function: function without arguments which returns the value.
+        :param str description: text exported as the help of the metric.
+        :param str kind: default ``gauge``. ``gauge`` or ``counter``.
+        :raises ValueError: if a metric with the same name is already
+            registered, for instance because two Engines use this registry.
+
+        '''
+        if name in self._gauges:
+            raise ValueError("The metric %s is already registered" % name)
+        self._gauges[name] = (function, description, kind)
+
+    def snapshot(self):
+        '''
+        :return: a dictionary with two keys:
+
+            * ``operations``: dictionary with the name of each method as key
+              and a dictionary with the keys ``calls``, ``errors``, ``rows``,
+              ``seconds`` (total duration) and ``latency`` as value.
+              ``latency`` is a list of tuples ``(upper_bound, calls)`` with
+              the cumulative count of each bucket, the last bound being
+              ``float('inf')``.
+            * ``gauges``: dictionary with the name and the current value of
+              each registered gauge.
+
+        '''
+        totals = {}
+        with self._lock:
+            self._add(totals, self._exited)
+            threads = list(self._counters.values())
+        for counters in threads:
+            self._add(totals, counters)
+        operations = {}
+        bounds = self.buckets + (float('inf'),)
+        for operation, total in totals.items():
+            latency = []
+            cumulative = 0
+            for bound, count in zip(bounds, total[4]):
+                cumulative += count
+                latency.append((bound, cumulative))
+            operations[operation] = {'calls': total[0], 'errors': total[1],
+                                     'rows': total[2], 'seconds': total[3],
+                                     'latency': latency}
+        gauges = dict((name, function())
+                      for name, (function, _, _) in self._gauges.items())
+        return {'operations': operations, 'gauges': gauges}
+
+    def prometheus(self, prefix='forum_db'):
+        '''
+        Export the metrics in the Prometheus text exposition format.
+
+        :param str prefix: prefix of the name of every metric.
+        :return: the metrics as a string.
+
+        '''
+        snapshot = self.snapshot()
+        operations = sorted(snapshot['operations'].items())
+        lines = []
+        for key, metric, description in (
+                ('calls', 'calls_total', 'Calls of each Connection method.'),
+                ('errors', 'errors_total',
+                 'Calls of each Connection method which raised an error.'),
+                ('rows', 'rows_total',
+                 'Rows returned or modified by each Connection method.')):
+            name = '%s_%s' % (prefix, metric)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s counter' % name)
+            for operation, values in operations:
+                lines.append('%s{operation="%s"} %d' %
+                             (name, operation, values[key]))
+        name = '%s_latency_seconds' % prefix
+        lines.append('# HELP %s Duration of each Connection method.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for operation, values in operations:
+            for bound, count in values['latency']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{operation="%s",le="%s"} %d' %
+                             (name, operation, le, count))
+            lines.append('%s_sum{operation="%s"} %r' %
+                         (name, operation, values['seconds']))
+            lines.append('%s_count{operation="%s"} %d' %
+                         (name, operation, values['calls']))
+        for gauge, (_, description, kind) in self._gauges.items():
+            name = '%s_%s' % (prefix, gauge)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %r' % (name, snapshot['gauges'][gauge]))
+        return '\n'.join(lines) + '\n'
+
+
+def _count_rows(result):
+    '''
+    :return: the number of rows returned or modified by a Connection method,
+        deduced from its result.
+
+    '''
+    if result is None or result is False:
+        return 0
+    if isinstance(result, tuple):
+        #get_threads returns (threads, next_cursor)
+        result = result[0]
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def _instrument(name, method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        #Only the outermost call of a connection is recorded
+        if metrics is None or self._in_call:
+            return method(self, *args, **kwargs)
+        self._in_call = True
+        start = time.time()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception:
+            metrics.observe(name, time.time() - start, 0, True)
+            raise
+        finally:
+            self._in_call = False
+        metrics.observe(name, time.time() - start, _count_rows(result))
+        return result
+    return wrapper
+
+
+def instrumented(cls):
+    '''
+    Class decorator which records the calls to the public methods of a
+    Connection class in the MetricsRegistry of the connection (its
+    ``metrics`` attribute), except :py:data:`UNINSTRUMENTED_METHODS`.
+
+    '''
+    for name, method in list(cls.__dict__.items()):
+        if name.startswith('_') or name in UNINSTRUMENTED_METHODS \
+           or not inspect.isfunction(method):
+            continue
+        setattr(cls, name, _instrument(name, method))
+    return cls
 
 
 class Engine(object):
@@ -34,9 +600,40 @@ class Engine(object):
     :param db_path: The path of the database file (always with respect to the
         calling script. If not specified, the Engine will use the file located
         at *db/forum.db*
+    :param int user_id_cache_size: maximum number of nicknames kept in the
+        nickname->user_id cache shared by all connections.
+    :param list replicas: default None. Paths of read replicas of the
+        database. The read methods of the connections query the replicas
+        and the rest of methods the database in ``db_path``. The replicas
+        are copies of the database made by :py:meth:`refresh_replicas`.
+    :param float replica_refresh_interval: default None. If given, the
+        replicas are refreshed every ``replica_refresh_interval`` seconds
+        from a background thread.
+    :param metrics: default None. Registry where the connections record
+        their calls, see :py:attr:`metrics`. If None, the Engine creates
+        its own registry. The Engine registers its gauges in the registry,
+        so a registry cannot be shared by several Engines.
+    :type metrics: MetricsRegistry
+    :param int body_compression_threshold: default None. If given, the
+        connections compress the message bodies of at least this number of
+        bytes (see :py:func:`encode_body`). The bodies are decompressed
+        only when a whole message is read, never in the listings. Databases
+        with compressed bodies can be read by any connection.
+    :param bool auto_migrate: default True. If ``True`` the first call to
+        :py:meth:`connect` applies the pending migrations of a database
+        created by an older version of this module (see :py:meth:`migrate`),
+        so that the connections find the tables they query. Set it to
+        ``False`` to run the migrations explicitly, for instance with a
+        ``pause`` between the batches of a large database.
 
     '''
-    def __init__(self, db_path=None):
+    #Tables which are not emptied by clear(fast=True)
+    _kept_tables = ('schema_migrations',)
+
+    def __init__(self, db_path=None,
+                 user_id_cache_size=DEFAULT_USER_ID_CACHE_SIZE,
+                 replicas=None, replica_refresh_interval=None, metrics=None,
+                 body_compression_threshold=None, auto_migrate=True):
         '''
         '''
 
@@ -45,33 +642,493 @@ class Engine(object):
             self.db_path = db_path
         else:
             self.db_path = DEFAULT_DB_PATH
-
-    def connect(self):
+        self.user_ids = UserIdCache(user_id_cache_size)
+        self.thread_connections = ThreadConnections(self.connect)
+        self.replicas = None
+        if replicas:
+            self.replicas = ReplicaSet(self.db_path, replicas)
+            if replica_refresh_interval is not None:
+                self.replicas.start(replica_refresh_interval)
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.body_compression_threshold = body_compression_threshold
+        self.auto_migrate = auto_migrate
+        self._schema_checked = False
+        self._schema_lock = threading.Lock()
+        self._register_metrics()
+
+    def _register_metrics(self):
+        '''
+        Register the pool and cache statistics of the Engine as gauges of
+        :py:attr:`metrics`.
+
+        '''
+        user_ids = self.user_ids
+        self.metrics.register('thread_connections',
+                              self.thread_connections.__len__,
+                              'Open per-thread connections.')
+        self.metrics.register('user_id_cache_entries', user_ids.__len__,
+                              'Nicknames in the user_id cache.')
+        self.metrics.register('user_id_cache_capacity',
+                              lambda: user_ids.capacity,
+                              'Maximum nicknames in the user_id cache.')
+        self.metrics.register('user_id_cache_hits_total',
+                              lambda: user_ids.hits,
+                              'Lookups answered by the user_id cache.',
+                              'counter')
+        self.metrics.register('user_id_cache_misses_total',
+                              lambda: user_ids.misses,
+                              'Lookups not answered by the user_id cache.',
+                              'counter')
+
+    def connect(self, read_your_writes=False):
         '''
         Creates a connection to the database.
 
+        :param bool read_your_writes: default False. Only used with
+            replicas. If ``True`` the connection reads from the primary
+            database after modifying it until the replicas are refreshed.
         :return: A Connection instance
         :rtype: Connection
 
         '''
-        return Connection(self.db_path)
+        connection = Connection(self.db_path, self.user_ids, self.replicas,
+                                read_your_writes, self.metrics,
+                                self.body_compression_threshold)
+        if self.auto_migrate and not self._schema_checked:
+            self._upgrade_schema(connection.con)
+        return connection
+
+    def _upgrade_schema(self, con):
+        '''
+        Apply the pending migrations if the database already has the forum
+        tables. Empty databases are left alone, they are created with
+        :py:meth:`create_tables`, which records the migrations as applied.
+
+        :param con: sqlite3 connection to the database.
+
+        '''
+        with self._schema_lock:
+            if self._schema_checked:
+                return
+            cur = con.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' \
+                         AND name IN ('users', 'schema_migrations')")
+            tables = set(row[0] for row in cur.fetchall())
+            if 'users' not in tables:
+                return
+            applied = set()
+            if 'schema_migrations' in tables:
+                cur.execute('SELECT version FROM schema_migrations')
+                applied = set(row[0] for row in cur.fetchall())
+            if [version for version, _, _ in self.migrations()
+                    if version not in applied]:
+                self.migrate()
+            self._schema_checked = True
+
+    def thread_connection(self):
+        '''
+        Return the Connection of the current thread, creating it in the
+        first call. Use it instead of :py:meth:`connect` in threaded
+        servers: each thread keeps its own connection between requests and
+        it is closed when the thread exits. Do not close it directly, use
+        :py:meth:`close_thread_connection` instead.
+
+        :return: A Connection instance owned by the current thread
+        :rtype: Connection
+
+        '''
+        return self.thread_connections.get()
+
+    def close_thread_connection(self):
+        '''
+        Close the Connection of the current thread, if it has one.
+
+        '''
+        self.thread_connections.close()
+
+    def live_connections(self):
+        '''
+        :return: the number of per-thread connections which are open.
+
+        '''
+        return len(self.thread_connections)
+
+    #READ REPLICAS
+    def refresh_replicas(self):
+        '''
+        Copy the database to all its read replicas. Connections switch to
+        the new copies on their next read.
+
+        '''
+        if self.replicas is not None:
+            self.replicas.refresh()
+
+    def replica_staleness(self):
+        '''
+        :return: a dictionary with the replica paths as keys and as values
+            dictionaries with the keys ``age`` (seconds since the data of the
+            replica was copied or None if it has never been refreshed),
+            ``refreshes`` (int) and ``duration`` (seconds taken by the last
+            refresh). An empty dictionary if there are no replicas.
+
+        '''
+        if self.replicas is None:
+            return {}
+        return self.replicas.staleness()
+
+    def preload_user_ids(self):
+        '''
+        Fill the nickname->user_id cache with the users in the database, up
+        to the capacity of the cache.
+
+        :return: the number of nicknames loaded.
+
+        '''
+        query = 'SELECT nickname, user_id FROM users LIMIT ?'
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            cur.execute(query, (self.user_ids.capacity,))
+            rows = cur.fetchall()
+        finally:
+            con.close()
+        self.user_ids.update(rows)
+        return len(rows)
+
+    #ONLINE BACKUP
+    @staticmethod
+    def _is_memory(path):
+        '''
+        :return: ``True`` if ``path`` refers to an in-memory database.
+
+        '''
+        return path == ':memory:' or 'mode=memory' in path
+
+    @staticmethod
+    def _drop_schema(cur):
+        '''
+        Drop all the tables, views and triggers of the main database of the
+        cursor. Foreign keys must be disabled.
+
+        '''
+        cur.execute("SELECT type, name FROM main.sqlite_master \
+                     WHERE type IN ('trigger', 'view', 'table') \
+                     AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'")
+        objects = cur.fetchall()
+        for kind in ('trigger', 'view', 'table'):
+            for type_, name in objects:
+                if type_ == kind:
+                    cur.execute('DROP %s main."%s"' % (kind.upper(), name))
+
+    @staticmethod
+    def _attach_copy(src_path, dest_path):
+        '''
+        Replace the content of ``dest_path`` with a copy of ``src_path``
+        attaching the source and copying table by table in one transaction.
+
+        '''
+        dest = sqlite3.connect(dest_path)
+        #Manage the transaction explicitly, otherwise the sqlite3 module
+        #commits before each CREATE statement.
+        dest.isolation_level = None
+        cur = dest.cursor()
+        try:
+            cur.execute('PRAGMA foreign_keys = OFF')
+            cur.execute('ATTACH DATABASE ? AS source', (src_path,))
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                Engine._drop_schema(cur)
+                cur.execute("SELECT type, name, sql FROM source.sqlite_master \
+                             WHERE sql IS NOT NULL \
+                             AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\' \
+                             ORDER BY rowid")
+                objects = cur.fetchall()
+                #Tables and data first, then indexes, views and triggers
+                for type_, name, sql in objects:
+                    if type_ == 'table':
+                        cur.execute(sql)
+                        cur.execute('INSERT INTO main."%s" \
+                                     SELECT * FROM source."%s"' % (name, name))
+                cur.execute("SELECT 1 FROM source.sqlite_master \
+                             WHERE name = 'sqlite_sequence'")
+                if cur.fetchone() is not None:
+                    cur.execute('DELETE FROM main.sqlite_sequence')
+                    cur.execute('INSERT INTO main.sqlite_sequence \
+                                 SELECT * FROM source.sqlite_sequence')
+                for type_, name, sql in objects:
+                    if type_ != 'table':
+                        cur.execute(sql)
+                cur.execute('COMMIT')
+            except sqlite3.Error:
+                cur.execute('ROLLBACK')
+                raise
+            finally:
+                cur.execute('DETACH DATABASE source')
+        finally:
+            dest.close()
+
+    @staticmethod
+    def _copy_database(src_path, dest_path, pages_per_step, progress, sleep):
+        '''
+        Copy the database in ``src_path`` to ``dest_path`` while other
+        connections keep using it.
+
+        If the sqlite3 module provides the online backup API (Python 3.7+),
+        ``pages_per_step`` pages are copied at a time, sleeping ``sleep``
+        seconds between steps. Otherwise (Python 2) the copy is not stepped:
+        the snapshot is taken in one step with ``VACUUM INTO`` on a
+        temporary file which then replaces ``dest_path``,
+        ``pages_per_step`` and ``sleep`` are ignored and ``progress`` is
+        only called once at the end. ``VACUUM INTO`` reads the whole
+        database in one transaction, so unless the database uses
+        ``journal_mode=WAL`` the writers wait until the copy finishes.
+
+        '''
+        if not hasattr(sqlite3.Connection, 'backup') and \
+           Engine._is_memory(dest_path):
+            #VACUUM INTO cannot write to a memory database
+            Engine._attach_copy(src_path, dest_path)
+            if progress is not None:
+                progress(sqlite3.SQLITE_OK, 0, 0)
+            return
+        src = sqlite3.connect(src_path)
+        try:
+            if hasattr(src, 'backup'):
+                dest = sqlite3.connect(dest_path)
+                try:
+                    src.backup(dest, pages=pages_per_step,
+                               progress=progress, sleep=sleep)
+                finally:
+                    dest.close()
+                return
+            tmp_path = dest_path + '.tmp'
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            cur = src.cursor()
+            cur.execute('VACUUM INTO ?', (tmp_path,))
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            os.rename(tmp_path, dest_path)
+            if progress is not None:
+                cur.execute('PRAGMA page_count')
+                total = cur.fetchone()[0]
+                progress(sqlite3.SQLITE_OK, 0, total)
+        finally:
+            src.close()
+
+    @staticmethod
+    def _restore_database(src_path, dest_path, pages_per_step, progress,
+                          sleep):
+        '''
+        Replace the content of ``dest_path`` with the snapshot in
+        ``src_path``, see :py:meth:`restore`.
+
+        '''
+        if hasattr(sqlite3.Connection, 'backup'):
+            Engine._copy_database(src_path, dest_path, pages_per_step,
+                                  progress, sleep)
+        else:
+            Engine._attach_copy(src_path, dest_path)
+            if progress is not None:
+                progress(sqlite3.SQLITE_OK, 0, 0)
+
+    def backup(self, dest_path, pages_per_step=DEFAULT_BACKUP_PAGES,
+               progress=None, sleep=DEFAULT_BACKUP_SLEEP):
+        '''
+        Create a consistent snapshot of the database in ``dest_path`` using
+        the sqlite3 online backup API. The forum can keep reading and
+        writing the database while the backup is running.
+
+        The online backup API is only available in Python 3.7+. On Python 2
+        the backup is not online: the snapshot is taken in one step with
+        ``VACUUM INTO``, which holds a read transaction for the whole copy.
+        The forum can keep reading, but with the default rollback journal
+        the writers wait until the copy finishes, and fail with *database
+        is locked* if it takes longer than their busy timeout. With
+        ``journal_mode=WAL`` the writers are not blocked. ``pages_per_step``
+        and ``sleep`` have no effect and ``progress`` is called once at the
+        end.
+
+        :param str dest_path: path of the snapshot file. It is overwritten if
+            it exists.
+        :param int pages_per_step: default 256. Number of pages copied at a
+            time. Smaller values limit the I/O impact on the live database.
+            Ignored on Python 2.
+        :param progress: default None. Callable receiving
+            ``(status, remaining, total)`` after each step.
+        :param float sleep: default 0.05. Seconds to wait between steps.
+            Ignored on Python 2.
+
+        '''
+        self._copy_database(self.db_path, dest_path, pages_per_step,
+                            progress, sleep)
+
+    def verify_backup(self, path):
+        '''
+        Check the integrity of a snapshot created with :py:meth:`backup`.
+
+        :param str path: path of the snapshot file.
+        :return: ``True`` if the file is a sound database and ``False``
+            otherwise.
+
+        '''
+        if not os.path.exists(path):
+            return False
+        con = sqlite3.connect(path)
+        try:
+            cur = con.cursor()
+            cur.execute('PRAGMA integrity_check')
+            return cur.fetchall() == [('ok',)]
+        except sqlite3.Error, excp:
+            print "Error %s:" % excp.args[0]
+            return False
+        finally:
+            con.close()
+
+    def restore(self, src_path, pages_per_step=DEFAULT_BACKUP_PAGES,
+                progress=None, sleep=DEFAULT_BACKUP_SLEEP):
+        '''
+        Replace the content of the database with a snapshot created with
+        :py:meth:`backup`. The snapshot is verified first.
+
+        On Python 2, which has no online backup API, the tables of the
+        snapshot are copied into the database in one transaction (the
+        database file is not replaced), so the open connections see the
+        restored content. ``pages_per_step`` and ``sleep`` have no effect
+        and ``progress`` is called once at the end.
+
+        :param str src_path: path of the snapshot file.
+        :param int pages_per_step: see :py:meth:`backup`.
+        :param progress: see :py:meth:`backup`.
+        :param float sleep: see :py:meth:`backup`.
+        :return: ``True`` if the database was restored and ``False`` if the
+            snapshot is not valid.
+
+        '''
+        if not self.verify_backup(src_path):
+            return False
+        self._restore_database(src_path, self.db_path, pages_per_step,
+                               progress, sleep)
+        #Nicknames cached meanwhile may have other ids in the snapshot
+        self.user_ids.clear()
+        return True
+
+    #TEMPLATE DATABASES
+    def _default_template_path(self):
+        '''
+        :return: the path of the template of this database, the database path
+            with the suffix *_template*.
+
+        '''
+        root, ext = os.path.splitext(self.db_path)
+        return root + '_template' + (ext or '.db')
+
+    def create_template(self, template_path=None, schema=None, dump=None,
+                        force=False):
+        '''
+        Create a database file with the schema and the data of the given
+        scripts to be copied later with :py:meth:`clone_template`. The
+        template is only rebuilt if it does not exist, if it is older than
+        the scripts or if ``force`` is ``True``, so parsing the scripts is
+        done once instead of every time a fresh database is needed.
+
+        :param str template_path: default None. Path of the template file.
+            If None *<db_path>_template.db* is used.
+        :param str schema: path to the .sql schema file. If None
+            *db/forum_schema_dump.sql* is utilized.
+        :param str dump: path to the .sql dump file. If None
+            *db/forum_data_dump.sql* is utilized.
+        :param bool force: default False. Rebuild the template even if it is
+            up to date.
+        :return: the path of the template file.
+
+        '''
+        if template_path is None:
+            template_path = self._default_template_path()
+        if schema is None:
+            schema = DEFAULT_SCHEMA
+        if dump is None:
+            dump = DEFAULT_DATA_DUMP
+        if not force and os.path.exists(template_path):
+            built = os.path.getmtime(template_path)
+            scripts = [schema, dump] + [path for _, _, path in
+                                        self.migrations()]
+            if built >= max(os.path.getmtime(path) for path in scripts):
+                return template_path
+        #Build it under a temporary name so a half built template is never
+        #cloned.
+        tmp_path = template_path + '.tmp'
+        template = Engine(tmp_path)
+        template.remove_database()
+        template.create_tables(schema)
+        template.populate_tables(dump)
+        if os.path.exists(template_path):
+            os.remove(template_path)
+        os.rename(tmp_path, template_path)
+        return template_path
+
+    def clone_template(self, template_path=None):
+        '''
+        Replace the database file with a copy of a template created with
+        :py:meth:`create_template`. Copying the file is much faster than
+        creating and populating the tables from the scripts. Connections
+        opened before the clone must be closed and opened again.
+
+        :param str template_path: default None. Path of the template file.
+            If None *<db_path>_template.db* is used.
+
+        '''
+        if template_path is None:
+            template_path = self._default_template_path()
+        self.user_ids.clear()
+        tmp_path = self.db_path + '.tmp'
+        shutil.copyfile(template_path, tmp_path)
+        if os.path.exists(self.db_path):
+            os.remove(self.db_path)
+        os.rename(tmp_path, self.db_path)
+
+    def remove_template(self, template_path=None):
+        '''
+        Removes the template file from the filesystem.
+
+        :param str template_path: default None. Path of the template file.
+            If None *<db_path>_template.db* is used.
+
+        '''
+        if template_path is None:
+            template_path = self._default_template_path()
+        if os.path.exists(template_path):
+            os.remove(template_path)
 
     def remove_database(self):
         '''
         Removes the database file from the filesystem.
 
         '''
+        self.user_ids.clear()
         if os.path.exists(self.db_path):
             #THIS REMOVES THE DATABASE STRUCTURE
             os.remove(self.db_path)
 
-    def clear(self):
+    def clear(self, fast=False):
         '''
         Purge the database removing all records from the tables. However,
         it keeps the database schema (meaning the table structure)
 
+        :param bool fast: default False. If ``True`` all the tables are
+            emptied with foreign keys disabled and the triggers are dropped
+            and created again in the same transaction. This allows SQLite to
+            drop the pages of each table instead of deleting, cascading and
+            firing triggers row by row, so the time barely depends on the
+            size of the database. Use :py:meth:`clone_template` to go back
+            to a populated snapshot instead.
+
         '''
         keys_on = 'PRAGMA foreign_keys = ON'
+        self.user_ids.clear()
+        if fast:
+            self._truncate()
+            return
         #THIS KEEPS THE SCHEMA AND REMOVE VALUES
         con = sqlite3.connect(self.db_path)
         #Activate foreing keys support
@@ -81,9 +1138,349 @@ class Engine(object):
             cur = con.cursor()
             cur.execute("DELETE FROM messages")
             cur.execute("DELETE FROM users")
+            cur.execute("SELECT name FROM sqlite_master \
+                         WHERE type = 'table' AND name = 'messages_archive'")
+            if cur.fetchone() is not None:
+                cur.execute("DELETE FROM messages_archive")
+                cur.execute("DELETE FROM archive_info")
+            cur.execute("SELECT name FROM sqlite_master \
+                         WHERE type = 'table' AND name = 'changelog'")
+            if cur.fetchone() is not None:
+                cur.execute("DELETE FROM changelog")
+                cur.execute("DELETE FROM changelog_info")
             #NOTE since we have ON DELETE CASCADE BOTH IN users_profile AND
             #friends, WE DO NOT HAVE TO WORRY TO CLEAR THOSE TABLES.
 
+    def _truncate(self):
+        '''
+        Empty all the tables using the SQLite truncate optimization. See
+        :py:meth:`clear`.
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        #Manage the transaction explicitly, otherwise the sqlite3 module
+        #commits before each DROP and CREATE statement.
+        con.isolation_level = None
+        cur = con.cursor()
+        try:
+            cur.execute('PRAGMA foreign_keys = OFF')
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                cur.execute("SELECT name, sql FROM sqlite_master \
+                             WHERE type = 'trigger'")
+                triggers = cur.fetchall()
+                cur.execute("SELECT name FROM sqlite_master \
+                             WHERE type = 'table' \
+                             AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'")
+                tables = [row[0] for row in cur.fetchall()
+                          if row[0] not in self._kept_tables]
+                for name, sql in triggers:
+                    cur.execute('DROP TRIGGER %s' % name)
+                for table in tables:
+                    cur.execute('DELETE FROM %s' % table)
+                for name, sql in triggers:
+                    cur.execute(sql)
+                cur.execute('COMMIT')
+            except sqlite3.Error:
+                cur.execute('ROLLBACK')
+                raise
+        finally:
+            con.close()
+
+    #ARCHIVE OF OLD THREADS
+    def archive_messages(self, cutoff):
+        '''
+        Move the threads whose newest message is older than ``cutoff`` from
+        ``messages`` to ``messages_archive``. The messages table and its
+        indexes keep only the recent threads, while the connections read the
+        archive only when the requested time range reaches the cutoff (see
+        :py:meth:`Connection.get_messages`). The thread and user statistics
+        are not modified by the move.
+
+        Archived threads are read only: they can be deleted but not answered.
+
+        :param cutoff: UNIX timestamp. The cutoff of the archive never goes
+            back, so a value older than the current cutoff only archives the
+            threads which became older than the current cutoff meanwhile.
+        :return: the number of messages archived.
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            cur.execute('PRAGMA foreign_keys = ON')
+            with con:
+                cur.execute('INSERT INTO archive_info(archive_id, cutoff) \
+                             VALUES(0, ?) ON CONFLICT(archive_id) DO UPDATE \
+                             SET cutoff = MAX(cutoff, excluded.cutoff)',
+                            (cutoff,))
+                cur.execute('SELECT cutoff FROM archive_info')
+                cutoff = cur.fetchone()[0]
+                #Archived threads keep their rows in message_threads
+                archived = 'SELECT message_threads.message_id \
+                            FROM threads, message_threads \
+                            WHERE threads.last_activity < ? \
+                            AND message_threads.root_id = threads.root_id'
+                #The delete triggers skip the messages present in the archive
+                cur.execute('INSERT INTO messages_archive \
+                             SELECT * FROM messages \
+                             WHERE message_id IN (%s)' % archived, (cutoff,))
+                count = cur.rowcount
+                cur.execute('DELETE FROM messages WHERE message_id IN (%s)'
+                            % archived, (cutoff,))
+            return count
+        finally:
+            con.close()
+
+    #CHANGELOG COMPACTION
+    def compact_changelog(self, before_seq, drop_deletes=False):
+        '''
+        Remove the entries of the changelog up to ``before_seq`` which are
+        followed by a newer entry of the same row. A consumer reading from
+        any position still receives the last change of every row, see
+        :py:meth:`Connection.read_changes`.
+
+        :param int before_seq: only entries with a sequence number less than
+            or equal to this value are removed.
+        :param bool drop_deletes: default False. If ``True`` the deletes up
+            to ``before_seq`` are removed too. Consumers which have not read
+            ``before_seq`` yet must then read the log again from 0.
+        :return: the number of entries removed.
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            with con:
+                cur.execute('DELETE FROM changelog WHERE seq <= ? \
+                             AND EXISTS (SELECT 1 FROM changelog AS newer \
+                                 WHERE newer.table_name = changelog.table_name \
+                                 AND newer.row_id = changelog.row_id \
+                                 AND newer.friend_id IS changelog.friend_id \
+                                 AND newer.seq > changelog.seq)',
+                            (before_seq,))
+                count = cur.rowcount
+                if drop_deletes:
+                    cur.execute("DELETE FROM changelog WHERE seq <= ? \
+                                 AND operation = 'delete'", (before_seq,))
+                    count += cur.rowcount
+                    cur.execute('INSERT INTO changelog_info(changelog_id, \
+                                 purged_seq) VALUES(0, ?) \
+                                 ON CONFLICT(changelog_id) DO UPDATE \
+                                 SET purged_seq = MAX(purged_seq, \
+                                                      excluded.purged_seq)',
+                                (before_seq,))
+            return count
+        finally:
+            con.close()
+
+    #SCHEMA MIGRATIONS
+    @staticmethod
+    def _split_migration(script):
+        '''
+        Split a migration script in statements. A statement preceded by a
+        line ``-- batch`` is a batched statement, see :py:meth:`migrate`.
+
+        :return: a list of tuples ``(batched, statement)``.
+        :raises ValueError: if the script ends with an incomplete statement.
+
+        '''
+        def only_comments(text):
+            text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+            return not [line for line in text.splitlines()
+                        if line.strip() and not line.strip().startswith('--')]
+        statements = []
+        current = ''
+        batched = False
+        for line in script.splitlines(True):
+            if line.strip().lower() == '-- batch' and only_comments(current):
+                batched = True
+                current = ''
+                continue
+            current += line
+            if sqlite3.complete_statement(current):
+                statements.append((batched, current.strip()))
+                current = ''
+                batched = False
+        if not only_comments(current):
+            raise ValueError("Incomplete statement at the end of the script")
+        return statements
+
+    def migrations(self, directory=None):
+        '''
+        List the migration scripts of a directory. The name of a script is
+        ``<version>_<name>.sql``, for instance ``0001_add_tags.sql``.
+
+        :param str directory: default None. If None
+            *db/migrations* is utilized.
+        :return: a list of tuples ``(version, name, path)`` ordered by
+            version.
+        :raises ValueError: if two scripts have the same version.
+
+        '''
+        if directory is None:
+            directory = DEFAULT_MIGRATIONS
+        if not os.path.isdir(directory):
+            return []
+        scripts = {}
+        for filename in os.listdir(directory):
+            match = MIGRATION_FILE.match(filename)
+            if match is None:
+                continue
+            version = int(match.group(1))
+            if version in scripts:
+                raise ValueError("Duplicated migration version %d" % version)
+            scripts[version] = (version, match.group(2),
+                                os.path.join(directory, filename))
+        return [scripts[version] for version in sorted(scripts)]
+
+    def applied_migrations(self):
+        '''
+        :return: a dictionary with the version of each applied migration as
+            key and a tuple ``(name, applied_at, checksum)`` as value.
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            cur.execute('CREATE TABLE IF NOT EXISTS schema_migrations( \
+                             version INTEGER PRIMARY KEY, name TEXT, \
+                             applied_at INTEGER, checksum TEXT)')
+            con.commit()
+            cur.execute('SELECT version, name, applied_at, checksum \
+                         FROM schema_migrations')
+            return dict((row[0], row[1:]) for row in cur.fetchall())
+        finally:
+            con.close()
+
+    def migrate(self, directory=None, target=None, dry_run=False,
+                batch_size=DEFAULT_MIGRATION_BATCH, pause=0,
+                baseline=False):
+        '''
+        Apply in order the migration scripts which have not been applied
+        yet. Each applied migration is recorded in the ``schema_migrations``
+        table. A database created before the migrations existed is upgraded
+        from *0000_baseline_schema.sql*, which adds the tables of the
+        archive, user statistics and thread summaries.
+
+        The consecutive statements of a script are executed in one
+        transaction. A statement preceded by a line ``-- batch`` is a
+        backfill executed repeatedly, each time in its own short
+        transaction, until it changes less than ``batch_size`` rows, so that
+        the writers are not blocked during the whole migration. It must
+        limit the rows it changes with the ``:batch_size`` parameter, for
+        instance::
+
+            -- batch
+            UPDATE messages SET body_length = LENGTH(body)
+            WHERE message_id IN (SELECT message_id FROM messages
+                                 WHERE body_length IS NULL
+                                 LIMIT :batch_size);
+
+        SQLite builds an index in a single statement, so place each
+        ``CREATE INDEX`` between batched statements (or in its own script)
+        to keep it in a transaction of its own. The statements must be
+        idempotent (``IF NOT EXISTS``, backfills which skip the rows already
+        changed), so that an interrupted migration can be run again.
+
+        :param str directory: default None. Directory of the scripts. If
+            None *db/migrations* is utilized.
+        :param int target: default None. Last version applied. If None all
+            the scripts are applied.
+        :param bool dry_run: default False. If ``True``, the scripts are
+            parsed but not executed.
+        :param int batch_size: rows changed by each transaction of a batched
+            statement.
+        :param float pause: seconds slept between the transactions of a
+            batched statement.
+        :param bool baseline: default False. If ``True``, the migrations are
+            recorded as applied without executing them. Used by
+            :py:meth:`create_tables` because the schema file already
+            contains them.
+        :return: a list of tuples ``(version, name)`` with the migrations
+            applied (or which would be applied with ``dry_run``).
+        :raises ValueError: if a script is malformed or an applied script
+            has been modified.
+        :raises sqlite3.Error: if a statement fails. The transaction of the
+            failing statements is rolled back and the migration is not
+            recorded.
+
+        '''
+        applied = self.applied_migrations()
+        pending = []
+        for version, name, path in self.migrations(directory):
+            with open(path) as f:
+                script = f.read()
+            checksum = hashlib.sha1(script).hexdigest()
+            if version in applied:
+                if applied[version][2] != checksum:
+                    raise ValueError("Migration %d_%s has been modified after "
+                                     "being applied" % (version, name))
+                continue
+            if target is not None and version > target:
+                break
+            pending.append((version, name, checksum,
+                            self._split_migration(script)))
+        if dry_run:
+            return [(version, name) for version, name, _, _ in pending]
+        con = sqlite3.connect(self.db_path)
+        #Manage the transactions explicitly, otherwise the sqlite3 module
+        #commits before each DDL statement.
+        con.isolation_level = None
+        cur = con.cursor()
+        done = []
+        try:
+            cur.execute('PRAGMA foreign_keys = ON')
+            for version, name, checksum, statements in pending:
+                if not baseline:
+                    for batched, group in itertools.groupby(
+                            statements, lambda statement: statement[0]):
+                        group = [statement for _, statement in group]
+                        if batched:
+                            for statement in group:
+                                self._run_batched(cur, statement,
+                                                  batch_size, pause)
+                        else:
+                            self._run_transaction(cur, group)
+                self._run_transaction(
+                    cur, ['INSERT INTO schema_migrations(version, name, \
+                               applied_at, checksum) VALUES(?, ?, ?, ?)'],
+                    (version, name, int(time.time()), checksum))
+                done.append((version, name))
+        finally:
+            con.close()
+            #The migrations may change the users
+            if done:
+                self.user_ids.clear()
+        return done
+
+    @staticmethod
+    def _run_transaction(cur, statements, parameters=()):
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                cur.execute(statement, parameters)
+            cur.execute('COMMIT')
+        except sqlite3.Error:
+            cur.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _run_batched(cur, statement, batch_size, pause):
+        while True:
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                cur.execute(statement, {'batch_size': batch_size})
+                changed = cur.rowcount
+                cur.execute('COMMIT')
+            except sqlite3.Error:
+                cur.execute('ROLLBACK')
+                raise
+            if changed < batch_size:
+                return
+            if pause:
+                time.sleep(pause)
+
     #METHODS TO CREATE AND POPULATE A DATABASE USING DIFFERENT SCRIPTS
     def create_tables(self, schema=None):
         '''
@@ -96,6 +1493,7 @@ class Engine(object):
         con = sqlite3.connect(self.db_path)
         if schema is None:
             schema = DEFAULT_SCHEMA
+        baseline = os.path.abspath(schema) == os.path.abspath(DEFAULT_SCHEMA)
         try:
             with open(schema) as f:
                 sql = f.read()
@@ -103,6 +1501,9 @@ class Engine(object):
                 cur.executescript(sql)
         finally:
             con.close()
+        #The default schema already includes the changes of the migrations
+        if baseline:
+            self.migrate(baseline=True)
 
     def populate_tables(self, dump=None):
         '''
@@ -113,6 +1514,8 @@ class Engine(object):
 
         '''
         keys_on = 'PRAGMA foreign_keys = ON'
+        #The dump may reuse nicknames with other ids
+        self.user_ids.clear()
         con = sqlite3.connect(self.db_path)
         #Activate foreing keys support
         cur = con.cursor()
@@ -125,6 +1528,253 @@ class Engine(object):
             cur = con.cursor()
             cur.executescript(sql)
 
+    #BULK LOAD
+    @staticmethod
+    def _read_bulk_file(f, fmt):
+        '''
+        Generator that reads a file in one of the :py:data:`BULK_FORMATS`.
+        The first value produced is the list of columns and the next ones
+        the rows as tuples.
+
+        '''
+        if fmt == 'csv':
+            reader = csv.reader(f)
+            yield next(reader)
+            for row in reader:
+                #CSV has no NULL, empty fields are stored as NULL
+                yield tuple(value.decode('utf-8') if value else None
+                            for value in row)
+        elif fmt == 'jsonl':
+            columns = None
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if columns is None:
+                    columns = list(record.keys())
+                    yield columns
+                yield tuple(record.get(column) for column in columns)
+        else:
+            yield pickle.load(f)
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    return
+                for row in batch:
+                    yield row
+
+    def bulk_load(self, table, path, fmt=None, batch_size=DEFAULT_BULK_BATCH):
+        '''
+        Load the rows of a data file into ``table`` much faster than
+        :py:meth:`populate_tables`. The rows are inserted with
+        ``executemany`` in transactions of ``batch_size`` rows, the indexes of
+        the table are dropped during the load and created again at the end,
+        and the journal is kept in memory without syncing the disk. Finally
+        the table is analyzed so the query planner knows its new size.
+
+        The supported formats are:
+
+        * ``csv``: the first row contains the column names. Empty fields are
+          stored as NULL.
+        * ``jsonl``: one JSON object per line with the column names as keys.
+        * ``binary``: a pickle stream with the list of column names followed
+          by lists of row tuples, as written by :py:meth:`export`. Only load
+          binary files from trusted sources.
+
+        Foreign keys are not checked while loading, so tables should be
+        loaded in dependency order (``users``, ``users_profile``, ``friends``
+        and ``messages``). The triggers that maintain ``user_stats`` and the
+        thread summaries are executed for each row. The nickname->user_id
+        cache is cleared after loading ``users``.
+
+        Each batch is committed on its own. If the load fails, for instance
+        because of a malformed row, the batches committed before the failure
+        are kept in the table: empty the table before loading the file
+        again, or use a ``batch_size`` larger than the file to load it in a
+        single transaction.
+
+        :param str table: name of the table to load.
+        :param str path: path of the data file.
+        :param str fmt: default None. One of ``csv``, ``jsonl`` or
+            ``binary``. If None it is deduced from the file extension.
+        :param int batch_size: default 50000. Rows per transaction.
+        :return: a dictionary with the keys ``table``, ``rows`` (int),
+            ``seconds`` (float), ``rows_per_second`` (float) and
+            ``foreign_key_errors`` (int) with the number of rows which violate
+            a foreign key after the load.
+        :raises ValueError: if the format is unknown or the file contains
+            columns which are not in ``table``.
+
+        '''
+        if fmt is None:
+            fmt = BULK_FORMATS.get(os.path.splitext(path)[1])
+        if fmt not in BULK_FORMATS.values():
+            raise ValueError("Unknown bulk load format %s" % fmt)
+        start = time.time()
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            cur.execute('PRAGMA table_info(%s)' % table)
+            table_columns = set(row[1] for row in cur.fetchall())
+            if not table_columns:
+                raise ValueError("Unknown table %s" % table)
+            #Relax durability while loading. The file is not consistent
+            #until the load finishes anyway.
+            cur.execute('PRAGMA foreign_keys = OFF')
+            cur.execute('PRAGMA synchronous = OFF')
+            cur.execute('PRAGMA journal_mode = MEMORY')
+            #Defer the indexes of the table
+            cur.execute("SELECT name, sql FROM sqlite_master \
+                         WHERE type = 'index' AND tbl_name = ? \
+                         AND sql IS NOT NULL", (table,))
+            indexes = cur.fetchall()
+            for name, sql in indexes:
+                cur.execute('DROP INDEX %s' % name)
+            con.commit()
+            rows = 0
+            try:
+                with open(path, 'rb') as f:
+                    reader = self._read_bulk_file(f, fmt)
+                    columns = list(next(reader))
+                    unknown = set(columns) - table_columns
+                    if unknown:
+                        raise ValueError("Unknown columns %s in %s" %
+                                         (', '.join(sorted(unknown)), path))
+                    stmnt = 'INSERT INTO %s(%s) VALUES(%s)' % (
+                        table, ','.join(columns),
+                        ','.join('?' * len(columns)))
+                    batch = []
+                    for row in reader:
+                        batch.append(row)
+                        if len(batch) >= batch_size:
+                            cur.executemany(stmnt, batch)
+                            con.commit()
+                            rows += len(batch)
+                            batch = []
+                    if batch:
+                        cur.executemany(stmnt, batch)
+                        rows += len(batch)
+                    con.commit()
+            finally:
+                #Rebuild the deferred indexes even if the load failed
+                for name, sql in indexes:
+                    cur.execute(sql)
+                con.commit()
+                #Nicknames looked up before the load may be cached as not
+                #being users
+                if table == 'users':
+                    self.user_ids.clear()
+            cur.execute('ANALYZE %s' % table)
+            cur.execute('PRAGMA foreign_key_check(%s)' % table)
+            foreign_key_errors = len(cur.fetchall())
+            con.commit()
+        finally:
+            con.close()
+        seconds = time.time() - start
+        return {'table': table, 'rows': rows, 'seconds': seconds,
+                'rows_per_second': rows / seconds if seconds > 0 else 0.0,
+                'foreign_key_errors': foreign_key_errors}
+
+    #EXPORT
+    def export(self, source, path, fmt=None, watermark=None, since=None,
+               chunk_size=DEFAULT_EXPORT_CHUNK):
+        '''
+        Write the rows of a table or of a joined view to a data file. The
+        rows are read ``chunk_size`` at a time and written as they arrive, so
+        the memory used does not depend on the size of the table.
+
+        For incremental exports pass the watermark returned by the previous
+        export in ``since``: only rows with a greater ``watermark`` column
+        are written. Note that rows sharing the ``timestamp`` of the previous
+        watermark are not exported again, use ``message_id`` if they must
+        not be lost.
+
+        :param str source: one of the keys of :py:data:`EXPORT_SOURCES`:
+            ``messages``, ``users``, ``users_profile``, ``messages_users``
+            (messages with the sender's registration data) or
+            ``users_profiles`` (users with their profile).
+        :param str path: path of the data file. The file is written under a
+            temporary name and renamed when the export finishes.
+        :param str fmt: default None. One of ``csv``, ``jsonl`` or
+            ``binary`` (see :py:meth:`bulk_load`). If None it is deduced from
+            the file extension.
+        :param str watermark: default None. Column used to order the rows and
+            filter incremental exports. If None the id of the source is used.
+        :param since: default None. Export only rows whose ``watermark`` is
+            greater than this value.
+        :param int chunk_size: default 1000. Rows read at a time.
+        :return: a dictionary with the keys ``source``, ``rows`` (int) and
+            ``watermark``, the value to pass as ``since`` in the next
+            incremental export.
+        :raises ValueError: if the source, format or watermark are unknown.
+
+        '''
+        if source not in EXPORT_SOURCES:
+            raise ValueError("Unknown export source %s" % source)
+        query, default_watermark, watermarks = EXPORT_SOURCES[source]
+        if watermark is None:
+            watermark = default_watermark
+        if watermark not in watermarks:
+            raise ValueError("%s cannot be used as watermark of %s" %
+                             (watermark, source))
+        if fmt is None:
+            fmt = BULK_FORMATS.get(os.path.splitext(path)[1])
+        if fmt not in BULK_FORMATS.values():
+            raise ValueError("Unknown export format %s" % fmt)
+        column = watermarks[watermark]
+        pvalue = ()
+        if since is not None:
+            query += ' WHERE %s > ?' % column
+            pvalue = (since,)
+        query += ' ORDER BY %s' % column
+        rows = 0
+        last = since
+        tmp_path = path + '.tmp'
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            cur.execute(query, pvalue)
+            columns = [description[0] for description in cur.description]
+            position = columns.index(watermark)
+            body = columns.index('body') if 'body' in columns else None
+            with open(tmp_path, 'wb') as f:
+                if fmt == 'csv':
+                    writer = csv.writer(f)
+                    writer.writerow(columns)
+                elif fmt == 'binary':
+                    pickle.dump(columns, f, pickle.HIGHEST_PROTOCOL)
+                while True:
+                    chunk = cur.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    if body is not None:
+                        chunk = [row[:body] + (decode_body(row[body]),) +
+                                 row[body + 1:] for row in chunk]
+                    if fmt == 'csv':
+                        writer.writerows([value.encode('utf-8')
+                                          if isinstance(value, unicode)
+                                          else value for value in row]
+                                         for row in chunk)
+                    elif fmt == 'jsonl':
+                        for row in chunk:
+                            f.write(json.dumps(dict(zip(columns, row))))
+                            f.write('\n')
+                    else:
+                        pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+                    rows += len(chunk)
+                    last = chunk[-1][position]
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            con.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+        return {'source': source, 'rows': rows, 'watermark': last}
+
     #METHODS TO CREATE THE TABLES PROGRAMMATICALLY WITHOUT USING SQL SCRIPT
     def create_messages_table(self):
         '''
@@ -198,66 +1848,467 @@ class Engine(object):
 
         Print an error message in the console if it could not be created.
 
-        :return: ``True`` if the table was successfully created or ``False``
-            otherwise.
+        :return: ``True`` if the table was successfully created or ``False``
+            otherwise.
+
+        '''
+        keys_on = 'PRAGMA foreign_keys = ON'
+
+        '''
+        #TASK3 TODO#
+        Write the SQL Statement and neccesary codeto create users_profile table
+        '''
+        stmnt = 'CREATE TABLE users_profile(user_id INTEGER PRIMARY KEY,\
+                                    firstname TEXT, lastname TEXT, email TEXT,\
+                                    website TEXT, picture TEXT, mobile TEXT,\
+                                    skype TEXT, age INTEGER, residence TEXT,\
+                                    gender TEXT, signature TEXT, avatar TEXT,\
+                                    FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE)'
+        con = sqlite3.connect(self.db_path)
+
+        with con:
+            #Get the cursor object.
+            #It allows to execute SQL code and traverse the result set
+            cur = con.cursor()
+            try:
+                cur.execute(keys_on)
+                #execute the statement
+                cur.execute(stmnt)
+            except sqlite3.Error as excp:
+                print "Error %s:" % excp.args[0]
+                return False
+        return True
+
+    def create_friends_table(self):
+        '''
+        Create the table ``friends`` programmatically, without using .sql file.
+
+        Print an error message in the console if it could not be created.
+
+        :return: ``True`` if the table was successfully created or ``False``
+            otherwise.
+        '''
+        keys_on = 'PRAGMA foreign_keys = ON'
+        stmnt = 'CREATE TABLE friends (user_id INTEGER, friend_id INTEGER, \
+                     PRIMARY KEY(user_id, friend_id), \
+                     FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE, \
+                     FOREIGN KEY(friend_id) REFERENCES users(user_id) ON DELETE CASCADE)'
+        #Connects to the database. Gets a connection object
+        con = sqlite3.connect(self.db_path)
+        with con:
+            #Get the cursor object.
+            #It allows to execute SQL code and traverse the result set
+            cur = con.cursor()
+            try:
+                cur.execute(keys_on)
+                #execute the statement
+                cur.execute(stmnt)
+            except sqlite3.Error as excp:
+                print "Error %s:" % excp.args[0]
+        return None
+
+    def _schema_objects(self, prefixes, schema=None):
+        '''
+        Read from a schema file the statements which create the tables,
+        indexes and triggers whose name starts with one of ``prefixes``, so
+        that the programmatic creation shares its definitions with the
+        schema file.
+
+        :param tuple prefixes: prefixes of the names of the objects.
+        :param schema: path to the .sql schema file. If this parmeter is
+            None, then *db/forum_schema_dump.sql* is utilized.
+        :return: a tuple ``(tables, triggers)`` with the statements which
+            create tables and indexes and the statements which create
+            triggers, in the order of the schema file.
+
+        '''
+        if schema is None:
+            schema = DEFAULT_SCHEMA
+        with open(schema) as f:
+            script = f.read()
+        tables = []
+        triggers = []
+        for _, statement in self._split_migration(script):
+            text = re.sub(r'/\*.*?\*/', '', statement, flags=re.DOTALL)
+            match = re.match(r'\s*CREATE\s+(TABLE|INDEX|TRIGGER)\s+'
+                             r'(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', text,
+                             re.IGNORECASE)
+            if match is None or not match.group(2).startswith(prefixes):
+                continue
+            if match.group(1).upper() == 'TRIGGER':
+                triggers.append(text.strip())
+            else:
+                tables.append(text.strip())
+        return tables, triggers
+
+    def _create_schema_objects(self, prefixes, backfill):
+        '''
+        Create the objects of the schema file selected by ``prefixes``, see
+        :py:meth:`_schema_objects`, and fill them. The tables are filled
+        before the triggers are created and everything is done in one
+        transaction, so writes made meanwhile are not counted twice.
+
+        Print an error message in the console if they could not be created.
+
+        :param tuple prefixes: prefixes of the names of the objects.
+        :param list backfill: statements which fill the new tables.
+        :return: ``True`` if the objects were successfully created or
+            ``False`` otherwise.
+
+        '''
+        keys_on = 'PRAGMA foreign_keys = ON'
+        con = sqlite3.connect(self.db_path)
+        con.isolation_level = None
+        try:
+            #Get the cursor object.
+            #It allows to execute SQL code and traverse the result set
+            cur = con.cursor()
+            cur.execute(keys_on)
+            tables, triggers = self._schema_objects(prefixes)
+            self._run_transaction(cur, tables + backfill + triggers)
+        except sqlite3.Error as excp:
+            print "Error %s:" % excp.args[0]
+            return False
+        finally:
+            con.close()
+        return True
+
+    def create_user_stats_table(self):
+        '''
+        Create the table ``user_stats`` and the triggers that keep it in sync
+        with ``messages``, ``messages_archive`` and ``users``
+        programmatically. The definitions are read from
+        *db/forum_schema_dump.sql*. The table is filled from the messages
+        already in the database.
+
+        Print an error message in the console if it could not be created.
+
+        :return: ``True`` if the table was successfully created or ``False``
+            otherwise.
+
+        '''
+        #The archive tables are created too since the triggers use them
+        prefixes = ('messages_archive', 'archive_info', 'user_stats',
+                    'messages_user_timestamp')
+        backfill = ['INSERT INTO user_stats(user_id, message_count, last_post) \
+                         SELECT user_id, COUNT(*), MAX(timestamp) \
+                         FROM (SELECT user_id, timestamp FROM messages \
+                               UNION ALL \
+                               SELECT user_id, timestamp \
+                               FROM messages_archive) \
+                         WHERE user_id IS NOT NULL \
+                         GROUP BY user_id']
+        return self._create_schema_objects(prefixes, backfill)
+
+    def create_threads_table(self):
+        '''
+        Create the tables ``message_threads``, ``threads`` and
+        ``thread_participants`` and the triggers that keep them in sync with
+        ``messages`` and ``messages_archive`` programmatically. The
+        definitions are read from *db/forum_schema_dump.sql*. The tables
+        are filled from the messages already in the database.
+
+        Print an error message in the console if they could not be created.
+
+        :return: ``True`` if the tables were successfully created or
+            ``False`` otherwise.
+
+        '''
+        #The archive tables are created too since the triggers use them
+        prefixes = ('messages_archive', 'archive_info', 'message_threads',
+                    'threads', 'thread_participants')
+        backfill = ['INSERT INTO message_threads(message_id, root_id, \
+                                                 timestamp) \
+                     WITH RECURSIVE \
+                     every_message(message_id, reply_to, timestamp) AS ( \
+                         SELECT message_id, reply_to, timestamp \
+                         FROM messages \
+                         UNION ALL \
+                         SELECT message_id, reply_to, timestamp \
+                         FROM messages_archive), \
+                     tree(message_id, root_id, timestamp) AS ( \
+                         SELECT message_id, message_id, timestamp \
+                         FROM every_message WHERE reply_to IS NULL \
+                         UNION ALL \
+                         SELECT every_message.message_id, tree.root_id, \
+                                every_message.timestamp \
+                         FROM every_message, tree \
+                         WHERE every_message.reply_to = tree.message_id) \
+                     SELECT * FROM tree',
+                    'INSERT INTO thread_participants(root_id, nickname, \
+                                                     message_count) \
+                     SELECT message_threads.root_id, \
+                            every_message.user_nickname, COUNT(*) \
+                     FROM message_threads, \
+                          (SELECT message_id, user_nickname FROM messages \
+                           UNION ALL \
+                           SELECT message_id, user_nickname \
+                           FROM messages_archive) AS every_message \
+                     WHERE every_message.message_id = \
+                           message_threads.message_id \
+                     AND every_message.user_nickname IS NOT NULL \
+                     GROUP BY message_threads.root_id, \
+                              every_message.user_nickname',
+                    'INSERT INTO threads(root_id, reply_count, \
+                                         participant_count, last_reply, \
+                                         last_activity) \
+                     SELECT root_id, COUNT(*) - 1, \
+                            (SELECT COUNT(*) FROM thread_participants \
+                             WHERE thread_participants.root_id = \
+                                   message_threads.root_id), \
+                            MAX(CASE WHEN message_id != root_id \
+                                     THEN timestamp END), \
+                            MAX(timestamp) \
+                     FROM message_threads GROUP BY root_id']
+        return self._create_schema_objects(prefixes, backfill)
+
+class ReplicaSet(object):
+    '''
+    Read replicas of a database. The replicas are refreshed as a whole with
+    :py:meth:`Engine.backup` snapshots of the primary database and each
+    refresh increments :py:attr:`generation`, so that connections know when
+    to reopen the replica files.
+
+    An instance of this class should not be instantiated directly. Instead
+    use the ``replicas`` parameter of :py:class:`Engine`.
+
+    :param str primary: path of the primary database.
+    :param list paths: paths of the replica files.
+
+    '''
+    def __init__(self, primary, paths):
+        super(ReplicaSet, self).__init__()
+        self.primary = primary
+        self.paths = list(paths)
+        self.generation = 0
+        self._refreshed_at = {}
+        self._durations = {}
+        self._refreshes = dict((path, 0) for path in self.paths)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def choose(self):
+        '''
+        :return: the path of a refreshed replica, in round robin, or None if
+            no replica has been refreshed yet.
+
+        '''
+        with self._lock:
+            ready = [path for path in self.paths if path in self._refreshed_at]
+        if not ready:
+            return None
+        return ready[next(self._next) % len(ready)]
+
+    def refreshed_at(self, path):
+        '''
+        :return: the time when the data of the replica was copied, 0 if it
+            has never been refreshed.
+
+        '''
+        with self._lock:
+            return self._refreshed_at.get(path, 0)
+
+    def refresh(self):
+        '''
+        Copy the primary database to every replica. On Python 2 each copy
+        is taken in one step, see :py:meth:`Engine.backup`.
+
+        '''
+        for path in self.paths:
+            start = time.time()
+            Engine._copy_database(self.primary, path, DEFAULT_BACKUP_PAGES,
+                                  None, 0)
+            with self._lock:
+                self._refreshed_at[path] = start
+                self._durations[path] = time.time() - start
+                self._refreshes[path] += 1
+        with self._lock:
+            self.generation += 1
+
+    def staleness(self):
+        '''
+        See :py:meth:`Engine.replica_staleness`.
+
+        '''
+        now = time.time()
+        with self._lock:
+            return dict((path,
+                         {'age': now - self._refreshed_at[path]
+                                 if path in self._refreshed_at else None,
+                          'refreshes': self._refreshes[path],
+                          'duration': self._durations.get(path)})
+                        for path in self.paths)
+
+    def start(self, interval):
+        '''
+        Refresh the replicas every ``interval`` seconds from a daemon thread.
+
+        '''
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop,
+                                           args=(interval,))
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def stop(self):
+        '''
+        Stop the thread started with :py:meth:`start`.
+
+        '''
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+    def _refresh_loop(self, interval):
+        '''
+        Body of the thread which refreshes the replicas periodically.
+
+        '''
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except (sqlite3.Error, OSError), excp:
+                print "Error %s:" % excp.args[0]
+
+
+class MemoryEngine(Engine):
+    '''
+    Engine which serves the forum from a SQLite database kept in memory, for
+    load tests and ephemeral environments.
+
+    All the connections created with :py:meth:`connect` share the same
+    memory database through a shared-cache URI, so the :py:class:`Connection`
+    API works unchanged. The database exists until :py:meth:`close` is
+    called. The changes can be persisted to a file with :py:meth:`persist`,
+    periodically from a background thread and when the engine is closed.
+
+    :Example:
+
+    >>> engine = MemoryEngine(source='db/forum.db',
+    ...                       persist_path='db/forum.db',
+    ...                       persist_interval=60)
+    >>> con = engine.connect()
+    >>> engine.close()
+
+    :param str source: default None. Path of a database file used to seed
+        the memory database. If None the database is empty and can be
+        seeded with :py:meth:`create_tables` and :py:meth:`populate_tables`.
+    :param str persist_path: default None. File where :py:meth:`persist`
+        writes the memory database.
+    :param float persist_interval: default None. If given, the database is
+        persisted every ``persist_interval`` seconds.
+    :param str name: default None. Name of the shared memory database. If
+        None a name unique to this engine is generated.
+    :param int user_id_cache_size: see :py:class:`Engine`.
+
+    '''
+    _names = itertools.count()
+
+    def __init__(self, source=None, persist_path=None, persist_interval=None,
+                 name=None, user_id_cache_size=DEFAULT_USER_ID_CACHE_SIZE):
+        if name is None:
+            name = 'forum-%d-%d' % (os.getpid(), next(MemoryEngine._names))
+        super(MemoryEngine, self).__init__(
+            'file:%s?mode=memory&cache=shared' % name, user_id_cache_size)
+        self.persist_path = persist_path
+        #The memory database is discarded when its last connection is closed
+        self._keeper = sqlite3.connect(self.db_path)
+        self._stop = threading.Event()
+        self._persister = None
+        if source is not None:
+            self._copy_database(source, self.db_path, DEFAULT_BACKUP_PAGES,
+                                None, 0)
+        if persist_interval is not None:
+            self._persister = threading.Thread(target=self._persist_loop,
+                                               args=(persist_interval,))
+            self._persister.daemon = True
+            self._persister.start()
+
+    def _persist_loop(self, interval):
+        '''
+        Body of the thread which persists the database periodically.
+
+        '''
+        while not self._stop.wait(interval):
+            try:
+                self.persist()
+            except sqlite3.Error, excp:
+                print "Error %s:" % excp.args[0]
+
+    def persist(self, path=None):
+        '''
+        Write the memory database to a file using :py:meth:`backup`.
+
+        :param str path: default None. Destination file. If None
+            ``persist_path`` is used.
+        :return: ``True`` if the database was written and ``False`` if there
+            is no destination.
+
+        '''
+        if path is None:
+            path = self.persist_path
+        if path is None:
+            return False
+        self.backup(path, sleep=0)
+        return True
+
+    def close(self):
+        '''
+        Stop the periodic persistence, persist the database a last time and
+        discard it. Connections obtained from this engine must be closed
+        before.
+
+        '''
+        if self._keeper is None:
+            return
+        self._stop.set()
+        if self._persister is not None:
+            self._persister.join()
+            self._persister = None
+        self.persist()
+        self._keeper.close()
+        self._keeper = None
+
+    def clone_template(self, template_path=None):
+        '''
+        Replace the memory database with a copy of a template created with
+        :py:meth:`create_template`.
 
         '''
-        keys_on = 'PRAGMA foreign_keys = ON'
+        if template_path is None:
+            template_path = self._default_template_path()
+        self.user_ids.clear()
+        self._attach_copy(template_path, self.db_path)
 
+    def remove_database(self):
         '''
-        #TASK3 TODO#
-        Write the SQL Statement and neccesary codeto create users_profile table
+        Remove all the tables of the memory database.
+
         '''
-        stmnt = 'CREATE TABLE users_profile(user_id INTEGER PRIMARY KEY,\
-                                    firstname TEXT, lastname TEXT, email TEXT,\
-                                    website TEXT, picture TEXT, mobile TEXT,\
-                                    skype TEXT, age INTEGER, residence TEXT,\
-                                    gender TEXT, signature TEXT, avatar TEXT,\
-                                    FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE)'
+        self.user_ids.clear()
         con = sqlite3.connect(self.db_path)
-
-        with con:
-            #Get the cursor object.
-            #It allows to execute SQL code and traverse the result set
+        con.isolation_level = None
+        try:
             cur = con.cursor()
-            try:
-                cur.execute(keys_on)
-                #execute the statement
-                cur.execute(stmnt)
-            except sqlite3.Error as excp:
-                print "Error %s:" % excp.args[0]
-                return False
-        return True
+            cur.execute('PRAGMA foreign_keys = OFF')
+            self._drop_schema(cur)
+        finally:
+            con.close()
 
-    def create_friends_table(self):
+    def _default_template_path(self):
         '''
-        Create the table ``friends`` programmatically, without using .sql file.
+        :return: *<persist_path>_template.db* or the template of the default
+            database if there is no ``persist_path``.
 
-        Print an error message in the console if it could not be created.
-
-        :return: ``True`` if the table was successfully created or ``False``
-            otherwise.
         '''
-        keys_on = 'PRAGMA foreign_keys = ON'
-        stmnt = 'CREATE TABLE friends (user_id INTEGER, friend_id INTEGER, \
-                     PRIMARY KEY(user_id, friend_id), \
-                     FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE, \
-                     FOREIGN KEY(friend_id) REFERENCES users(user_id) ON DELETE CASCADE)'
-        #Connects to the database. Gets a connection object
-        con = sqlite3.connect(self.db_path)
-        with con:
-            #Get the cursor object.
-            #It allows to execute SQL code and traverse the result set
-            cur = con.cursor()
-            try:
-                cur.execute(keys_on)
-                #execute the statement
-                cur.execute(stmnt)
-            except sqlite3.Error as excp:
-                print "Error %s:" % excp.args[0]
-        return None
+        root, ext = os.path.splitext(self.persist_path or DEFAULT_DB_PATH)
+        return root + '_template' + (ext or '.db')
 
 
+@instrumented
 class Connection(object):
     '''
     API to access the Forum database.
@@ -274,21 +2325,78 @@ class Connection(object):
 
     :param db_path: Location of the database file.
     :type dbpath: str
+    :param user_ids: nickname->user_id cache shared with other connections.
+        If it is None the connection uses its own cache.
+    :type user_ids: UserIdCache
+    :param replicas: read replicas of the database. If it is not None the
+        read methods query a replica and the rest of methods the primary
+        database in ``db_path``.
+    :type replicas: ReplicaSet
+    :param bool read_your_writes: default False. If ``True``, after this
+        connection modifies the database its reads are sent to the primary
+        until the replicas are refreshed.
+    :param metrics: default None. Registry where the calls to the public
+        methods are recorded. If None, the calls are not recorded.
+    :type metrics: MetricsRegistry
+    :param int body_compression_threshold: default None. Minimum size of
+        the bodies compressed by :py:meth:`create_message` and
+        :py:meth:`modify_message`. If None the bodies are not compressed.
 
     '''
-    def __init__(self, db_path):
+    def __init__(self, db_path, user_ids=None, replicas=None,
+                 read_your_writes=False, metrics=None,
+                 body_compression_threshold=None):
         super(Connection, self).__init__()
         self.con = sqlite3.connect(db_path)
+        self.user_ids = user_ids if user_ids is not None else UserIdCache()
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+        self.metrics = metrics
+        self.body_compression_threshold = body_compression_threshold
+        self._in_call = False
+        self._last_write = 0
+        self._replica_con = None
+        self._replica_path = None
+        self._replica_generation = None
 
     def close(self):
         '''
         Closes the database connection, commiting all changes.
 
         '''
+        if self._replica_con:
+            self._replica_con.close()
+            self._replica_con = None
         if self.con:
             self.con.commit()
             self.con.close()
 
+    def _reader(self):
+        '''
+        :return: the sqlite3 connection used by the read methods: a replica
+            if there are replicas and :py:attr:`self.con` otherwise.
+
+        '''
+        if self.replicas is None:
+            return self.con
+        generation = self.replicas.generation
+        if self._replica_generation != generation:
+            #The replica files have been replaced, reopen them
+            if self._replica_con is not None:
+                self._replica_con.close()
+                self._replica_con = None
+            self._replica_path = self.replicas.choose()
+            if self._replica_path is not None:
+                self._replica_con = sqlite3.connect(self._replica_path)
+            self._replica_generation = generation
+        if self._replica_con is None:
+            #No replica has been refreshed yet
+            return self.con
+        if self.read_your_writes and self._last_write >= \
+           self.replicas.refreshed_at(self._replica_path):
+            return self.con
+        return self._replica_con
+
     #FOREIGN KEY STATUS
     def check_foreign_keys_status(self):
         '''
@@ -361,7 +2469,9 @@ class Connection(object):
         '''
         It takes a :py:class:`sqlite3.Row` and transform it into a dictionary.
 
-        :param row: The row obtained from the database.
+        :param row: The row obtained from the database. If the row has a
+            ``stored_body`` column (see :py:data:`STORED_BODY_JOIN`) it is
+            used when ``body`` is NULL.
         :type row: sqlite3.Row
         :return: a dictionary containing the following keys:
 
@@ -385,7 +2495,12 @@ class Connection(object):
         message_sender = row['user_nickname']
         message_editor = row['editor_nickname']
         message_title = row['title']
+        #Long bodies are read from message_bodies by the queries which
+        #build whole messages. Compressed bodies are only decompressed here.
         message_body = row['body']
+        if message_body is None and 'stored_body' in row.keys():
+            message_body = row['stored_body']
+        message_body = decode_body(message_body)
         message_timestamp = row['timestamp']
         message = {'messageid': message_id, 'title': message_title,
                    'timestamp': message_timestamp, 'replyto': message_replyto,
@@ -412,6 +2527,78 @@ class Connection(object):
                    'timestamp': message_timestamp, 'sender': message_sender}
         return message
 
+    def _create_thread_object(self, row):
+        '''
+        It takes a :py:class:`sqlite3.Row` joining ``threads`` and the root
+        message and transform it into a dictionary.
+
+        :param row: The row obtained from the database.
+        :type row: sqlite3.Row
+        :return: a dictionary containing the following keys:
+
+            * ``messageid``: id of the root message of the thread.
+            * ``title``: title of the root message.
+            * ``sender``: The nickname of the root message's creator.
+            * ``replies``: number of messages in the thread excluding the
+              root message (int).
+            * ``participants``: number of different nicknames that have sent
+              messages to the thread (int).
+            * ``lastreply``: UNIX timestamp of the newest reply or None if the
+              thread has no replies.
+            * ``lastactivity``: UNIX timestamp of the newest message in the
+              thread.
+
+        '''
+        return {'messageid': 'msg-' + str(row['root_id']),
+                'title': row['title'],
+                'sender': row['user_nickname'],
+                'replies': row['reply_count'],
+                'participants': row['participant_count'],
+                'lastreply': row['last_reply'],
+                'lastactivity': row['last_activity']}
+
+    def _create_change_object(self, row):
+        '''
+        It takes a :py:class:`sqlite3.Row` of the ``changelog`` table and
+        transform it into a dictionary.
+
+        :param row: The row obtained from the database.
+        :type row: sqlite3.Row
+        :return: a dictionary containing the following keys:
+
+            * ``seq``: sequence number of the change (int).
+            * ``table``: ``messages``, ``users``, ``users_profile`` or
+              ``friends``.
+            * ``operation``: ``insert``, ``update`` or ``delete``.
+            * ``timestamp``: UNIX timestamp of the change.
+            * ``messageid``: id of the message with format
+              ``msg-\d{1,3}``. Only for ``messages``.
+            * ``userid``: id of the user (int). Only for ``users``,
+              ``users_profile`` and ``friends``.
+            * ``nickname``: nickname of the user. Only for ``users``,
+              ``users_profile`` and ``friends``. It is also given for
+              deletes, so consumers which identify the users by nickname can
+              apply them. It is None for the changes logged before the
+              nicknames were recorded if the user no longer exists.
+            * ``friendid``: id of the friend (int). Only for ``friends``.
+            * ``friendnickname``: nickname of the friend. Only for
+              ``friends``.
+
+        '''
+        change = {'seq': row['seq'],
+                  'table': row['table_name'],
+                  'operation': row['operation'],
+                  'timestamp': row['timestamp']}
+        if row['table_name'] == 'messages':
+            change['messageid'] = 'msg-' + str(row['row_id'])
+        else:
+            change['userid'] = row['row_id']
+            change['nickname'] = row['nickname']
+        if row['table_name'] == 'friends':
+            change['friendid'] = row['friend_id']
+            change['friendnickname'] = row['friend_nickname']
+        return change
+
     #Helpers for users
     def _create_user_object(self, row):
         '''
@@ -482,6 +2669,48 @@ class Connection(object):
         '''
         return {'registrationdate': row['regDate'], 'nickname': row['nickname']}
 
+    #Helpers for the nickname->user_id cache
+    def _resolve_user_id(self, cur, nickname, cache=True):
+        '''
+        Return the user_id of a nickname, querying the ``users`` table only
+        if the nickname is not in :py:attr:`self.user_ids`.
+
+        :param cur: cursor used to query the ``users`` table.
+        :param str nickname: the nickname to resolve.
+        :param bool cache: default True. If ``False`` the result of the
+            query is not stored in the cache. Used when ``cur`` reads a
+            replica, which may be stale, because the writes to the primary
+            use the cache too.
+        :return: the user_id or None if the nickname is not a user.
+
+        '''
+        user_id = self.user_ids.get(nickname)
+        if user_id is not NOT_CACHED:
+            return user_id
+        cur.execute('SELECT user_id FROM users WHERE nickname = ?',
+                    (nickname,))
+        row = cur.fetchone()
+        user_id = row[0] if row is not None else None
+        if cache:
+            self.user_ids.put(nickname, user_id)
+        return user_id
+
+    def _archive_cutoff(self, cur):
+        '''
+        Return the cutoff of the messages archive.
+
+        :param cur: cursor used to query the ``archive_info`` table.
+        :return: the UNIX timestamp of the cutoff or None if no thread has
+            been archived (or the database has no archive tables).
+
+        '''
+        try:
+            cur.execute('SELECT cutoff FROM archive_info')
+        except sqlite3.OperationalError:
+            return None
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+
     #API ITSELF
     #Message Table API.
     def get_message(self, messageid):
@@ -504,16 +2733,22 @@ class Connection(object):
         #Activate foreign key support
         self.set_foreign_keys_support()
         #Create the SQL Query
-        query = 'SELECT * FROM messages WHERE message_id = ?'
+        query = 'SELECT ' + MESSAGE_OBJECT_COLUMNS + \
+                ', message_bodies.body AS stored_body FROM %(table)s' + \
+                STORED_BODY_JOIN + ' WHERE %(table)s.message_id = ?'
         #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
         #Execute main SQL Statement
         pvalue = (messageid,)
-        cur.execute(query, pvalue)
+        cur.execute(query % {'table': 'messages'}, pvalue)
         #Process the response.
         #Just one row is expected
         row = cur.fetchone()
+        if row is None and self._archive_cutoff(cur) is not None:
+            cur.execute(query % {'table': 'messages_archive'}, pvalue)
+            row = cur.fetchone()
         if row is None:
             return None
         #Build the return object
@@ -558,34 +2793,45 @@ class Connection(object):
         '''
         #Create the SQL Statement build the string depending on the existence
         #of nickname, numbero_of_messages, before and after arguments.
-        query = 'SELECT * FROM messages'
+        where = ''
+        pvalue = ()
           #Nickname restriction
         if nickname is not None or before != -1 or after != -1:
-            query += ' WHERE'
+            where += ' WHERE'
         if nickname is not None:
-            query += " user_nickname = '%s'" % nickname
+            where += " user_nickname = ?"
+            pvalue = (nickname,)
           #Before restriction
         if before != -1:
             if nickname is not None:
-                query += ' AND'
-            query += " timestamp < %s" % str(before)
+                where += ' AND'
+            where += " timestamp < %s" % str(before)
           #After restriction
         if after != -1:
             if nickname is not None or before != -1:
-                query += ' AND'
-            query += " timestamp > %s" % str(after)
+                where += ' AND'
+            where += " timestamp > %s" % str(after)
+        #Activate foreign key support
+        self.set_foreign_keys_support()
+        #Cursor and row initialization
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+          #The bodies are not read
+        query = 'SELECT %s FROM messages' % MESSAGE_LIST_COLUMNS + where
+          #The archive only contains messages older than the cutoff
+        cutoff = self._archive_cutoff(cur)
+        if cutoff is not None and (after == -1 or after < cutoff):
+            query += ' UNION ALL SELECT %s FROM messages_archive' % \
+                MESSAGE_LIST_COLUMNS + where
+            pvalue += pvalue
           #Order of results
         query += ' ORDER BY timestamp DESC'
           #Limit the number of resulst return
         if number_of_messages > -1:
             query += ' LIMIT ' + str(number_of_messages)
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
         #Execute main SQL Statement
-        cur.execute(query)
+        cur.execute(query, pvalue)
         #Get results
         rows = cur.fetchall()
         if rows is None:
@@ -639,13 +2885,18 @@ class Connection(object):
         #Execute the statement to delete
         pvalue = (messageid,)
         cur.execute(query, pvalue)
+        if cur.rowcount < 1 and self._archive_cutoff(cur) is not None:
+            cur.execute('DELETE FROM messages_archive WHERE message_id = ?',
+                        pvalue)
         self.con.commit()
+        self._last_write = time.time()
         #Check that it has been deleted
         if cur.rowcount < 1:
             return False
         return True
 
-    def modify_message(self, messageid, title, body, editor="Anonymous"):
+    def modify_message(self, messageid, title, body, editor="Anonymous",
+                       version=None):
         '''
         Modify the title, the body and the editor of the message with id
         ``messageid``
@@ -657,9 +2908,15 @@ class Connection(object):
         :param str editor: default 'Anonymous'. The nickname of the person
             who is editing this message. If it is not provided "Anonymous"
             will be stored in db.
-        :return: the id of the edited message or None if the message was
-              not found. The id of the message has the format ``msg-\d{1,3}``,
-              where \d{1,3} is the id of the message in the database.
+        :param int version: default None. The version of the message read
+            by the editor (see :py:meth:`get_message_if_changed`). If given,
+            the message is modified only if it still has this version, which
+            is checked in the same UPDATE statement.
+        :return: the id of the edited message, None if the message was
+              not found or :py:data:`VERSION_CONFLICT` if the message has
+              been modified after ``version``. The id of the message has the
+              format ``msg-\d{1,3}``, where \d{1,3} is the id of the message
+              in the database.
         :raises ValueError: if the messageid has a wrong format.
 
         '''
@@ -690,23 +2947,38 @@ class Connection(object):
         self.set_foreign_keys_support()
         self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
-        
-        get_message = 'SELECT * from messages WHERE message_id = ?'
-        p_message = (messageid,)
-        cur.execute(get_message, p_message)
-        rowMessage = cur.fetchone()
-        if not rowMessage:
-            return None
 
-        query1 = 'UPDATE messages SET title = ?, body = ?, editor_nickname = ? WHERE message_id = ?'        
+        #The UPDATE itself tells if the message exists, so it is not read
+        #first. The version is compared inside the same statement.
+        query1 = 'UPDATE %(table)s SET title = ?, body = ?, editor_nickname = ? \
+                  WHERE message_id = ? AND (? IS NULL OR \
+                      (SELECT version FROM message_versions \
+                       WHERE message_id = %(table)s.message_id) = ?)'
         if editor=='Anonymous':
             editor = None
-        pvalue = (title, body, editor, messageid)
-        cur.execute(query1, pvalue)
+        body, stored_body = _split_body(
+            encode_body(body, self.body_compression_threshold))
+        pvalue = (title, body, editor, messageid, version, version)
+        cur.execute(query1 % {'table': 'messages'}, pvalue)
+        if cur.rowcount < 1 and self._archive_cutoff(cur) is not None:
+            cur.execute(query1 % {'table': 'messages_archive'}, pvalue)
+        modified = cur.rowcount > 0
+        if modified and stored_body is not None:
+            cur.execute('INSERT OR REPLACE INTO message_bodies(message_id, \
+                         body) VALUES(?, ?)', (messageid, stored_body))
+        elif modified:
+            cur.execute('DELETE FROM message_bodies WHERE message_id = ?',
+                        (messageid,))
+        if not modified and version is not None:
+            cur.execute('SELECT 1 FROM message_versions WHERE message_id = ?',
+                        (messageid,))
+            exists = cur.fetchone() is not None
         self.con.commit()
-        #Check that I have modified the user
-        if cur.rowcount < 1:
-            return None
+        self._last_write = time.time()
+        #Check that I have modified the message
+        if not modified:
+            return VERSION_CONFLICT if version is not None and exists \
+                else None
         return 'msg-' + str(messageid)
 
     def create_message(self, title, body, sender="Anonymous",
@@ -729,7 +3001,9 @@ class Connection(object):
             not found. Note that it is a string with the format msg-\d{1,3}.
 
         :raises ForumDatabaseError: if the database could not be modified.
-        :raises ValueError: if the replyto has a wrong format.
+        :raises ValueError: if the replyto has a wrong format or the message
+            it refers to has been archived with
+            :py:meth:`Engine.archive_messages`.
 
         '''
         #Extracts the int which is the id for a message in the database
@@ -780,13 +3054,20 @@ class Connection(object):
         cur = self.con.cursor()
         
         if replyto:
-            get_replyTo_query = 'SELECT * from messages WHERE message_id = ?'
+            get_replyTo_query = 'SELECT message_id from messages WHERE message_id = ?'
             p_reply_to = (replyto,)
             cur.execute(get_replyTo_query, p_reply_to)
             row = cur.fetchone()
             if row:
                 replyto = row['message_id']
             else:
+                #Archived threads are read only for new answers
+                if self._archive_cutoff(cur) is not None:
+                    cur.execute('SELECT message_id FROM messages_archive \
+                                 WHERE message_id = ?', p_reply_to)
+                    if cur.fetchone() is not None:
+                        raise ValueError("The message msg-%d is archived" %
+                                         replyto)
                 return None
         else:
             replyto = None
@@ -794,23 +3075,24 @@ class Connection(object):
         timesviewed = 0
         timestamp = time.mktime(datetime.now().timetuple())
         user_nickname = sender
-        get_user_query = 'SELECT user_id FROM users WHERE nickname=?'
-        puser_nickname = (user_nickname,)
-        cur.execute(get_user_query, puser_nickname)
-        rowUser = cur.fetchone()       
-        
-        if rowUser:
-            user_id = rowUser["user_id"]
-        else:
-            user_id = None
-            
+        #Usually served from the nickname cache without touching users.
+        user_id = self._resolve_user_id(cur, user_nickname)
+
+        #Long bodies are stored in message_bodies
+        body, stored_body = _split_body(
+            encode_body(body, self.body_compression_threshold))
         pvalue = (title,body,timestamp,ipaddress,timesviewed, replyto, user_nickname, user_id)
         cur.execute(query1, pvalue)
+        message_id = cur.lastrowid
+        if cur.rowcount > 0 and stored_body is not None:
+            cur.execute('INSERT OR REPLACE INTO message_bodies(message_id, \
+                         body) VALUES(?, ?)', (message_id, stored_body))
         self.con.commit()
+        self._last_write = time.time()
         #Check that I have modified the user
         if cur.rowcount < 1:
             return None
-        return 'msg-' + str(cur.lastrowid)
+        return 'msg-' + str(message_id)
 
     def append_answer(self, replyto, title, body, sender="Anonymous",
                       ipaddress="0.0.0.0"):
@@ -833,11 +3115,216 @@ class Connection(object):
             not found. Note that it is a string with the format msg-\d{1,3}.
 
         :raises ForumDatabaseError: if the database could not be modified.
-        :raises ValueError: if the replyto has a wrong format.
+        :raises ValueError: if the replyto has a wrong format or the message
+            it refers to has been archived.
 
         '''
         return self.create_message(title, body, sender, ipaddress, replyto)
 
+    def get_threads(self, limit=20, cursor=None):
+        '''
+        Return the threads of the forum, that is the messages which are not a
+        reply to another message, ordered by the time of the newest message in
+        the thread (most recent first). The summaries are read from the
+        ``threads`` table, which is kept up to date by triggers, and are
+        paginated using the ``(last_activity, root_id)`` index.
+
+        :param int limit: default 20. Maximum number of threads returned.
+        :param str cursor: default None. Value returned by a previous call to
+            continue the listing after its last thread. If None the listing
+            starts from the most recent thread.
+        :return: a tuple ``(threads, next_cursor)``. ``threads`` is a list
+            of dictionaries with the format provided in
+            :py:meth:`_create_thread_object` and ``next_cursor`` is the cursor
+            to obtain the next page or None if there are no more threads.
+        :raises ValueError: if ``cursor`` is malformed.
+
+        '''
+        #Activate foreign key support
+        self.set_foreign_keys_support()
+        #Cursor and row initialization
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        query = 'SELECT threads.*, messages.title, messages.user_nickname \
+                 FROM threads, messages \
+                 WHERE messages.message_id = threads.root_id'
+        #The root of an archived thread is in messages_archive
+        if self._archive_cutoff(cur) is not None:
+            query = 'SELECT threads.*, \
+                         IFNULL(messages.title, archived.title) AS title, \
+                         IFNULL(messages.user_nickname, \
+                                archived.user_nickname) AS user_nickname \
+                     FROM threads \
+                     LEFT JOIN messages \
+                         ON messages.message_id = threads.root_id \
+                     LEFT JOIN messages_archive AS archived \
+                         ON archived.message_id = threads.root_id \
+                     WHERE (messages.message_id IS NOT NULL \
+                            OR archived.message_id IS NOT NULL)'
+        pvalue = ()
+        if cursor is not None:
+            match = re.match(r'^(-?\d+(?:\.\d+)?):(\d+)$', cursor)
+            if match is None:
+                raise ValueError("The cursor is malformed")
+            query += ' AND (threads.last_activity, threads.root_id) < (?, ?)'
+            pvalue = (float(match.group(1)), int(match.group(2)))
+        query += ' ORDER BY threads.last_activity DESC, threads.root_id DESC \
+                   LIMIT ?'
+        pvalue += (limit,)
+        #Execute main SQL Statement
+        cur.execute(query, pvalue)
+        rows = cur.fetchall()
+        threads = [self._create_thread_object(row) for row in rows]
+        next_cursor = None
+        if len(rows) == limit and limit > 0:
+            last = rows[-1]
+            next_cursor = '%r:%d' % (last['last_activity'], last['root_id'])
+        return threads, next_cursor
+
+    def get_thread(self, messageid):
+        '''
+        Extracts all the messages of the thread which contains a message:
+        the root message and all the replies to it or to its replies.
+
+        :param str messageid: id of any message of the thread. Note that
+            messageid is a string with format ``msg-\d{1,3}``.
+        :return: a list of dictionaries with the format provided in
+            :py:meth:`_create_message_object` ordered by timestamp, or None
+            if the message does not exist.
+        :raises ValueError: when ``messageid`` is not well formed
+
+        '''
+        #Extracts the int which is the id for a message in the database
+        match = re.match(r'msg-(\d{1,3})', messageid)
+        if match is None:
+            raise ValueError("The messageid is malformed")
+        messageid = int(match.group(1))
+        #The root of every message is kept by triggers in message_threads
+        query = 'SELECT ' + MESSAGE_OBJECT_COLUMNS + \
+                ', message_bodies.body AS stored_body \
+                 FROM message_threads, %(table)s' + STORED_BODY_JOIN + \
+                ' WHERE message_threads.root_id = \
+                     (SELECT root_id FROM message_threads \
+                      WHERE message_id = ?) \
+                 AND %(table)s.message_id = message_threads.message_id \
+                 ORDER BY %(table)s.timestamp, %(table)s.message_id'
+        #Activate foreign key support
+        self.set_foreign_keys_support()
+        #Cursor and row initialization
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        #Execute main SQL Statement
+        pvalue = (messageid,)
+        cur.execute(query % {'table': 'messages'}, pvalue)
+        rows = cur.fetchall()
+        #Threads are archived as a whole
+        if not rows and self._archive_cutoff(cur) is not None:
+            cur.execute(query % {'table': 'messages_archive'}, pvalue)
+            rows = cur.fetchall()
+        if not rows:
+            return None
+        return [self._create_message_object(row) for row in rows]
+
+    #CONDITIONAL READS
+    def get_message_if_changed(self, messageid, version=None):
+        '''
+        Extracts a message only if it has changed. The version of a message
+        is increased each time the message is modified, so it can be used
+        as an ETag.
+
+        :param str messageid: The id of the message. Note that messageid is
+            a string with format ``msg-\d{1,3}``.
+        :param int version: default None. The version of the message known
+            by the caller. If None, the message is always returned.
+        :return: :py:data:`NOT_MODIFIED` if the message has still the given
+            version, None if the message does not exist, or otherwise a
+            dictionary with the format provided in
+            :py:meth:`_create_message_object` and the extra key
+            ``version`` (int).
+        :raises ValueError: when ``messageid`` is not well formed
+
+        '''
+        match = re.match(r'msg-(\d{1,3})', messageid)
+        if match is None:
+            raise ValueError("The messageid is malformed")
+        messageid = int(match.group(1))
+        self.set_foreign_keys_support()
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        pvalue = (messageid,)
+        #The body is not read if the message has not changed
+        cur.execute('SELECT version FROM message_versions \
+                     WHERE message_id = ?', pvalue)
+        row = cur.fetchone()
+        if row is None:
+            return None
+        if version is not None and row['version'] == version:
+            return NOT_MODIFIED
+        query = 'SELECT ' + MESSAGE_OBJECT_COLUMNS + \
+                ', message_versions.version, \
+                        message_bodies.body AS stored_body \
+                 FROM %(table)s JOIN message_versions \
+                     ON message_versions.message_id = %(table)s.message_id' + \
+                STORED_BODY_JOIN + ' WHERE %(table)s.message_id = ?'
+        cur.execute(query % {'table': 'messages'}, pvalue)
+        row = cur.fetchone()
+        if row is None and self._archive_cutoff(cur) is not None:
+            cur.execute(query % {'table': 'messages_archive'}, pvalue)
+            row = cur.fetchone()
+        if row is None:
+            return None
+        message = self._create_message_object(row)
+        message['version'] = row['version']
+        return message
+
+    def get_changed_messages(self, since, messageids=None):
+        '''
+        Find the messages which have changed after a version.
+
+        :param int since: a version returned by
+            :py:meth:`get_message_if_changed` or by this method.
+        :param list messageids: default None. Ids of the messages to check,
+            with format ``msg-\d{1,3}``. If None, all the messages are
+            checked, but the deleted messages cannot be reported.
+        :return: a dictionary with the id of each changed message as key and
+            its current version as value. The messages of ``messageids``
+            which have been deleted have the value None.
+        :raises ValueError: when an id is not well formed
+
+        '''
+        ids = []
+        for messageid in messageids or []:
+            match = re.match(r'msg-(\d{1,3})', messageid)
+            if match is None:
+                raise ValueError("The messageid is malformed")
+            ids.append(int(match.group(1)))
+        self.set_foreign_keys_support()
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        if messageids is None:
+            cur.execute('SELECT message_id, version FROM message_versions \
+                         WHERE version > ? ORDER BY version', (since,))
+            return dict(('msg-' + str(row['message_id']), row['version'])
+                        for row in cur.fetchall())
+        versions = {}
+        for i in range(0, len(ids), MAX_IDS_PER_STATEMENT):
+            chunk = ids[i:i + MAX_IDS_PER_STATEMENT]
+            cur.execute('SELECT message_id, version FROM message_versions \
+                         WHERE message_id IN (%s)' % ','.join('?' * len(chunk)),
+                        chunk)
+            versions.update((row['message_id'], row['version'])
+                            for row in cur.fetchall())
+        changed = {}
+        for messageid in ids:
+            version = versions.get(messageid)
+            if version is None or version > since:
+                changed['msg-' + str(messageid)] = version
+        return changed
+
     #MESSAGE UTILS
     def get_sender(self, messageid):
         '''
@@ -919,14 +3406,16 @@ class Connection(object):
 
         '''
         #Create the SQL Statements
-          #SQL Statement for retrieving the users
-        query = 'SELECT users.*, users_profile.* FROM users, users_profile \
-                 WHERE users.user_id = users_profile.user_id'
+          #SQL Statement for retrieving the users. It is answered by a
+          #covering index of users. The profiles are not joined: append_user
+          #creates the profile with the user and it is deleted in cascade.
+        query = 'SELECT nickname, regDate FROM users'
         #Activate foreign key support
         self.set_foreign_keys_support()
         #Create the cursor
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
         #Execute main SQL Statement
         cur.execute(query)
         #Process the results
@@ -939,6 +3428,94 @@ class Connection(object):
             users.append(self._create_user_list_object(row))
         return users
 
+    def get_users_page(self, limit=20, cursor=None, order='nickname',
+                       prefix=None):
+        '''
+        Return a page of the users of the database, for instance to
+        autocomplete a nickname. The users are paginated by the value of the
+        ordering key (keyset pagination), so every page is read from the
+        covering index of that key, whatever its position in the listing.
+
+        :param int limit: default 20. Maximum number of users returned.
+        :param str cursor: default None. Value returned by a previous call,
+            with the same ``order``, to continue the listing after its last
+            user. If None the listing starts from the first user.
+        :param str order: default ``nickname``. ``nickname`` sorts the users
+            by nickname, case insensitive. ``registrationdate`` sorts them
+            by registration date, most recent first.
+        :param str prefix: default None. If given, only the users whose
+            nickname starts with ``prefix`` are returned, case insensitive
+            for ASCII letters. A byte string is decoded as UTF-8.
+        :return: a tuple ``(users, next_cursor)``. ``users`` is a list of
+            dictionaries with the format provided in
+            :py:meth:`_create_user_list_object` and ``next_cursor`` is the
+            cursor to obtain the next page or None if there are no more
+            users.
+        :raises ValueError: if ``order`` is unknown or ``cursor`` is
+            malformed.
+
+        '''
+        if order not in ('nickname', 'registrationdate'):
+            raise ValueError("Unknown order %s" % order)
+        query = 'SELECT nickname, regDate FROM users WHERE 1'
+        pvalue = ()
+        if prefix:
+            if isinstance(prefix, str):
+                prefix = prefix.decode('utf-8')
+            #Range of the nicknames which start with the prefix in the NOCASE
+            #collation, which only folds ASCII letters.
+            lower = re.sub(u'[A-Z]', lambda match: match.group(0).lower(),
+                           prefix)
+            query += ' AND nickname >= ? COLLATE NOCASE'
+            pvalue += (lower,)
+            #The uppercase letters compare as lowercase, so the character
+            #after '@' in the collation is '['
+            last = ord(lower[-1]) + 1
+            if ord('A') <= last <= ord('Z'):
+                last = ord('Z') + 1
+            if last <= sys.maxunicode:
+                query += ' AND nickname < ? COLLATE NOCASE'
+                pvalue += (lower[:-1] + unichr(last),)
+            #Exact check, also when the range has no upper bound. LIKE
+            #folds the same letters as NOCASE.
+            query += " AND nickname LIKE ? ESCAPE '\\'"
+            pvalue += (re.sub(r'([\\%_])', r'\\\1', prefix) + '%',)
+        if order == 'nickname':
+            #Nicknames are unique but may only differ in case
+            if cursor is not None:
+                query += ' AND nickname >= ? COLLATE NOCASE \
+                           AND (nickname COLLATE NOCASE, nickname) > (?, ?)'
+                pvalue += (cursor, cursor, cursor)
+            query += ' ORDER BY nickname COLLATE NOCASE, nickname'
+        else:
+            if cursor is not None:
+                match = re.match(r'^(-?\d+):(.*)$', cursor, re.DOTALL)
+                if match is None:
+                    raise ValueError("The cursor is malformed")
+                query += ' AND (regDate, nickname) < (?, ?)'
+                pvalue += (int(match.group(1)), match.group(2))
+            query += ' ORDER BY regDate DESC, nickname DESC'
+        query += ' LIMIT ?'
+        pvalue += (limit,)
+        #Activate foreign key support
+        self.set_foreign_keys_support()
+        #Cursor and row initialization
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        #Execute main SQL Statement
+        cur.execute(query, pvalue)
+        rows = cur.fetchall()
+        users = [self._create_user_list_object(row) for row in rows]
+        next_cursor = None
+        if len(rows) == limit and limit > 0:
+            last = rows[-1]
+            if order == 'nickname':
+                next_cursor = last['nickname']
+            else:
+                next_cursor = '%d:%s' % (last['regDate'], last['nickname'])
+        return users, next_cursor
+
     def get_user(self, nickname):
         '''
         Extracts all the information of a user.
@@ -949,34 +3526,42 @@ class Connection(object):
 
         '''
         #Create the SQL Statements
-          #SQL Statement for retrieving the user given a nickname
-        query1 = 'SELECT user_id from users WHERE nickname = ?'
-          #SQL Statement for retrieving the user information
-        query2 = 'SELECT users.*, users_profile.* FROM users, users_profile \
-                  WHERE users.user_id = ? \
-                  AND users_profile.user_id = users.user_id'
-          #Variable to be used in the second query.
-        user_id = None
+          #SQL Statement for retrieving the user information. The user is
+          #searched by the cached user_id if it is known and by nickname,
+          #using the UNIQUE(nickname) index, otherwise. The nickname is
+          #checked too, because the cached user_id may have been reused.
+        query = 'SELECT ' + USER_OBJECT_COLUMNS + \
+                ' FROM users, users_profile \
+                 WHERE users.user_id = COALESCE(?, \
+                     (SELECT user_id FROM users WHERE nickname = ?)) \
+                 AND users.nickname = ? \
+                 AND users_profile.user_id = users.user_id'
+        user_id = self.user_ids.get(nickname)
+        if user_id is NOT_CACHED:
+            user_id = None
         #Activate foreign key support
         self.set_foreign_keys_support()
         #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        #Execute SQL Statement to retrieve the id given a nickname
-        pvalue = (nickname,)
-        cur.execute(query1, pvalue)
-        #Extract the user id
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        #Execute the SQL Statement to retrieve the user information.
+        pvalue = (user_id, nickname, nickname)
+        cur.execute(query, pvalue)
+        #Process the response. Only one posible row is expected.
         row = cur.fetchone()
+        if row is None and user_id is not None:
+            #The user was deleted, maybe by another Engine, and its user_id
+            #given to another user. Search it again by nickname.
+            self.user_ids.invalidate(nickname)
+            cur.execute(query, (None, nickname, nickname))
+            row = cur.fetchone()
         if row is None:
+            self.user_ids.invalidate(nickname)
             return None
-        user_id = row["user_id"]
-        # Execute the SQL Statement to retrieve the user invformation.
-        # Create first the valuse
-        pvalue = (user_id, )
-        #execute the statement
-        cur.execute(query2, pvalue)
-        #Process the response. Only one posible row is expected.
-        row = cur.fetchone()
+        #A stale replica could return a deleted user
+        if con is self.con:
+            self.user_ids.put(nickname, row['user_id'])
         return self._create_user_object(row)
 
     def delete_user(self, nickname):
@@ -1001,12 +3586,14 @@ class Connection(object):
         pvalue = (nickname,)
         cur.execute(query, pvalue)
         self.con.commit()
+        self._last_write = time.time()
+        self.user_ids.invalidate(nickname)
         #Check that it has been deleted
         if cur.rowcount < 1:
             return False
         return True
 
-    def modify_user(self, nickname, user):
+    def modify_user(self, nickname, user, version=None):
         '''
         Modify the information of a user.
 
@@ -1044,23 +3631,38 @@ class Connection(object):
 
             Note that all values are string if they are not otherwise indicated.
 
-        :return: the nickname of the modified user or None if the
-            ``nickname`` passed as parameter is not  in the database.
+        :param int version: default None. The version of the user read by
+            the caller (see :py:meth:`get_user_if_changed`). If given, the
+            user is modified only if it still has this version, which is
+            checked in the same UPDATE statement.
+        :return: the nickname of the modified user, None if the
+            ``nickname`` passed as parameter is not  in the database or
+            :py:data:`VERSION_CONFLICT` if the user has been modified after
+            ``version``.
         :raise ValueError: if the user argument is not well formed.
 
         '''
-                #Create the SQL Statements
-           #SQL Statement for extracting the userid given a nickname
-        query1 = 'SELECT user_id from users WHERE nickname = ?'
-          #SQL Statement to update the user_profile table
-        query2 = 'UPDATE users_profile SET firstname = ?,lastname = ?, \
-                                           email = ?,website = ?, \
-                                           picture = ?,mobile = ?, \
-                                           skype = ?,age = ?,residence = ?, \
-                                           gender = ?,signature = ?,avatar = ?\
-                                           WHERE user_id = ?'
+        #Create the SQL Statements
+          #SQL Statement to update the user_profile table. If the user_id is
+          #not cached it is resolved from the nickname inside the same
+          #statement. The nickname is checked too, because the cached
+          #user_id may have been reused.
+        query = 'UPDATE users_profile SET firstname = ?,lastname = ?, \
+                                          email = ?,website = ?, \
+                                          picture = ?,mobile = ?, \
+                                          skype = ?,age = ?,residence = ?, \
+                                          gender = ?,signature = ?,avatar = ?\
+                 WHERE user_id = COALESCE(?, (SELECT user_id FROM users \
+                                              WHERE nickname = ?)) \
+                 AND EXISTS (SELECT 1 FROM users \
+                             WHERE users.user_id = users_profile.user_id \
+                             AND users.nickname = ?) \
+                 AND (? IS NULL OR (SELECT version FROM profile_versions \
+                      WHERE user_id = users_profile.user_id) = ?)'
+        user_id = self.user_ids.get(nickname)
+        if user_id is NOT_CACHED:
+            user_id = None
         #temporal variables
-        user_id = None
         p_profile = user['public_profile']
         r_profile = user['restricted_profile']
         _firstname = r_profile.get('firstname', None)
@@ -1080,26 +3682,30 @@ class Connection(object):
         #Cursor and row initialization
         self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (nickname,)
-        cur.execute(query1, pvalue)
-        #Only one value expected
-        row = cur.fetchone()
-        #if does not exist, return
-        if row is None:
-            return None
-        else:
-            user_id = row["user_id"]
-            #execute the main statement
-            pvalue = (_firstname, _lastname, _email, _website, _picture,
-                      _mobile, _skype, _age, _residence, _gender,
-                      _signature, _avatar, user_id)
-            cur.execute(query2, pvalue)
-            self.con.commit()
-            #Check that I have modified the user
-            if cur.rowcount < 1:
-                return None
-            return nickname
+        #execute the main statement
+        pvalue = (_firstname, _lastname, _email, _website, _picture,
+                  _mobile, _skype, _age, _residence, _gender,
+                  _signature, _avatar, user_id, nickname, nickname, version,
+                  version)
+        cur.execute(query, pvalue)
+        modified = cur.rowcount > 0
+        if not modified and user_id is not None:
+            #The user was deleted, maybe by another Engine, and its user_id
+            #given to another user. Search it again by nickname.
+            self.user_ids.invalidate(nickname)
+            cur.execute(query, pvalue[:12] + (None,) + pvalue[13:])
+            modified = cur.rowcount > 0
+        if not modified and version is not None:
+            cur.execute('SELECT 1 FROM users WHERE nickname = ?', (nickname,))
+            exists = cur.fetchone() is not None
+        self.con.commit()
+        self._last_write = time.time()
+        #Check that I have modified the user. If the nickname does not exist
+        #the subquery returns NULL and no row is updated.
+        if not modified:
+            return VERSION_CONFLICT if version is not None and exists \
+                else None
+        return nickname
 
     def append_user(self, nickname, user):
         '''
@@ -1145,13 +3751,14 @@ class Connection(object):
 
         '''
         #Create the SQL Statements
-          #SQL Statement for extracting the userid given a nickname
-        query1 = 'SELECT user_id from users WHERE nickname = ?'
-          #SQL Statement to create the row in  users table
-        query2 = 'INSERT INTO users(nickname,regDate,lastLogin,timesviewed)\
-                  VALUES(?,?,?,?)'
+          #SQL Statement to create the row in users table. If the nickname
+          #already exists nothing is inserted and no user_id is returned.
+        query1 = 'INSERT INTO users(nickname,regDate,lastLogin,timesviewed)\
+                  VALUES(?,?,?,?) \
+                  ON CONFLICT(nickname) DO NOTHING \
+                  RETURNING user_id'
           #SQL Statement to create the row in user_profile table
-        query3 = 'INSERT INTO users_profile (user_id, firstname,lastname, \
+        query2 = 'INSERT INTO users_profile (user_id, firstname,lastname, \
                                              email,website, \
                                              picture,mobile, \
                                              skype,age,residence, \
@@ -1181,30 +3788,26 @@ class Connection(object):
         #Cursor and row initialization
         self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
-        #Execute the statement to extract the id associated to a nickname
-        pvalue = (nickname,)
+        #Add the row in users table
+        pvalue = (nickname, timestamp, timestamp, timesviewed)
         cur.execute(query1, pvalue)
-        #No value expected (no other user with that nickname expected)
+        #Extract the returned user_id. No row means that there is already
+        #another user with that nickname.
         row = cur.fetchone()
-        #If there is no user add rows in user and user profile
         if row is None:
-            #Add the row in users table
-            # Execute the statement
-            pvalue = (nickname, timestamp, timestamp, timesviewed)
-            cur.execute(query2, pvalue)
-            #Extrat the rowid => user-id
-            lid = cur.lastrowid
-            #Add the row in users_profile table
-            # Execute the statement
-            pvalue = (lid, _firstname, _lastname, _email, _website,
-                      _picture, _mobile, _skype, _age, _residence, _gender,
-                      _signature, _avatar)
-            cur.execute(query3, pvalue)
             self.con.commit()
-            #We do not do any comprobation and return the nickname
-            return nickname
-        else:
             return None
+        lid = row["user_id"]
+        #Add the row in users_profile table
+        pvalue = (lid, _firstname, _lastname, _email, _website,
+                  _picture, _mobile, _skype, _age, _residence, _gender,
+                  _signature, _avatar)
+        cur.execute(query2, pvalue)
+        self.con.commit()
+        self._last_write = time.time()
+        self.user_ids.put(nickname, lid)
+        #We do not do any comprobation and return the nickname
+        return nickname
 
     # UTILS
     def get_friends(self, nickname):
@@ -1245,25 +3848,125 @@ class Connection(object):
                 * test_get_user_id_unknown_user
         '''
         
-        query = 'SELECT user_id from users WHERE nickname = ?'
-        
         self.set_foreign_keys_support()
-        
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-        
-        pvalue = (nickname,)
-        cur.execute(query, pvalue)
-        
-        row = cur.fetchone()
-        if row is None:
-            return None
-        user_id = row["user_id"]
 
-        return user_id
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+
+        return self._resolve_user_id(cur, nickname, con is self.con)
 
     def contains_user(self, nickname):
         '''
         :return: True if the user is in the database. False otherwise
         '''
-        return self.get_user_id(nickname) is not None
\ No newline at end of file
+        return self.get_user_id(nickname) is not None
+
+    def get_user_if_changed(self, nickname, version=None):
+        '''
+        Extracts the information of a user only if it has changed. The
+        version of a user is increased each time the user or its profile is
+        modified, so it can be used as an ETag.
+
+        :param str nickname: The nickname of the user to search for.
+        :param int version: default None. The version of the user known by
+            the caller. If None, the user is always returned.
+        :return: :py:data:`NOT_MODIFIED` if the user has still the given
+            version, None if the user does not exist, or otherwise a
+            dictionary with the format provided in
+            :py:meth:`_create_user_object` and the extra key ``version``
+            (int).
+
+        '''
+        self.set_foreign_keys_support()
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        cur.execute('SELECT profile_versions.version \
+                     FROM users, profile_versions \
+                     WHERE users.nickname = ? \
+                     AND profile_versions.user_id = users.user_id',
+                    (nickname,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        if version is not None and row['version'] == version:
+            return NOT_MODIFIED
+        #The version is read first: if the user is modified meanwhile the
+        #caller gets the new data with the old version and reads it again.
+        user = self.get_user(nickname)
+        if user is None:
+            return None
+        user['version'] = row['version']
+        return user
+
+    #CHANGE FEED
+    def read_changes(self, since_seq=0, limit=100):
+        '''
+        Read the changes of messages, users, profiles and friends in the
+        order they were made. A consumer keeps the ``seq`` of the last change
+        it has processed and passes it in the next call, so each call costs
+        the number of new changes and not the size of the tables.
+
+        Moving threads to the archive is not reported. After
+        :py:meth:`Engine.compact_changelog` only the newest change of each
+        row is kept, so inserts and updates must be applied as upserts.
+
+        :param int since_seq: default 0. Return the changes with a greater
+            sequence number. With 0 all the changes in the log are returned.
+        :param int limit: default 100. Maximum number of changes returned.
+        :return: a list of changes with the format provided in
+            :py:meth:`_create_change_object`, ordered by ``seq``, or None if
+            changes after ``since_seq`` have been purged from the log. In that
+            case the consumer must read again from 0.
+
+        '''
+        self.set_foreign_keys_support()
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        cur.execute('SELECT purged_seq FROM changelog_info')
+        row = cur.fetchone()
+        if row is not None and since_seq < row['purged_seq']:
+            return None
+        cur.execute('SELECT * FROM changelog WHERE seq > ? \
+                     ORDER BY seq LIMIT ?', (since_seq, limit))
+        return [self._create_change_object(row) for row in cur.fetchall()]
+
+    #USER STATISTICS
+    def get_user_stats(self, nickname):
+        '''
+        Get the number of messages sent by a user and the time of the last
+        one. The values are read from the ``user_stats`` table, which is kept
+        up to date by triggers, so the cost does not depend on the number of
+        messages of the user.
+
+        :param str nickname: The nickname of the user.
+        :return: a dictionary with the keys ``nickname``, ``messages`` (int)
+            and ``lastpost`` (UNIX timestamp or None if the user has not sent
+            any message) or None if ``nickname`` is not in the database.
+
+        '''
+        query = 'SELECT users.nickname, \
+                        IFNULL(user_stats.message_count, 0) AS message_count, \
+                        user_stats.last_post \
+                 FROM users LEFT JOIN user_stats \
+                      ON user_stats.user_id = users.user_id \
+                 WHERE users.user_id = ?'
+        #Activate foreign key support
+        self.set_foreign_keys_support()
+        #Cursor and row initialization
+        con = self._reader()
+        con.row_factory = sqlite3.Row
+        cur = con.cursor()
+        user_id = self._resolve_user_id(cur, nickname, con is self.con)
+        if user_id is None:
+            return None
+        cur.execute(query, (user_id,))
+        row = cur.fetchone()
+        if row is None:
+            self.user_ids.invalidate(nickname)
+            return None
+        return {'nickname': row['nickname'],
+                'messages': row['message_count'],
+                'lastpost': row['last_post']}
@@ -0,0 +1,351 @@
+'''
+Created on 19.10.2026
+
+Query plan regression checker for the database API.
+
+It runs a workload which calls the methods of :py:class:`Connection` on a
+copy of a populated database, records every SQL statement they issue and
+passes each one through ``EXPLAIN QUERY PLAN``. ``EXPLAIN QUERY PLAN`` does
+not describe the statements run by triggers, so the statements of every
+trigger of the schema are explained too, with their ``new`` and ``old``
+columns bound as parameters. Full scans of the ``messages`` or ``users``
+tables are flagged. The report is a JSON document with a stable order, so
+the reports of two releases can be diffed.
+
+Usage::
+
+    python -m forum.queryplan [db_path] [-o report.json]
+
+The exit status is 1 if there are unexpected scans or statements which
+cannot be explained.
+'''
+
+import sqlite3, re, os, sys, json, shutil, tempfile, argparse
+
+from forum.database import Engine, DEFAULT_DB_PATH
+
+#Tables which must not be scanned
+CHECKED_TABLES = ('messages', 'users')
+SCAN_PATTERN = re.compile(r'\bSCAN (?:TABLE )?(%s)\b' %
+                          '|'.join(CHECKED_TABLES))
+#Statements sent to EXPLAIN QUERY PLAN
+EXPLAINED_STATEMENTS = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b',
+                                  re.IGNORECASE)
+#References to the row of a trigger, replaced by parameters
+TRIGGER_ROW = re.compile(r'\b(new|old)\.(\w+)\b', re.IGNORECASE)
+#Prefix of the operation of the statements of a trigger
+TRIGGER_OPERATION = 'trigger:'
+
+#Operations which list a whole table, so a scan is their expected plan.
+#They scan a covering index (get_messages_limit stops after the limit).
+EXPECTED_SCANS = {'get_messages': ('messages',),
+                  'get_messages_limit': ('messages',),
+                  'get_users': ('users',),
+                  'get_users_page': ('users',),
+                  'get_users_page_registration': ('users',)}
+
+#User added and removed by the workload
+WORKLOAD_USER = {'public_profile': {'signature': 'Query plans',
+                                    'avatar': 'plan.jpg'},
+                 'restricted_profile': {'firstname': 'Query',
+                                        'lastname': 'Planner',
+                                        'email': 'planner@forum.org',
+                                        'age': 30, 'website': None,
+                                        'residence': 'Oulu',
+                                        'gender': 'Female',
+                                        'picture': None, 'mobile': None,
+                                        'skype': None}}
+
+#Operations run by check(). Each one is a tuple (name, function) and the
+#function receives a Connection. The ids and nicknames belong to
+#db/forum_data_dump.sql.
+WORKLOAD = [
+    ('get_message', lambda con: con.get_message('msg-1')),
+    ('get_messages', lambda con: con.get_messages()),
+    ('get_messages_by_nickname',
+     lambda con: con.get_messages('HockeyFan')),
+    ('get_messages_limit', lambda con: con.get_messages(
+        number_of_messages=5)),
+    ('get_messages_before', lambda con: con.get_messages(
+        before=1362017482, number_of_messages=5)),
+    ('get_messages_after', lambda con: con.get_messages(
+        after=1362017480, number_of_messages=5)),
+    ('get_thread', lambda con: con.get_thread('msg-10')),
+    ('get_threads', lambda con: con.get_threads(5)),
+    ('get_threads_cursor', lambda con: con.get_threads(5, '1362017481:9')),
+    ('contains_message', lambda con: con.contains_message('msg-2')),
+    ('get_users', lambda con: con.get_users()),
+    ('get_users_page', lambda con: con.get_users_page(2)),
+    ('get_users_page_cursor', lambda con: con.get_users_page(2, 'HockeyFan')),
+    ('get_users_page_prefix', lambda con: con.get_users_page(
+        2, prefix='hock')),
+    ('get_users_page_registration', lambda con: con.get_users_page(
+        2, order='registrationdate')),
+    ('get_users_page_registration_cursor', lambda con: con.get_users_page(
+        2, '1389260086:Koodari', 'registrationdate')),
+    ('get_user', lambda con: con.get_user('AxelW')),
+    ('get_user_id', lambda con: con.get_user_id('Mystery')),
+    ('contains_user', lambda con: con.contains_user('Jack')),
+    ('get_user_stats', lambda con: con.get_user_stats('AxelW')),
+    ('append_user', lambda con: con.append_user('Planner', WORKLOAD_USER)),
+    ('modify_user', lambda con: con.modify_user('Planner', WORKLOAD_USER)),
+    ('create_message', lambda con: con.create_message('Plan', 'Body',
+                                                      'Planner')),
+    ('append_answer', lambda con: con.append_answer('msg-1', 'Re', 'Body',
+                                                    'Planner')),
+    ('modify_message', lambda con: con.modify_message('msg-2', 'Plan',
+                                                      'Body', 'Planner')),
+    ('delete_message', lambda con: con.delete_message('msg-4')),
+    ('delete_user', lambda con: con.delete_user('Planner')),
+]
+
+
+class _RecordingCursor(object):
+    '''
+    Cursor which appends the statements it executes to a log.
+
+    '''
+    def __init__(self, cursor, log):
+        self._cursor = cursor
+        self._log = log
+
+    def execute(self, sql, parameters=()):
+        self._log.append((sql, parameters))
+        return self._cursor.execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        if seq_of_parameters:
+            self._log.append((sql, seq_of_parameters[0]))
+        return self._cursor.executemany(sql, seq_of_parameters)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _RecordingConnection(object):
+    '''
+    Wrapper of a sqlite3 connection whose cursors log their statements.
+
+    '''
+    def __init__(self, con, log):
+        object.__setattr__(self, '_con', con)
+        object.__setattr__(self, '_log', log)
+
+    def cursor(self):
+        return _RecordingCursor(self._con.cursor(), self._log)
+
+    def execute(self, sql, parameters=()):
+        self._log.append((sql, parameters))
+        return self._con.execute(sql, parameters)
+
+    def __enter__(self):
+        return self._con.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._con.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def __setattr__(self, name, value):
+        #For instance row_factory
+        setattr(self._con, name, value)
+
+
+def _normalize(sql):
+    return ' '.join(sql.split())
+
+
+def explain(con, sql, parameters=()):
+    '''
+    Run a statement through EXPLAIN QUERY PLAN.
+
+    :param con: sqlite3 connection.
+    :param str sql: the statement.
+    :param parameters: the parameters of the statement.
+    :return: a tuple ``(plan, scans)``. ``plan`` is the list of details of
+        the plan and ``scans`` the sorted list of checked tables scanned.
+
+    '''
+    cur = con.cursor()
+    cur.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+    plan = [row[3] for row in cur.fetchall()]
+    scans = sorted(set(match.group(1) for detail in plan
+                       for match in SCAN_PATTERN.finditer(detail)))
+    return plan, scans
+
+
+def trigger_statements(con):
+    '''
+    Extract the statements of the triggers of a database.
+
+    :param con: sqlite3 connection.
+    :return: a list of tuples ``(trigger, sql, parameters)`` ordered by
+        trigger. The ``WHEN`` condition of a trigger is returned as a
+        ``SELECT`` statement. The ``new`` and ``old`` columns are replaced by
+        named parameters bound to NULL.
+
+    '''
+    cur = con.cursor()
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' \
+                 ORDER BY name")
+    statements = []
+    for name, sql in cur.fetchall():
+        sql = TRIGGER_ROW.sub(lambda match: ':%s_%s' % (
+            match.group(1).lower(), match.group(2)), sql)
+        begin = re.search(r'\bBEGIN\b', sql, re.IGNORECASE).start()
+        body = sql[begin + len('BEGIN'):sql.rindex('END')]
+        when = re.search(r'\bWHEN\b(.*)', sql[:begin],
+                         re.IGNORECASE | re.DOTALL)
+        trigger = []
+        if when is not None:
+            trigger.append('SELECT ' + when.group(1).strip())
+        current = ''
+        for part in body.split(';'):
+            current += part + ';'
+            if sqlite3.complete_statement(current):
+                if current.strip(' \t\n;'):
+                    trigger.append(current.strip().rstrip(';'))
+                current = ''
+        for statement in trigger:
+            parameters = dict(('%s_%s' % (match.group(1).lower(),
+                                          match.group(2)), None)
+                              for match in re.finditer(r':(new|old)_(\w+)',
+                                                       statement))
+            statements.append((name, statement, parameters))
+    return statements
+
+
+def _explain_statement(statements, explainer, operation, sql, parameters):
+    '''
+    Explain a statement once per operation and store its entry in
+    ``statements``. A statement which cannot be explained is stored with
+    its error.
+
+    '''
+    key = (operation, _normalize(sql))
+    if key in statements:
+        return
+    try:
+        plan, scans = explain(explainer, sql, parameters)
+        error = None
+    except sqlite3.Error, e:
+        plan, scans = [], []
+        error = '%s: %s' % (type(e).__name__, e)
+    expected = set(scans) <= set(EXPECTED_SCANS.get(operation, ()))
+    statements[key] = {'operation': operation, 'sql': key[1], 'plan': plan,
+                       'scans': scans, 'expected': expected,
+                       'error': error}
+
+
+def check(db_path=None, workload=None):
+    '''
+    Run the workload on a copy of a database and explain every statement.
+
+    :param str db_path: default None. Path of a populated database. If None
+        *db/forum.db* is used. The database is not modified.
+    :param list workload: default :py:data:`WORKLOAD`.
+    :return: the report, a dictionary with the keys:
+
+        * ``sqlite_version``: version of the SQLite library.
+        * ``statements``: list of dictionaries with the keys ``operation``,
+          ``sql`` (whitespace normalized), ``plan`` (list of str), ``scans``
+          (checked tables scanned), ``expected`` (True if the scans are
+          in :py:data:`EXPECTED_SCANS`) and ``error`` (message of the
+          exception raised by ``EXPLAIN QUERY PLAN`` or None), ordered by
+          operation and sql. The operation of the statements of a trigger
+          is ``trigger:<name>``.
+        * ``errors``: dictionary with the operations which raised an
+          exception and the message of the exception.
+        * ``unexpected_scans``: number of statements with scans which are
+          not expected.
+        * ``failed_statements``: number of statements which could not be
+          explained.
+
+    '''
+    if db_path is None:
+        db_path = DEFAULT_DB_PATH
+    if workload is None:
+        workload = WORKLOAD
+    directory = tempfile.mkdtemp()
+    copy_path = os.path.join(directory, 'forum.db')
+    try:
+        Engine(db_path, auto_migrate=False).backup(copy_path)
+        #The copy of a database created by an older version is upgraded,
+        #the workload needs the current schema
+        engine = Engine(copy_path)
+        engine.migrate()
+        connection = engine.connect()
+        explainer = sqlite3.connect(copy_path)
+        statements = {}
+        errors = {}
+        try:
+            for name, sql, parameters in trigger_statements(explainer):
+                _explain_statement(statements, explainer,
+                                   TRIGGER_OPERATION + name, sql, parameters)
+            for operation, function in workload:
+                log = []
+                connection.con = _RecordingConnection(connection.con, log)
+                try:
+                    function(connection)
+                except (NotImplementedError, sqlite3.Error, ValueError), e:
+                    errors[operation] = '%s: %s' % (type(e).__name__, e)
+                finally:
+                    connection.con = connection.con._con
+                for sql, parameters in log:
+                    if EXPLAINED_STATEMENTS.match(sql):
+                        _explain_statement(statements, explainer, operation,
+                                           sql, parameters)
+        finally:
+            explainer.close()
+            connection.close()
+    finally:
+        shutil.rmtree(directory)
+    statements = [statements[key] for key in sorted(statements)]
+    return {'sqlite_version': sqlite3.sqlite_version,
+            'statements': statements,
+            'errors': errors,
+            'unexpected_scans': len([s for s in statements
+                                     if not s['expected']]),
+            'failed_statements': len([s for s in statements
+                                      if s['error'] is not None])}
+
+
+def main(argv=None):
+    '''
+    Command line entry point. Print the report or write it in a file.
+
+    :return: 1 if there are unexpected scans or statements which cannot be
+        explained, 0 otherwise.
+
+    '''
+    parser = argparse.ArgumentParser(
+        description='Explain the queries of the forum database API.')
+    parser.add_argument('db_path', nargs='?', default=DEFAULT_DB_PATH)
+    parser.add_argument('-o', '--output', help='path of the JSON report')
+    args = parser.parse_args(argv)
+    report = check(args.db_path)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+    for statement in report['statements']:
+        if not statement['expected']:
+            sys.stderr.write('SCAN %s in %s: %s\n' % (
+                ', '.join(statement['scans']), statement['operation'],
+                statement['sql']))
+        if statement['error'] is not None:
+            sys.stderr.write('ERROR %s in %s: %s\n' % (
+                statement['error'], statement['operation'],
+                statement['sql']))
+    return 1 if report['unexpected_scans'] or report['failed_statements'] \
+        else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1034 @@
+'''
+Created on 19.10.2026
+
+Provides a sharded version of the database API to access the forum
+persistent data.
+
+The messages are partitioned across several sqlite files (shards), either by
+thread or by timestamp range. Users, profiles and friends stay in the main
+database file, which also keeps the routing table that tells in which shard
+each message is stored. Sharding is opt-in: use :py:class:`ShardedEngine`
+instead of :py:class:`forum.database.Engine`.
+'''
+
+from datetime import datetime
+import time, sqlite3, re, os
+
+from forum.database import Engine, Connection, DEFAULT_USER_ID_CACHE_SIZE, \
+     MAX_IDS_PER_STATEMENT, WHOLE_MESSAGE_COLUMNS, STORED_BODY_JOIN, \
+     NOT_MODIFIED, VERSION_CONFLICT, DEFAULT_BACKUP_PAGES, \
+     DEFAULT_BACKUP_SLEEP, instrumented, encode_body
+
+#Strategies to assign messages to shards.
+#All the messages of a thread are stored in the shard of its root message.
+THREAD_STRATEGY = 'thread'
+#Each shard stores the messages from its start timestamp to the start of the
+#next shard.
+TIME_STRATEGY = 'time'
+
+#Adds a new route to the summary of its thread in route_threads.
+_ROUTE_THREAD_UPSERT = 'INSERT INTO route_threads(root_id, reply_count, \
+                            last_reply, last_activity) \
+                        VALUES(new.root_id, new.message_id != new.root_id, \
+                               CASE WHEN new.message_id != new.root_id \
+                                    THEN new.timestamp END, \
+                               new.timestamp) \
+                        ON CONFLICT(root_id) DO UPDATE SET \
+                            reply_count = reply_count + excluded.reply_count, \
+                            last_reply = IFNULL(MAX(last_reply, \
+                                                    excluded.last_reply), \
+                                                IFNULL(last_reply, \
+                                                       excluded.last_reply)), \
+                            last_activity = MAX(last_activity, \
+                                                excluded.last_activity);'
+
+#Tables added to the main database to route the messages.
+CATALOG_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS shards(shard_id INTEGER PRIMARY KEY, \
+         path TEXT UNIQUE, start INTEGER)',
+    'CREATE TABLE IF NOT EXISTS message_routes( \
+         message_id INTEGER PRIMARY KEY, shard_id INTEGER, \
+         root_id INTEGER, reply_to INTEGER, timestamp INTEGER)',
+    'CREATE INDEX IF NOT EXISTS message_routes_reply_to \
+         ON message_routes(reply_to)',
+    'CREATE INDEX IF NOT EXISTS message_routes_root \
+         ON message_routes(root_id)',
+    #The versions and the changelog of the messages are kept in the main
+    #database. A route is inserted and deleted with its message, and
+    #ShardedConnection.modify_message records the modifications.
+    "CREATE TRIGGER IF NOT EXISTS message_routes_insert \
+         AFTER INSERT ON message_routes \
+     BEGIN \
+         INSERT INTO version_sequence(version) VALUES(NULL); \
+         INSERT OR REPLACE INTO message_versions(message_id, version) \
+         VALUES(new.message_id, last_insert_rowid()); \
+         DELETE FROM version_sequence; \
+         INSERT INTO changelog(table_name, operation, row_id, timestamp) \
+         VALUES('messages', 'insert', new.message_id, \
+                strftime('%s', 'now')); \
+     END",
+    "CREATE TRIGGER IF NOT EXISTS message_routes_delete \
+         AFTER DELETE ON message_routes \
+     BEGIN \
+         DELETE FROM message_versions WHERE message_id = old.message_id; \
+         INSERT INTO changelog(table_name, operation, row_id, timestamp) \
+         VALUES('messages', 'delete', old.message_id, \
+                strftime('%s', 'now')); \
+     END",
+    #Thread summaries of the routes, see ShardedConnection.get_threads
+    'CREATE TABLE IF NOT EXISTS route_threads(root_id INTEGER PRIMARY KEY, \
+         reply_count INTEGER NOT NULL DEFAULT 0, last_reply INTEGER, \
+         last_activity INTEGER)',
+    'CREATE INDEX IF NOT EXISTS route_threads_last_activity \
+         ON route_threads(last_activity, root_id)',
+    #A route gets its root_id when it is inserted (distribute_messages) or
+    #just after (ShardedConnection.create_message)
+    'CREATE TRIGGER IF NOT EXISTS message_routes_thread_insert \
+         AFTER INSERT ON message_routes WHEN new.root_id IS NOT NULL \
+     BEGIN %s END' % _ROUTE_THREAD_UPSERT,
+    'CREATE TRIGGER IF NOT EXISTS message_routes_thread_root \
+         AFTER UPDATE OF root_id ON message_routes \
+         WHEN old.root_id IS NULL AND new.root_id IS NOT NULL \
+     BEGIN %s END' % _ROUTE_THREAD_UPSERT,
+    'CREATE TRIGGER IF NOT EXISTS message_routes_thread_delete \
+         AFTER DELETE ON message_routes WHEN old.root_id IS NOT NULL \
+     BEGIN \
+         DELETE FROM route_threads WHERE root_id = old.message_id; \
+         UPDATE route_threads SET \
+             reply_count = reply_count - 1, \
+             last_reply = (SELECT MAX(timestamp) FROM message_routes \
+                           WHERE root_id = old.root_id \
+                           AND message_id != old.root_id), \
+             last_activity = (SELECT MAX(timestamp) FROM message_routes \
+                              WHERE root_id = old.root_id) \
+         WHERE root_id = old.root_id AND old.message_id != old.root_id; \
+     END']
+
+#Schema of every shard. The messages have no foreign keys because the users
+#and, with the time strategy, the parent messages are in other files.
+SHARD_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS messages(message_id INTEGER PRIMARY KEY, \
+         title TEXT, body TEXT, timestamp INTEGER, ip TEXT, \
+         timesviewed INTEGER, reply_to INTEGER, user_nickname TEXT, \
+         user_id INTEGER, editor_nickname TEXT)',
+    'CREATE INDEX IF NOT EXISTS messages_listing_timestamp \
+         ON messages(timestamp, user_nickname, title)',
+    'CREATE INDEX IF NOT EXISTS messages_user_timestamp \
+         ON messages(user_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS messages_listing_nickname \
+         ON messages(user_nickname, timestamp, title)']
+
+MESSAGE_COLUMNS = ('message_id', 'title', 'body', 'timestamp', 'ip',
+                   'timesviewed', 'reply_to', 'user_nickname', 'user_id',
+                   'editor_nickname')
+
+
+def _chunks(ids):
+    '''
+    Split a list of ids in lists of at most :py:data:`MAX_IDS_PER_STATEMENT`.
+
+    '''
+    for i in range(0, len(ids), MAX_IDS_PER_STATEMENT):
+        yield ids[i:i + MAX_IDS_PER_STATEMENT]
+
+
+def _placeholders(ids):
+    return ','.join('?' * len(ids))
+
+
+class ShardedEngine(Engine):
+    '''
+    Abstraction of a forum database whose messages are partitioned across
+    several shard files.
+
+    The main database file (``db_path``) has the usual schema plus the
+    ``shards`` and ``message_routes`` tables. :py:meth:`create_tables`
+    creates them and the initial shards, and :py:meth:`populate_tables`
+    distributes the messages of the dump among the shards. The connections
+    are :py:class:`ShardedConnection` instances.
+
+    :Example:
+
+    >>> engine = ShardedEngine('db/forum.db',
+    ...                        ['db/forum_1.db', 'db/forum_2.db'])
+    >>> engine.create_tables()
+    >>> con = engine.connect()
+
+    :param db_path: The path of the main database file. If not specified,
+        the Engine will use the file located at *db/forum.db*
+    :param list shards: paths of the shards created by
+        :py:meth:`create_tables`. With the time strategy each item is a
+        tuple ``(path, start)`` where ``start`` is the first UNIX timestamp
+        stored in the shard.
+    :param str strategy: default ``thread``. :py:data:`THREAD_STRATEGY` or
+        :py:data:`TIME_STRATEGY`.
+    :param int user_id_cache_size: see :py:class:`forum.database.Engine`.
+    :param int body_compression_threshold: see
+        :py:class:`forum.database.Engine`.
+    :raises ValueError: if the strategy is unknown.
+
+    '''
+    #The shard registry survives Engine.clear(fast=True)
+    _kept_tables = Engine._kept_tables + ('shards',)
+
+    def __init__(self, db_path=None, shards=None, strategy=THREAD_STRATEGY,
+                 user_id_cache_size=DEFAULT_USER_ID_CACHE_SIZE,
+                 body_compression_threshold=None):
+        super(ShardedEngine, self).__init__(
+            db_path, user_id_cache_size,
+            body_compression_threshold=body_compression_threshold)
+        if strategy not in (THREAD_STRATEGY, TIME_STRATEGY):
+            raise ValueError("Unknown sharding strategy %s" % strategy)
+        self.strategy = strategy
+        self.initial_shards = [shard if isinstance(shard, tuple)
+                               else (shard, None) for shard in shards or []]
+
+    def connect(self, read_your_writes=False):
+        '''
+        Creates a connection to the sharded database.
+
+        :return: A ShardedConnection instance
+        :rtype: ShardedConnection
+
+        '''
+        return ShardedConnection(self)
+
+    def get_shards(self):
+        '''
+        :return: a list of tuples ``(shard_id, path, start)``, ordered by
+            ``start`` with the time strategy and by ``shard_id`` otherwise.
+
+        '''
+        query = 'SELECT shard_id, path, start FROM shards \
+                 ORDER BY start, shard_id'
+        if self.strategy == THREAD_STRATEGY:
+            query = 'SELECT shard_id, path, start FROM shards \
+                     ORDER BY shard_id'
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            cur.execute(query)
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    def target_shard(self, shards, root_id, timestamp):
+        '''
+        Select the shard where a message must be stored.
+
+        :param list shards: the result of :py:meth:`get_shards`.
+        :param int root_id: id of the root message of the thread.
+        :param timestamp: UNIX timestamp of the message.
+        :return: the shard_id.
+
+        '''
+        if self.strategy == THREAD_STRATEGY:
+            return shards[root_id % len(shards)][0]
+        #Messages older than the first shard are stored in the first one
+        target = shards[0][0]
+        for shard_id, path, start in shards:
+            if start <= timestamp:
+                target = shard_id
+        return target
+
+    #METHODS TO CREATE AND POPULATE THE SHARDS
+    def create_tables(self, schema=None):
+        '''
+        Create the tables of the main database from a schema file, the
+        routing tables and the shards given in the constructor.
+
+        :param schema: path to the .sql schema file. If this parmeter is
+            None, then *db/forum_schema_dump.sql* is utilized.
+
+        '''
+        super(ShardedEngine, self).create_tables(schema)
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                cur = con.cursor()
+                for stmnt in CATALOG_SCHEMA:
+                    cur.execute(stmnt)
+        finally:
+            con.close()
+        for path, start in self.initial_shards:
+            self.attach_shard(path, start)
+
+    def attach_shard(self, path, start=None):
+        '''
+        Create a new shard and register it in the main database. This is an
+        offline operation: existing messages are not moved to the new shard
+        until :py:meth:`rebalance` is called.
+
+        :param str path: path of the new shard file.
+        :param start: default None. With the time strategy, the first UNIX
+            timestamp stored in the shard.
+        :return: the shard_id of the new shard.
+        :raises ValueError: if ``start`` is missing with the time strategy.
+
+        '''
+        if self.strategy == TIME_STRATEGY and start is None:
+            raise ValueError("A time shard needs the start of its range")
+        shard = sqlite3.connect(path)
+        try:
+            with shard:
+                cur = shard.cursor()
+                for stmnt in SHARD_SCHEMA:
+                    cur.execute(stmnt)
+        finally:
+            shard.close()
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute('INSERT OR IGNORE INTO shards(path, start) \
+                             VALUES(?, ?)', (path, start))
+                cur.execute('SELECT shard_id FROM shards WHERE path = ?',
+                            (path,))
+                return cur.fetchone()[0]
+        finally:
+            con.close()
+
+    def populate_tables(self, dump=None):
+        '''
+        Populate the tables from a dump file and move the messages to the
+        shards.
+
+        :param dump:  path to the .sql dump file. If this parmeter is
+            None, then *db/forum_data_dump.sql* is utilized.
+
+        '''
+        super(ShardedEngine, self).populate_tables(dump)
+        self.distribute_messages()
+
+    def distribute_messages(self):
+        '''
+        Move the messages stored in the ``messages`` table of the main
+        database to the shards. It can be used to shard an existing forum
+        database after calling :py:meth:`create_tables`.
+
+        :return: the number of messages moved.
+
+        '''
+        #Find the root of every message
+        query = 'WITH RECURSIVE tree(message_id, root_id) AS ( \
+                     SELECT message_id, message_id FROM messages \
+                     WHERE reply_to IS NULL \
+                     UNION ALL \
+                     SELECT messages.message_id, tree.root_id \
+                     FROM messages, tree \
+                     WHERE messages.reply_to = tree.message_id) \
+                 SELECT %s, tree.root_id FROM tree, messages' % \
+                     WHOLE_MESSAGE_COLUMNS + \
+                 STORED_BODY_JOIN % {'table': 'messages'} + \
+                ' WHERE tree.message_id = messages.message_id \
+                 ORDER BY messages.message_id'
+        shards = self.get_shards()
+        con = sqlite3.connect(self.db_path)
+        con.row_factory = sqlite3.Row
+        try:
+            cur = con.cursor()
+            cur.execute('PRAGMA foreign_keys = ON')
+            cur.execute(query)
+            rows = cur.fetchall()
+            if not rows:
+                return 0
+            routes = []
+            by_shard = {}
+            for row in rows:
+                shard_id = self.target_shard(shards, row['root_id'],
+                                             row['timestamp'])
+                routes.append((row['message_id'], shard_id, row['root_id'],
+                               row['reply_to'], row['timestamp']))
+                by_shard.setdefault(shard_id, []).append(
+                    tuple(row[column] for column in MESSAGE_COLUMNS))
+            paths = dict((shard_id, path) for shard_id, path, _ in shards)
+            stmnt = 'INSERT INTO messages(%s) VALUES(%s)' % (
+                ','.join(MESSAGE_COLUMNS), _placeholders(MESSAGE_COLUMNS))
+            for shard_id, messages in by_shard.items():
+                shard = sqlite3.connect(paths[shard_id])
+                try:
+                    with shard:
+                        shard.executemany(stmnt, messages)
+                finally:
+                    shard.close()
+            #Delete first: the delete triggers of messages remove the
+            #versions which the routes give to the messages again
+            cur.execute('DELETE FROM messages')
+            cur.executemany('INSERT INTO message_routes(message_id, \
+                                 shard_id, root_id, reply_to, timestamp) \
+                             VALUES(?, ?, ?, ?, ?)', routes)
+            con.commit()
+            return len(routes)
+        finally:
+            con.close()
+
+    def rebalance(self):
+        '''
+        Move the messages which are not in the shard selected by
+        :py:meth:`target_shard`, for instance after attaching a new shard.
+        This is an offline operation: no connection should be using the
+        database meanwhile.
+
+        :return: the number of messages moved.
+
+        '''
+        shards = self.get_shards()
+        paths = dict((shard_id, path) for shard_id, path, _ in shards)
+        con = sqlite3.connect(self.db_path)
+        try:
+            cur = con.cursor()
+            cur.execute('SELECT message_id, shard_id, root_id, timestamp \
+                         FROM message_routes')
+            moves = {}
+            for message_id, shard_id, root_id, timestamp in cur.fetchall():
+                target = self.target_shard(shards, root_id, timestamp)
+                if target != shard_id:
+                    moves.setdefault((shard_id, target), []).append(message_id)
+            stmnt = 'INSERT INTO messages(%s) VALUES(%s)' % (
+                ','.join(MESSAGE_COLUMNS), _placeholders(MESSAGE_COLUMNS))
+            moved = 0
+            for (source_id, target_id), ids in moves.items():
+                source = sqlite3.connect(paths[source_id])
+                target = sqlite3.connect(paths[target_id])
+                try:
+                    for chunk in _chunks(ids):
+                        scur = source.cursor()
+                        scur.execute('SELECT %s FROM messages \
+                                      WHERE message_id IN (%s)' %
+                                     (','.join(MESSAGE_COLUMNS),
+                                      _placeholders(chunk)), chunk)
+                        target.executemany(stmnt, scur.fetchall())
+                        target.commit()
+                        cur.execute('UPDATE message_routes SET shard_id = ? \
+                                     WHERE message_id IN (%s)' %
+                                    _placeholders(chunk), [target_id] + chunk)
+                        con.commit()
+                        scur.execute('DELETE FROM messages \
+                                      WHERE message_id IN (%s)' %
+                                     _placeholders(chunk), chunk)
+                        source.commit()
+                        moved += len(chunk)
+                finally:
+                    source.close()
+                    target.close()
+            return moved
+        finally:
+            con.close()
+
+    #BACKUPS
+    @staticmethod
+    def shard_snapshot_path(path, shard_id):
+        '''
+        :param str path: path of the snapshot of the main database.
+        :param int shard_id: id of a shard.
+        :return: the path of the snapshot of the shard taken with
+            :py:meth:`backup`, the path of the main snapshot with the suffix
+            *.shard<shard_id>*.
+
+        '''
+        return '%s.shard%d' % (path, shard_id)
+
+    def backup(self, dest_path, pages_per_step=DEFAULT_BACKUP_PAGES,
+               progress=None, sleep=DEFAULT_BACKUP_SLEEP):
+        '''
+        Create a snapshot of the main database in ``dest_path`` and of each
+        shard in :py:meth:`shard_snapshot_path`. See
+        :py:meth:`forum.database.Engine.backup`.
+
+        Every write of a shard is done while the main database is locked,
+        so the main database stays locked during the backup to keep the
+        snapshots consistent with each other: the forum can be read, but
+        the writers wait until the backup finishes.
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        con.isolation_level = None
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                super(ShardedEngine, self).backup(dest_path, pages_per_step,
+                                                  progress, sleep)
+                for shard_id, path, start in self.get_shards():
+                    self._copy_database(
+                        path, self.shard_snapshot_path(dest_path, shard_id),
+                        pages_per_step, progress, sleep)
+            finally:
+                con.execute('ROLLBACK')
+        finally:
+            con.close()
+
+    def restore(self, src_path, pages_per_step=DEFAULT_BACKUP_PAGES,
+                progress=None, sleep=DEFAULT_BACKUP_SLEEP):
+        '''
+        Replace the content of the main database and of the shards with the
+        snapshots created with :py:meth:`backup`. The shards are restored to
+        the paths registered in the snapshot of the main database. All the
+        snapshots are verified first. See
+        :py:meth:`forum.database.Engine.restore`.
+
+        :return: ``True`` if the database was restored and ``False`` if a
+            snapshot is missing or not valid.
+
+        '''
+        if not self.verify_backup(src_path):
+            return False
+        con = sqlite3.connect(src_path)
+        try:
+            cur = con.cursor()
+            cur.execute('SELECT shard_id, path FROM shards')
+            shards = [(self.shard_snapshot_path(src_path, shard_id), path)
+                      for shard_id, path in cur.fetchall()]
+        finally:
+            con.close()
+        for snapshot, path in shards:
+            if not self.verify_backup(snapshot):
+                return False
+        for snapshot, path in shards:
+            self._restore_database(snapshot, path, pages_per_step, progress,
+                                   sleep)
+        return super(ShardedEngine, self).restore(src_path, pages_per_step,
+                                                  progress, sleep)
+
+    def archive_messages(self, cutoff):
+        '''
+        Not supported: the messages of a sharded database are not archived.
+        Use the time strategy to keep the old messages in their own shards.
+
+        :raises NotImplementedError: always.
+
+        '''
+        raise NotImplementedError("The messages of a sharded database "
+                                  "cannot be archived")
+
+    def clear(self, fast=False):
+        '''
+        Purge the main database and all the shards, keeping the schema and
+        the shard registry. See :py:meth:`forum.database.Engine.clear`.
+
+        '''
+        shards = self.get_shards()
+        if not fast:
+            #Before the changelog is emptied, which the route triggers write
+            con = sqlite3.connect(self.db_path)
+            try:
+                with con:
+                    con.execute('DELETE FROM message_routes')
+            finally:
+                con.close()
+        super(ShardedEngine, self).clear(fast)
+        for shard_id, path, start in shards:
+            shard = sqlite3.connect(path)
+            try:
+                with shard:
+                    shard.execute('DELETE FROM messages')
+            finally:
+                shard.close()
+
+    def remove_database(self):
+        '''
+        Removes the main database file and the shard files from the
+        filesystem.
+
+        '''
+        paths = set(path for path, start in self.initial_shards)
+        if os.path.exists(self.db_path):
+            try:
+                paths.update(path for _, path, _ in self.get_shards())
+            except sqlite3.Error:
+                #The database has not been created with create_tables
+                pass
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        super(ShardedEngine, self).remove_database()
+
+
+@instrumented
+class ShardedConnection(Connection):
+    '''
+    API to access a sharded Forum database. It provides the same methods as
+    :py:class:`forum.database.Connection`. The user methods use the main
+    database and the message methods are routed to the shards. The message
+    versions, the changelog and the thread summaries are kept in the main
+    database, while the user statistics are computed from the shards.
+
+    An instance of this class should not be instantiated directly using the
+    constructor. Instead use the :py:meth:`ShardedEngine.connect`.
+
+    :param engine: the engine of the sharded database.
+    :type engine: ShardedEngine
+
+    '''
+    def __init__(self, engine):
+        super(ShardedConnection, self).__init__(
+            engine.db_path, engine.user_ids, metrics=engine.metrics,
+            body_compression_threshold=engine.body_compression_threshold)
+        self.engine = engine
+        self._shard_cons = {}
+
+    def close(self):
+        '''
+        Closes the connections to the main database and the shards,
+        commiting all changes.
+
+        '''
+        for shard in self._shard_cons.values():
+            shard.commit()
+            shard.close()
+        self._shard_cons = {}
+        super(ShardedConnection, self).close()
+
+    #HELPERS
+    def _shard(self, shard_id):
+        '''
+        :return: the sqlite3 connection to a shard.
+
+        '''
+        shard = self._shard_cons.get(shard_id)
+        if shard is None:
+            cur = self.con.cursor()
+            cur.execute('SELECT path FROM shards WHERE shard_id = ?',
+                        (shard_id,))
+            shard = sqlite3.connect(cur.fetchone()[0])
+            shard.row_factory = sqlite3.Row
+            self._shard_cons[shard_id] = shard
+        return shard
+
+    def _route(self, messageid):
+        '''
+        :return: a row with the ``shard_id`` and ``root_id`` of a message or
+            None if the message does not exist.
+
+        '''
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+        cur.execute('SELECT shard_id, root_id FROM message_routes \
+                     WHERE message_id = ?', (messageid,))
+        return cur.fetchone()
+
+    def _fetch_messages(self, routes):
+        '''
+        :param routes: list of ``(message_id, shard_id)``.
+        :return: the message rows, ordered by timestamp.
+
+        '''
+        by_shard = {}
+        for message_id, shard_id in routes:
+            by_shard.setdefault(shard_id, []).append(message_id)
+        rows = []
+        for shard_id, ids in by_shard.items():
+            cur = self._shard(shard_id).cursor()
+            for chunk in _chunks(ids):
+                cur.execute('SELECT * FROM messages WHERE message_id IN (%s)'
+                            % _placeholders(chunk), chunk)
+                rows.extend(cur.fetchall())
+        rows.sort(key=lambda row: (row['timestamp'], row['message_id']))
+        return rows
+
+    def _delete_subtrees(self, ids):
+        '''
+        Delete messages and, recursively, their replies from the shards.
+
+        :param list ids: database ids of the messages.
+        :return: the number of messages deleted.
+
+        '''
+        cur = self.con.cursor()
+        routes = []
+        for chunk in _chunks(ids):
+            cur.execute('WITH RECURSIVE subtree(message_id) AS ( \
+                             SELECT message_id FROM message_routes \
+                             WHERE message_id IN (%s) \
+                             UNION \
+                             SELECT message_routes.message_id \
+                             FROM message_routes, subtree \
+                             WHERE message_routes.reply_to = \
+                                   subtree.message_id) \
+                         SELECT message_routes.message_id, \
+                                message_routes.shard_id \
+                         FROM message_routes, subtree \
+                         WHERE message_routes.message_id = \
+                               subtree.message_id' % _placeholders(chunk),
+                        chunk)
+            routes.extend(tuple(row) for row in cur.fetchall())
+        #Like the other writes, the shards are modified while the main
+        #database is locked by the deletion of the routes
+        deleted = [message_id for message_id, shard_id in routes]
+        for chunk in _chunks(deleted):
+            cur.execute('DELETE FROM message_routes WHERE message_id IN (%s)'
+                        % _placeholders(chunk), chunk)
+        by_shard = {}
+        for message_id, shard_id in routes:
+            by_shard.setdefault(shard_id, []).append(message_id)
+        try:
+            for shard_id, shard_ids in by_shard.items():
+                shard = self._shard(shard_id)
+                for chunk in _chunks(shard_ids):
+                    shard.execute('DELETE FROM messages \
+                                   WHERE message_id IN (%s)'
+                                  % _placeholders(chunk), chunk)
+                shard.commit()
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        self._last_write = time.time()
+        return len(deleted)
+
+    #API ITSELF
+    #Message Table API.
+    def get_message(self, messageid):
+        '''
+        See :py:meth:`forum.database.Connection.get_message`.
+
+        '''
+        match = re.match(r'msg-(\d{1,3})', messageid)
+        if match is None:
+            raise ValueError("The messageid is malformed")
+        messageid = int(match.group(1))
+        route = self._route(messageid)
+        if route is None:
+            return None
+        cur = self._shard(route['shard_id']).cursor()
+        cur.execute('SELECT * FROM messages WHERE message_id = ?',
+                    (messageid,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return self._create_message_object(row)
+
+    def get_messages(self, nickname=None, number_of_messages=-1,
+                     before=-1, after=-1):
+        '''
+        See :py:meth:`forum.database.Connection.get_messages`. The query is
+        sent to every shard which can contain messages in the ``before`` and
+        ``after`` range and the results are merged by timestamp.
+
+        '''
+        conditions = []
+        pvalue = []
+        if nickname is not None:
+            conditions.append('user_nickname = ?')
+            pvalue.append(nickname)
+        if before != -1:
+            conditions.append('timestamp < ?')
+            pvalue.append(before)
+        if after != -1:
+            conditions.append('timestamp > ?')
+            pvalue.append(after)
+        query = 'SELECT message_id, title, timestamp, user_nickname \
+                 FROM messages'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY timestamp DESC, message_id DESC'
+        if number_of_messages > -1:
+            query += ' LIMIT ?'
+            pvalue.append(number_of_messages)
+        shards = self.engine.get_shards()
+        rows = []
+        for i, (shard_id, path, start) in enumerate(shards):
+            if self.engine.strategy == TIME_STRATEGY:
+                #The shard stores [start, start of the next shard)
+                end = shards[i + 1][2] if i + 1 < len(shards) else None
+                if after != -1 and end is not None and end <= after:
+                    continue
+                if before != -1 and i > 0 and start >= before:
+                    continue
+            cur = self._shard(shard_id).cursor()
+            cur.execute(query, pvalue)
+            rows.extend(cur.fetchall())
+        rows.sort(key=lambda row: (row['timestamp'], row['message_id']),
+                  reverse=True)
+        if number_of_messages > -1:
+            rows = rows[:number_of_messages]
+        return [self._create_message_list_object(row) for row in rows]
+
+    def get_thread(self, messageid):
+        '''
+        See :py:meth:`forum.database.Connection.get_thread`.
+
+        '''
+        match = re.match(r'msg-(\d{1,3})', messageid)
+        if match is None:
+            raise ValueError("The messageid is malformed")
+        messageid = int(match.group(1))
+        route = self._route(messageid)
+        if route is None:
+            return None
+        cur = self.con.cursor()
+        cur.execute('SELECT message_id, shard_id FROM message_routes \
+                     WHERE root_id = ?', (route['root_id'],))
+        routes = [tuple(row) for row in cur.fetchall()]
+        return [self._create_message_object(row)
+                for row in self._fetch_messages(routes)]
+
+    def delete_message(self, messageid):
+        '''
+        See :py:meth:`forum.database.Connection.delete_message`. The replies
+        are deleted too, even if they are in other shards.
+
+        '''
+        match = re.match(r'msg-(\d{1,3})', messageid)
+        if match is None:
+            raise ValueError("The messageid is malformed")
+        messageid = int(match.group(1))
+        return self._delete_subtrees([messageid]) > 0
+
+    def modify_message(self, messageid, title, body, editor="Anonymous",
+                       version=None):
+        '''
+        See :py:meth:`forum.database.Connection.modify_message`. The main
+        database stays locked from the version check until the shard has
+        been modified, so the conditional modifications of concurrent
+        connections are serialized.
+
+        '''
+        match = re.match(r'msg-(\d{1,3})', messageid)
+        if match is None:
+            raise ValueError("The messageid is malformed")
+        messageid = int(match.group(1))
+        route = self._route(messageid)
+        if route is None:
+            return None
+        if editor == 'Anonymous':
+            editor = None
+        body = encode_body(body, self.body_compression_threshold)
+        cur = self.con.cursor()
+        #Taking the new version locks the main database
+        cur.execute('INSERT INTO version_sequence(version) VALUES(NULL)')
+        new_version = cur.lastrowid
+        cur.execute('DELETE FROM version_sequence')
+        if version is not None:
+            cur.execute('SELECT version FROM message_versions \
+                         WHERE message_id = ?', (messageid,))
+            row = cur.fetchone()
+            if row is None or row['version'] != version:
+                self.con.rollback()
+                return VERSION_CONFLICT
+        shard = self._shard(route['shard_id'])
+        scur = shard.cursor()
+        scur.execute('UPDATE messages SET title = ?, body = ?, \
+                      editor_nickname = ? WHERE message_id = ?',
+                     (title, body, editor, messageid))
+        if scur.rowcount < 1:
+            shard.rollback()
+            self.con.rollback()
+            return None
+        shard.commit()
+        cur.execute('INSERT OR REPLACE INTO message_versions(message_id, \
+                     version) VALUES(?, ?)', (messageid, new_version))
+        cur.execute("INSERT INTO changelog(table_name, operation, row_id, \
+                     timestamp) VALUES('messages', 'update', ?, \
+                     strftime('%s', 'now'))", (messageid,))
+        self.con.commit()
+        self._last_write = time.time()
+        return 'msg-' + str(messageid)
+
+    def create_message(self, title, body, sender="Anonymous",
+                       ipaddress="0.0.0.0", replyto=None):
+        '''
+        See :py:meth:`forum.database.Connection.create_message`. The id of
+        the message is allocated in the routing table of the main database
+        and the message is stored in the shard selected by
+        :py:meth:`ShardedEngine.target_shard`. With the thread strategy
+        replies are stored in the shard of their thread.
+
+        '''
+        if replyto is not None:
+            match = re.match(r'msg-(\d{1,3})', replyto)
+            if match is None:
+                raise ValueError("The replyto is malformed")
+            replyto = int(match.group(1))
+        self.set_foreign_keys_support()
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+        parent = None
+        if replyto is not None:
+            parent = self._route(replyto)
+            if parent is None:
+                return None
+        timestamp = time.mktime(datetime.now().timetuple())
+        user_id = self._resolve_user_id(cur, sender)
+        cur.execute('INSERT INTO message_routes(reply_to, timestamp) \
+                     VALUES(?, ?)', (replyto, timestamp))
+        message_id = cur.lastrowid
+        if parent is None:
+            root_id = message_id
+            shard_id = self.engine.target_shard(self.engine.get_shards(),
+                                                root_id, timestamp)
+        else:
+            root_id = parent['root_id']
+            if self.engine.strategy == THREAD_STRATEGY:
+                shard_id = parent['shard_id']
+            else:
+                shard_id = self.engine.target_shard(self.engine.get_shards(),
+                                                    root_id, timestamp)
+        cur.execute('UPDATE message_routes SET shard_id = ?, root_id = ? \
+                     WHERE message_id = ?', (shard_id, root_id, message_id))
+        body = encode_body(body, self.body_compression_threshold)
+        shard = self._shard(shard_id)
+        try:
+            shard.execute('INSERT INTO messages(%s) VALUES(%s)' %
+                          (','.join(MESSAGE_COLUMNS),
+                           _placeholders(MESSAGE_COLUMNS)),
+                          (message_id, title, body, timestamp, ipaddress, 0,
+                           replyto, sender, user_id, None))
+            shard.commit()
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        self._last_write = time.time()
+        return 'msg-' + str(message_id)
+
+    def get_message_if_changed(self, messageid, version=None):
+        '''
+        See :py:meth:`forum.database.Connection.get_message_if_changed`. The
+        version is read from the main database and the message from its
+        shard.
+
+        '''
+        match = re.match(r'msg-(\d{1,3})', messageid)
+        if match is None:
+            raise ValueError("The messageid is malformed")
+        messageid = int(match.group(1))
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+        cur.execute('SELECT message_versions.version, message_routes.shard_id \
+                     FROM message_versions, message_routes \
+                     WHERE message_versions.message_id = ? \
+                     AND message_routes.message_id = \
+                         message_versions.message_id', (messageid,))
+        route = cur.fetchone()
+        if route is None:
+            return None
+        if version is not None and route['version'] == version:
+            return NOT_MODIFIED
+        scur = self._shard(route['shard_id']).cursor()
+        scur.execute('SELECT * FROM messages WHERE message_id = ?',
+                     (messageid,))
+        row = scur.fetchone()
+        if row is None:
+            return None
+        message = self._create_message_object(row)
+        message['version'] = route['version']
+        return message
+
+    def get_threads(self, limit=20, cursor=None):
+        '''
+        See :py:meth:`forum.database.Connection.get_threads`. The replies
+        and the activity of the threads are read from the ``route_threads``
+        table of the main database, which the triggers of the routing table
+        keep up to date, and paginated using its ``(last_activity,
+        root_id)`` index. The titles, senders and participants are read from
+        the shards of the threads in the page.
+
+        '''
+        query = 'SELECT root_id, reply_count, last_reply, last_activity \
+                 FROM route_threads'
+        pvalue = ()
+        if cursor is not None:
+            match = re.match(r'^(-?\d+(?:\.\d+)?):(\d+)$', cursor)
+            if match is None:
+                raise ValueError("The cursor is malformed")
+            query += ' WHERE (last_activity, root_id) < (?, ?)'
+            pvalue = (float(match.group(1)), int(match.group(2)))
+        query += ' ORDER BY last_activity DESC, root_id DESC LIMIT ?'
+        pvalue += (limit,)
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+        cur.execute(query, pvalue)
+        summaries = [dict(zip(row.keys(), row)) for row in cur.fetchall()]
+        roots = [summary['root_id'] for summary in summaries]
+        routes = []
+        for chunk in _chunks(roots):
+            cur.execute('SELECT message_id, shard_id, root_id \
+                         FROM message_routes WHERE root_id IN (%s)' %
+                        _placeholders(chunk), chunk)
+            routes.extend(cur.fetchall())
+        by_shard = {}
+        root_of = {}
+        for route in routes:
+            by_shard.setdefault(route['shard_id'], []).append(
+                route['message_id'])
+            root_of[route['message_id']] = route['root_id']
+        participants = dict((root_id, set()) for root_id in roots)
+        messages = {}
+        for shard_id, ids in by_shard.items():
+            scur = self._shard(shard_id).cursor()
+            for chunk in _chunks(ids):
+                scur.execute('SELECT message_id, title, user_nickname \
+                              FROM messages WHERE message_id IN (%s)' %
+                             _placeholders(chunk), chunk)
+                for row in scur.fetchall():
+                    messages[row['message_id']] = row
+                    if row['user_nickname'] is not None:
+                        participants[root_of[row['message_id']]].add(
+                            row['user_nickname'])
+        threads = []
+        for summary in summaries:
+            root = messages.get(summary['root_id'])
+            summary['title'] = root['title'] if root is not None else None
+            summary['user_nickname'] = root['user_nickname'] \
+                if root is not None else None
+            summary['participant_count'] = len(
+                participants[summary['root_id']])
+            threads.append(self._create_thread_object(summary))
+        next_cursor = None
+        if len(summaries) == limit and limit > 0:
+            last = summaries[-1]
+            next_cursor = '%r:%d' % (last['last_activity'], last['root_id'])
+        return threads, next_cursor
+
+    #ACCESSING THE USER and USER_PROFILE tables
+    def delete_user(self, nickname):
+        '''
+        See :py:meth:`forum.database.Connection.delete_user`. The messages
+        of the user and their replies are deleted from the shards.
+
+        '''
+        cur = self.con.cursor()
+        user_id = self._resolve_user_id(cur, nickname)
+        deleted = super(ShardedConnection, self).delete_user(nickname)
+        if deleted and user_id is not None:
+            ids = []
+            for shard_id, path, start in self.engine.get_shards():
+                scur = self._shard(shard_id).cursor()
+                scur.execute('SELECT message_id FROM messages \
+                              WHERE user_id = ?', (user_id,))
+                ids.extend(row[0] for row in scur.fetchall())
+            if ids:
+                self._delete_subtrees(ids)
+        return deleted
+
+    def get_user_stats(self, nickname):
+        '''
+        See :py:meth:`forum.database.Connection.get_user_stats`. The
+        messages of the user are counted in every shard, using the
+        ``(user_id, timestamp)`` index of the shards.
+
+        '''
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+        user_id = self._resolve_user_id(cur, nickname)
+        if user_id is None:
+            return None
+        cur.execute('SELECT nickname FROM users WHERE user_id = ?',
+                    (user_id,))
+        row = cur.fetchone()
+        if row is None:
+            self.user_ids.invalidate(nickname)
+            return None
+        count = 0
+        last_post = None
+        for shard_id, path, start in self.engine.get_shards():
+            scur = self._shard(shard_id).cursor()
+            scur.execute('SELECT COUNT(*), MAX(timestamp) FROM messages \
+                          WHERE user_id = ?', (user_id,))
+            shard_count, shard_last = scur.fetchone()
+            count += shard_count
+            if shard_last is not None:
+                last_post = max(last_post, shard_last)
+        return {'nickname': row['nickname'],
+                'messages': count,
+                'lastpost': last_post}
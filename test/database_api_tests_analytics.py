@@ -0,0 +1,110 @@
+'''
+Created on 19.10.2026
+
+Testing of the parallel analytics over the messages.
+
+@author: ivan
+'''
+
+import unittest
+
+from forum import database, analytics
+
+#Path to the database file, different from the deployment db
+DB_PATH = 'db/forum_test_analytics.db'
+ENGINE = database.Engine(DB_PATH)
+
+#Every message of the dump is sent at this time
+DUMP_TIMESTAMP = 1362017481
+
+INITIAL_SIZE = 20
+
+
+class AnalyticsTestCase(unittest.TestCase):
+    '''
+    Test cases for the analytics module.
+    '''
+    #INITIATION AND TEARDOWN METHODS
+    @classmethod
+    def setUpClass(cls):
+        ''' Creates the database structure. Removes first any preexisting
+            database file
+        '''
+        print("Testing ", cls.__name__)
+        ENGINE.remove_database()
+        ENGINE.create_template()
+
+    @classmethod
+    def tearDownClass(cls):
+        '''Remove the testing database'''
+        print("Testing ENDED for ", cls.__name__)
+        ENGINE.remove_database()
+        ENGINE.remove_template()
+
+    def setUp(self):
+        '''
+        Copies the template with the initial values from forum_data_dump.sql
+        '''
+        ENGINE.clone_template()
+        self.connection = ENGINE.connect()
+
+    def tearDown(self):
+        '''
+        Close underlying connection.
+        '''
+        self.connection.close()
+
+    def test_split_ranges(self):
+        '''
+        Checks that the ranges cover all the message ids.
+        '''
+        print('('+self.test_split_ranges.__name__+')', \
+                  self.test_split_ranges.__doc__)
+        ranges = analytics.split_ranges(DB_PATH, 6)
+        self.assertEqual(ranges[0][0], 1)
+        self.assertEqual(ranges[-1][1], INITIAL_SIZE)
+        for (_, last), (first, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(last + 1, first)
+        self.assertEqual(analytics.split_ranges(DB_PATH, 100),
+                         [(i, i) for i in range(1, INITIAL_SIZE + 1)])
+
+    def test_scan(self):
+        '''
+        Checks the built-in aggregations computed by a pool of processes.
+        '''
+        print('('+self.test_scan.__name__+')', \
+                  self.test_scan.__doc__)
+        results = analytics.scan(DB_PATH, processes=2)
+        users = results['posts_per_user']
+        self.assertEqual(sum(users.values()), INITIAL_SIZE)
+        self.assertEqual(users['HockeyFan'], 3)
+        self.assertEqual(users['AxelW'], 2)
+        self.assertEqual(results['posts_per_day'],
+                         {'2013-02-28': INITIAL_SIZE})
+        threads = results['posts_per_thread']
+        self.assertEqual(len(threads), 7)
+        self.assertEqual(threads['msg-1'], 12)
+        #The same result is obtained without the pool
+        self.assertEqual(analytics.scan(DB_PATH, processes=1), results)
+        self.assertEqual(analytics.posts_per_thread(DB_PATH, 3), threads)
+
+    def test_keyword_counts(self):
+        '''
+        Checks that the keywords are counted once per message, case
+        insensitive, including the archived messages.
+        '''
+        print('('+self.test_keyword_counts.__name__+')', \
+                  self.test_keyword_counts.__doc__)
+        cur = self.connection.con.cursor()
+        cur.execute("SELECT COUNT(*) FROM messages WHERE body LIKE '%zip%'")
+        expected = cur.fetchone()[0]
+        ENGINE.archive_messages(DUMP_TIMESTAMP + 1)
+        counts = analytics.keyword_counts(['ZIP', 'nonexistingword'],
+                                          DB_PATH, 2)
+        self.assertEqual(counts, {'ZIP': expected})
+        with self.assertRaises(ValueError):
+            analytics.scan(DB_PATH, ['posts_per_year'])
+
+if __name__ == '__main__':
+    print('Start running analytics tests')
+    unittest.main()
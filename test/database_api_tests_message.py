@@ -78,21 +78,25 @@ class MessageDBAPITestCase(unittest.TestCase):
         '''
         print("Testing ", cls.__name__)
         ENGINE.remove_database()
-        ENGINE.create_tables()
+        #Creates and populates the database structure only once. Each test
+        #starts from a copy of this template.
+        ENGINE.create_template()
 
     @classmethod
     def tearDownClass(cls):
         '''Remove the testing database'''
         print("Testing ENDED for ", cls.__name__)
         ENGINE.remove_database()
+        ENGINE.remove_template()
 
     def setUp(self):
         '''
         Populates the database
         '''
         try:
-          #This method load the initial values from forum_data_dump.sql
-          ENGINE.populate_tables()
+          #Copies the template with the initial values from
+          #forum_data_dump.sql
+          ENGINE.clone_template()
           #Creates a Connection instance to use the API
           self.connection = ENGINE.connect()
         except Exception as e: 
@@ -101,10 +105,10 @@ class MessageDBAPITestCase(unittest.TestCase):
 
     def tearDown(self):
         '''
-        Close underlying connection and remove all records from database
+        Close underlying connection. The next test starts from a new copy of
+        the template.
         '''
         self.connection.close()
-        ENGINE.clear()
 
     def test_messages_table_created(self):
         '''
@@ -284,6 +288,38 @@ class MessageDBAPITestCase(unittest.TestCase):
         resp2 = self.connection.get_message(MESSAGE1_ID)
         self.assertDictContainsSubset(resp2, MESSAGE1_MODIFIED)
 
+    def test_modify_message_version(self):
+        '''
+        Test that modify_message with a version only modifies the message if
+        nobody has modified it meanwhile
+        '''
+        print('('+self.test_modify_message_version.__name__+')', \
+              self.test_modify_message_version.__doc__)
+        version = self.connection.get_message_if_changed(
+            MESSAGE1_ID)['version']
+        #Another editor modifies the message first
+        resp = self.connection.modify_message(MESSAGE1_ID, 'new title',
+                                              'new body', 'new editor',
+                                              version)
+        self.assertEqual(resp, MESSAGE1_ID)
+        resp = self.connection.modify_message(MESSAGE1_ID, 'lost title',
+                                              'lost body', 'other editor',
+                                              version)
+        self.assertIs(resp, database.VERSION_CONFLICT)
+        self.assertDictContainsSubset(
+            self.connection.get_message(MESSAGE1_ID), MESSAGE1_MODIFIED)
+        version = self.connection.get_message_if_changed(
+            MESSAGE1_ID)['version']
+        self.assertIsNone(self.connection.modify_message(
+            WRONG_MESSAGE_ID, 'new title', 'new body', 'editor', version))
+        #Archived messages are checked too
+        ENGINE.archive_messages(MESSAGE1['timestamp'] + 1)
+        self.assertIs(self.connection.modify_message(
+            MESSAGE1_ID, 'title', 'body', 'editor', version - 1),
+            database.VERSION_CONFLICT)
+        self.assertEqual(self.connection.modify_message(
+            MESSAGE1_ID, 'title', 'body', 'editor', version), MESSAGE1_ID)
+
     def test_modify_message_malformedid(self):
         '''
         Test that trying to modify message wit id ='2' raises an error
@@ -390,6 +426,283 @@ class MessageDBAPITestCase(unittest.TestCase):
                                 "new title", "new body", "Koodari")
         self.assertIsNone(resp)
 
+    def test_get_threads(self):
+        '''
+        Test that get_threads returns the summaries of the root messages and
+        that the cursor continues the listing
+        '''
+        print('('+self.test_get_threads.__name__+')',\
+              self.test_get_threads.__doc__)
+        threads, cursor = self.connection.get_threads(4)
+        self.assertEqual([t['messageid'] for t in threads],
+                         ['msg-18', 'msg-12', 'msg-9', 'msg-6'])
+        self.assertIsNotNone(cursor)
+        threads, cursor = self.connection.get_threads(4, cursor)
+        self.assertEqual([t['messageid'] for t in threads],
+                         ['msg-4', 'msg-2', MESSAGE1_ID])
+        self.assertIsNone(cursor)
+        thread = threads[-1]
+        self.assertEqual(thread['title'], MESSAGE1['title'])
+        self.assertEqual(thread['replies'], 11)
+        self.assertEqual(thread['participants'], 10)
+        self.assertEqual(thread['lastreply'], 1362017481)
+        with self.assertRaises(ValueError):
+            self.connection.get_threads(4, 'msg-1')
+
+    def test_get_threads_after_changes(self):
+        '''
+        Test that the thread summaries follow append_answer and the cascading
+        deletes of delete_message
+        '''
+        print('('+self.test_get_threads_after_changes.__name__+')',\
+              self.test_get_threads_after_changes.__doc__)
+        #Reply to a reply of msg-6
+        messageid = self.connection.append_answer('msg-8', "new title",
+                                                  "new body", "Koodari")
+        threads, cursor = self.connection.get_threads(1)
+        self.assertEqual(threads[0]['messageid'], 'msg-6')
+        self.assertEqual(threads[0]['replies'], 2)
+        self.assertEqual(threads[0]['participants'], 2)
+        self.assertGreater(threads[0]['lastactivity'], 1362017481)
+        self.connection.delete_message(messageid)
+        threads, cursor = self.connection.get_threads(1)
+        self.assertEqual(threads[0]['messageid'], 'msg-18')
+        #msg-3 has two replies from Mystery
+        self.connection.delete_message('msg-3')
+        threads, cursor = self.connection.get_threads(10)
+        thread = threads[-1]
+        self.assertEqual(thread['replies'], 8)
+        self.assertEqual(thread['participants'], 8)
+        #Deleting the root removes the thread
+        self.connection.delete_message(MESSAGE1_ID)
+        threads, cursor = self.connection.get_threads(10)
+        self.assertEqual(len(threads), 6)
+        self.assertNotIn(MESSAGE1_ID, [t['messageid'] for t in threads])
+
+    def test_archive_messages(self):
+        '''
+        Test that archived threads leave the messages table but are still
+        returned by the read methods
+        '''
+        print('('+self.test_archive_messages.__name__+')',\
+              self.test_archive_messages.__doc__)
+        messageid = self.connection.create_message('new title', 'new body',
+                                                   'AxelW')
+        timestamp = MESSAGE1['timestamp']
+        self.assertEqual(ENGINE.archive_messages(timestamp + 1), INITIAL_SIZE)
+        self.assertEqual(ENGINE.archive_messages(timestamp), 0)
+        cur = self.connection.con.cursor()
+        cur.execute('SELECT COUNT(*) FROM messages')
+        self.assertEqual(cur.fetchone()[0], 1)
+        #The archive is only read when the range reaches the cutoff
+        messages = self.connection.get_messages(after=timestamp)
+        self.assertEqual([m['messageid'] for m in messages], [messageid])
+        messages = self.connection.get_messages()
+        self.assertEqual(len(messages), INITIAL_SIZE + 1)
+        self.assertEqual(messages[0]['messageid'], messageid)
+        self.assertEqual(len(self.connection.get_messages('AxelW')), 3)
+        self.assertEqual(len(self.connection.get_messages("Axel'W")), 0)
+        self.assertDictContainsSubset(self.connection.get_message(MESSAGE1_ID),
+                                      MESSAGE1)
+        self.assertEqual(len(self.connection.get_thread(MESSAGE2_ID)), 12)
+        threads, cursor = self.connection.get_threads(10)
+        self.assertEqual(len(threads), 8)
+        self.assertEqual(threads[-1]['title'], MESSAGE1['title'])
+        self.assertEqual(self.connection.get_user_stats('AxelW')['messages'],
+                         3)
+        #Archived threads cannot be answered but can be edited and deleted
+        with self.assertRaises(ValueError):
+            self.connection.append_answer(MESSAGE1_ID, 'a', 'b')
+        self.assertIsNone(self.connection.append_answer('msg-200', 'a', 'b'))
+        self.connection.modify_message(MESSAGE1_ID, 'new title', 'new body',
+                                       'new editor')
+        self.assertDictContainsSubset(self.connection.get_message(MESSAGE1_ID),
+                                      MESSAGE1_MODIFIED)
+        self.assertTrue(self.connection.delete_message(MESSAGE1_ID))
+        self.assertIsNone(self.connection.get_message(MESSAGE2_ID))
+        threads, cursor = self.connection.get_threads(10)
+        self.assertEqual(len(threads), 7)
+        stats = self.connection.get_user_stats('AxelW')
+        self.assertEqual(stats['messages'], 1)
+        self.assertEqual(stats['lastpost'],
+                         self.connection.get_message(messageid)['timestamp'])
+
+    def test_get_message_if_changed(self):
+        '''
+        Test that the message versions change when the messages are modified
+        or deleted
+        '''
+        print('('+self.test_get_message_if_changed.__name__+')',\
+              self.test_get_message_if_changed.__doc__)
+        message = self.connection.get_message_if_changed(MESSAGE1_ID)
+        version = message.pop('version')
+        self.assertDictContainsSubset(message, MESSAGE1)
+        self.assertIs(self.connection.get_message_if_changed(MESSAGE1_ID,
+                                                             version),
+                      database.NOT_MODIFIED)
+        versions = self.connection.get_changed_messages(0)
+        self.assertEqual(len(versions), INITIAL_SIZE)
+        latest = max(versions.values())
+        self.assertEqual(self.connection.get_changed_messages(
+                             latest, [MESSAGE1_ID, MESSAGE2_ID]), {})
+        self.connection.modify_message(MESSAGE1_ID, 'new title', 'new body',
+                                       'new editor')
+        message = self.connection.get_message_if_changed(MESSAGE1_ID,
+                                                         version)
+        new_version = message.pop('version')
+        self.assertGreater(new_version, latest)
+        self.assertDictContainsSubset(message, MESSAGE1_MODIFIED)
+        self.connection.delete_message(MESSAGE2_ID)
+        self.assertEqual(self.connection.get_changed_messages(
+                             latest, [MESSAGE1_ID, MESSAGE2_ID, 'msg-3']),
+                         {MESSAGE1_ID: new_version, MESSAGE2_ID: None})
+        self.assertEqual(self.connection.get_changed_messages(latest),
+                         {MESSAGE1_ID: new_version})
+        self.assertIsNone(self.connection.get_message_if_changed(
+                              WRONG_MESSAGE_ID))
+        with self.assertRaises(ValueError):
+            self.connection.get_changed_messages(latest, ['1'])
+
+    def test_versions_not_reused(self):
+        '''
+        Test that deleting the message with the greatest version does not
+        give its version to the next modified message
+        '''
+        print('('+self.test_versions_not_reused.__name__+')',\
+              self.test_versions_not_reused.__doc__)
+        self.connection.modify_message('msg-3', 'new title', 'new body')
+        version = self.connection.get_message_if_changed('msg-3')['version']
+        self.assertEqual(max(self.connection.get_changed_messages(0)
+                             .values()), version)
+        self.connection.delete_message('msg-3')
+        self.connection.modify_message('msg-5', 'new title', 'new body')
+        changed = self.connection.get_changed_messages(version)
+        self.assertEqual(changed.keys(), ['msg-5'])
+        self.assertGreater(changed['msg-5'], version)
+
+    def test_read_changes(self):
+        '''
+        Test that read_changes returns the changes made after a sequence
+        number, and that archiving is not reported
+        '''
+        print('('+self.test_read_changes.__name__+')',\
+              self.test_read_changes.__doc__)
+        changes = self.connection.read_changes(0, 1000)
+        self.assertEqual(len([change for change in changes
+                              if change['table'] == 'messages']),
+                         INITIAL_SIZE)
+        self.assertEqual(changes, sorted(changes, key=lambda c: c['seq']))
+        self.assertEqual(self.connection.read_changes(0, 5), changes[:5])
+        last = changes[-1]['seq']
+        self.assertEqual(self.connection.read_changes(last), [])
+        self.connection.modify_message(MESSAGE1_ID, 'new title', 'new body',
+                                       'new editor')
+        self.connection.delete_message(MESSAGE2_ID)
+        changes = self.connection.read_changes(last)
+        self.assertEqual([(change['operation'], change['messageid'])
+                          for change in changes],
+                         [('update', MESSAGE1_ID), ('delete', MESSAGE2_ID)])
+        self.assertGreater(changes[0]['seq'], last)
+        last = changes[-1]['seq']
+        ENGINE.archive_messages(MESSAGE1['timestamp'] + 1)
+        self.assertEqual(self.connection.read_changes(last), [])
+        #Changes of archived messages are reported as messages, including
+        #the replies deleted in cascade
+        self.connection.delete_message('msg-3')
+        changes = self.connection.read_changes(last)
+        self.assertEqual(sorted((change['operation'], change['messageid'])
+                                for change in changes),
+                         [('delete', 'msg-13'), ('delete', 'msg-14'),
+                          ('delete', 'msg-3')])
+
+    def test_body_compression(self):
+        '''
+        Test that long bodies are stored compressed and read back unchanged
+        '''
+        print('('+self.test_body_compression.__name__+')',\
+              self.test_body_compression.__doc__)
+        engine = database.Engine(DB_PATH, body_compression_threshold=200)
+        connection = engine.connect()
+        try:
+            body = u'Quoted reply \u00e4\u00f6. ' * 50
+            messageid = connection.create_message('long', body, 'AxelW')
+            shortid = connection.create_message('short', 'short body',
+                                                'AxelW')
+            connection.modify_message(MESSAGE1_ID, 'new title', body)
+            cur = connection.con.cursor()
+            cur.execute('SELECT message_id, typeof(body), length(body) \
+                         FROM messages WHERE message_id IN (?, ?, 1) \
+                         ORDER BY message_id',
+                        (messageid[4:], shortid[4:]))
+            rows = cur.fetchall()
+            self.assertEqual([row[1] for row in rows],
+                             ['blob', 'blob', 'text'])
+            self.assertLess(rows[0][2], len(body) / 4)
+            #Any connection reads the compressed bodies
+            self.assertEqual(self.connection.get_message(messageid)['body'],
+                             body)
+            self.assertEqual(connection.get_message(MESSAGE1_ID)['body'],
+                             body)
+            self.assertEqual(connection.get_message(shortid)['body'],
+                             'short body')
+            messages = self.connection.get_messages()
+            self.assertEqual(len(messages), INITIAL_SIZE + 2)
+            self.assertNotIn('body', messages[0])
+        finally:
+            connection.close()
+
+    def test_long_body_storage(self):
+        '''
+        Test that long bodies are kept in message_bodies and out of the rows
+        of messages
+        '''
+        print('('+self.test_long_body_storage.__name__+')',\
+              self.test_long_body_storage.__doc__)
+        body = 'x' * (database.MAX_INLINE_BODY + 1)
+        messageid = self.connection.append_answer(MESSAGE1_ID, 'long', body,
+                                                  'AxelW')
+        message_id = int(messageid[4:])
+        cur = self.connection.con.cursor()
+        query = 'SELECT messages.body, message_bodies.body FROM messages \
+                 LEFT JOIN message_bodies \
+                 ON message_bodies.message_id = messages.message_id \
+                 WHERE messages.message_id = ?'
+        cur.execute(query, (message_id,))
+        self.assertEqual(tuple(cur.fetchone()), (None, body))
+        self.assertEqual(self.connection.get_message(messageid)['body'], body)
+        thread = self.connection.get_thread(messageid)
+        self.assertIn(body, [message['body'] for message in thread])
+        #A short body goes back to messages
+        self.connection.modify_message(messageid, 'short', 'short body')
+        cur.execute(query, (message_id,))
+        self.assertEqual(tuple(cur.fetchone()), ('short body', None))
+        self.connection.modify_message(MESSAGE1_ID, 'long', body)
+        self.assertEqual(self.connection.get_message_if_changed(
+                             MESSAGE1_ID)['body'], body)
+        #Archived messages keep their body
+        ENGINE.archive_messages(MESSAGE1['timestamp'] + 1)
+        self.assertEqual(self.connection.get_message(MESSAGE1_ID)['body'],
+                         body)
+        self.connection.delete_message(MESSAGE1_ID)
+        cur.execute('SELECT COUNT(*) FROM message_bodies')
+        self.assertEqual(cur.fetchone()[0], 0)
+
+    def test_get_thread(self):
+        '''
+        Test that get_thread returns the root message and all its replies
+        ordered by time
+        '''
+        print('('+self.test_get_thread.__name__+')',\
+              self.test_get_thread.__doc__)
+        thread = self.connection.get_thread(MESSAGE2_ID)
+        self.assertEqual(len(thread), 12)
+        self.assertDictContainsSubset(thread[0], MESSAGE1)
+        self.assertIn(MESSAGE2, thread)
+        self.assertEqual(thread, self.connection.get_thread(MESSAGE1_ID))
+        self.assertIsNone(self.connection.get_thread(WRONG_MESSAGE_ID))
+        with self.assertRaises(ValueError):
+            self.connection.get_thread('1')
+
     def test_not_contains_message(self):
         '''
         Check if the database does not contain messages with id msg-200
@@ -0,0 +1,335 @@
+'''
+Created on 19.10.2026
+
+Database interface testing for the sharded database.
+
+@author: ivan
+'''
+
+import sqlite3, unittest, os
+
+from forum import database, sharding
+
+#Path to the main database file, different from the deployment db
+DB_PATH = 'db/forum_test_sharded.db'
+#Paths to the shards
+SHARD_PATHS = ['db/forum_test_shard1.db', 'db/forum_test_shard2.db']
+NEW_SHARD_PATH = 'db/forum_test_shard3.db'
+BACKUP_PATH = 'db/forum_test_sharded_backup.db'
+ENGINE = sharding.ShardedEngine(DB_PATH, SHARD_PATHS)
+
+#Every message of the dump is sent at this time
+DUMP_TIMESTAMP = 1362017481
+
+INITIAL_SIZE = 20
+
+
+def shard_sizes(paths):
+    '''
+    Count the messages of each shard.
+    '''
+    sizes = []
+    for path in paths:
+        con = sqlite3.connect(path)
+        sizes.append(con.execute('SELECT COUNT(*) FROM messages').fetchone()[0])
+        con.close()
+    return sizes
+
+
+class ShardedDBAPITestCase(unittest.TestCase):
+    '''
+    Test cases for the ShardedEngine and ShardedConnection.
+    '''
+    #INITIATION AND TEARDOWN METHODS
+    @classmethod
+    def setUpClass(cls):
+        ''' Removes any preexisting database file
+        '''
+        print("Testing ", cls.__name__)
+        ENGINE.remove_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        '''Remove the testing database'''
+        print("Testing ENDED for ", cls.__name__)
+        ENGINE.remove_database()
+
+    def setUp(self):
+        '''
+        Creates the main database and the shards and distributes the
+        messages of forum_data_dump.sql among them.
+        '''
+        ENGINE.create_tables()
+        ENGINE.populate_tables()
+        self.connection = ENGINE.connect()
+
+    def tearDown(self):
+        '''
+        Close underlying connection and remove the database files
+        '''
+        self.connection.close()
+        ENGINE.remove_database()
+        if os.path.exists(NEW_SHARD_PATH):
+            os.remove(NEW_SHARD_PATH)
+
+    def test_messages_distributed(self):
+        '''
+        Checks that the messages are moved to the shards grouped by thread.
+        '''
+        print('('+self.test_messages_distributed.__name__+')', \
+                  self.test_messages_distributed.__doc__)
+        con = self.connection.con
+        cur = con.cursor()
+        cur.execute('SELECT COUNT(*) FROM messages')
+        self.assertEqual(cur.fetchone()[0], 0)
+        sizes = shard_sizes(SHARD_PATHS)
+        self.assertEqual(sum(sizes), INITIAL_SIZE)
+        self.assertTrue(all(sizes))
+        #All the messages of a thread are in the same shard
+        cur.execute('SELECT root_id, COUNT(DISTINCT shard_id) \
+                     FROM message_routes GROUP BY root_id')
+        self.assertTrue(all(row[1] == 1 for row in cur.fetchall()))
+
+    def test_read_messages(self):
+        '''
+        Checks that the reads are routed to the shards and merged.
+        '''
+        print('('+self.test_read_messages.__name__+')', \
+                  self.test_read_messages.__doc__)
+        message = self.connection.get_message('msg-1')
+        self.assertEqual(message['title'], 'CSS: Margin problems with IE')
+        self.assertIsNone(self.connection.get_message('msg-200'))
+        messages = self.connection.get_messages()
+        self.assertEqual(len(messages), INITIAL_SIZE)
+        self.assertEqual(messages[0]['messageid'], 'msg-20')
+        self.assertEqual(len(self.connection.get_messages('HockeyFan')), 3)
+        self.assertEqual(len(self.connection.get_messages(
+                             number_of_messages=5)), 5)
+        self.assertEqual(len(self.connection.get_thread('msg-10')), 12)
+        self.assertEqual(self.connection.get_user('AxelW')['public_profile']
+                         ['nickname'], 'AxelW')
+
+    def test_write_messages(self):
+        '''
+        Checks that messages can be created, modified and deleted with their
+        replies.
+        '''
+        print('('+self.test_write_messages.__name__+')', \
+                  self.test_write_messages.__doc__)
+        messageid = self.connection.create_message('new title', 'new body',
+                                                   'AxelW')
+        self.assertEqual(messageid, 'msg-21')
+        replyid = self.connection.append_answer(messageid, 'reply', 'body',
+                                                'Mystery')
+        self.assertEqual(self.connection.get_message(replyid)['replyto'],
+                         messageid)
+        self.assertEqual(len(self.connection.get_thread(replyid)), 2)
+        self.assertIsNone(self.connection.append_answer('msg-200', 'a', 'b'))
+        self.assertEqual(self.connection.modify_message(replyid, 'a', 'b',
+                                                        'AxelW'), replyid)
+        self.assertEqual(self.connection.get_message(replyid)['editor'],
+                         'AxelW')
+        self.assertTrue(self.connection.delete_message('msg-1'))
+        self.assertFalse(self.connection.delete_message('msg-1'))
+        self.assertIsNone(self.connection.get_message('msg-15'))
+        self.assertEqual(len(self.connection.get_messages()),
+                         INITIAL_SIZE - 12 + 2)
+        #The messages of a deleted user and their replies are removed
+        self.assertTrue(self.connection.delete_user('HockeyFan'))
+        self.assertEqual(len(self.connection.get_messages()),
+                         INITIAL_SIZE - 12 + 2 - 2)
+        self.assertEqual(sum(shard_sizes(SHARD_PATHS)), 8)
+
+    def test_threads_and_user_stats(self):
+        '''
+        Checks that the thread summaries and the user statistics are merged
+        from all the shards.
+        '''
+        print('('+self.test_threads_and_user_stats.__name__+')', \
+                  self.test_threads_and_user_stats.__doc__)
+        threads, cursor = self.connection.get_threads(10)
+        self.assertEqual(len(threads), 7)
+        self.assertIsNone(cursor)
+        thread = [t for t in threads if t['messageid'] == 'msg-1'][0]
+        self.assertEqual(thread['replies'], 11)
+        self.assertEqual(thread['title'], 'CSS: Margin problems with IE')
+        self.assertEqual(thread['sender'], 'AxelW')
+        self.assertGreater(thread['participants'], 1)
+        #Pagination
+        page, cursor = self.connection.get_threads(4)
+        rest, last = self.connection.get_threads(4, cursor)
+        self.assertEqual(page + rest, threads)
+        self.assertIsNone(last)
+        with self.assertRaises(ValueError):
+            self.connection.get_threads(4, 'msg-1')
+        stats = self.connection.get_user_stats('HockeyFan')
+        self.assertEqual(stats['messages'], 3)
+        self.assertEqual(stats['lastpost'], DUMP_TIMESTAMP)
+        messageid = self.connection.create_message('new title', 'new body',
+                                                   'HockeyFan')
+        stats = self.connection.get_user_stats('HockeyFan')
+        self.assertEqual(stats['messages'], 4)
+        self.assertEqual(self.connection.get_threads(1)[0][0]['messageid'],
+                         messageid)
+        self.assertIsNone(self.connection.get_user_stats('Nobody'))
+
+    def test_thread_summaries(self):
+        '''
+        Checks that the thread summaries of the main database follow the
+        creation and deletion of messages in the shards.
+        '''
+        print('('+self.test_thread_summaries.__name__+')', \
+                  self.test_thread_summaries.__doc__)
+        summaries = 'SELECT * FROM route_threads ORDER BY root_id'
+        computed = 'SELECT root_id, COUNT(*) - 1, \
+                           MAX(CASE WHEN message_id != root_id \
+                                    THEN timestamp END), \
+                           MAX(timestamp) \
+                    FROM message_routes GROUP BY root_id ORDER BY root_id'
+        cur = self.connection.con.cursor()
+        self.assertEqual(len(cur.execute(summaries).fetchall()), 7)
+        root = self.connection.create_message('new title', 'new body')
+        reply = self.connection.append_answer(root, 'reply', 'body',
+                                              'HockeyFan')
+        thread = self.connection.get_threads(1)[0][0]
+        self.assertEqual((thread['messageid'], thread['replies']), (root, 1))
+        self.assertEqual(cur.execute(summaries).fetchall(),
+                         cur.execute(computed).fetchall())
+        self.assertTrue(self.connection.delete_message(reply))
+        self.assertEqual(self.connection.get_threads(1)[0][0]['replies'], 0)
+        self.assertTrue(self.connection.delete_message('msg-1'))
+        self.assertEqual(cur.execute(summaries).fetchall(),
+                         cur.execute(computed).fetchall())
+        self.assertEqual(len(self.connection.get_threads(10)[0]), 7)
+
+    def test_backup_and_restore(self):
+        '''
+        Checks that backup and restore cover the main database and every
+        shard, and that archive_messages is not supported.
+        '''
+        print('('+self.test_backup_and_restore.__name__+')', \
+                  self.test_backup_and_restore.__doc__)
+        snapshots = [BACKUP_PATH] + [
+            ENGINE.shard_snapshot_path(BACKUP_PATH, shard_id)
+            for shard_id, path, start in ENGINE.get_shards()]
+        try:
+            ENGINE.backup(BACKUP_PATH)
+            self.assertTrue(all(ENGINE.verify_backup(path)
+                                for path in snapshots))
+            threads = self.connection.get_threads(10)
+            self.assertTrue(self.connection.delete_message('msg-1'))
+            self.connection.create_message('new title', 'new body')
+            self.assertTrue(ENGINE.restore(BACKUP_PATH))
+            self.assertEqual(shard_sizes(SHARD_PATHS),
+                             shard_sizes(snapshots[1:]))
+            self.assertEqual(len(self.connection.get_messages()),
+                             INITIAL_SIZE)
+            self.assertEqual(self.connection.get_threads(10), threads)
+            #A missing shard snapshot is detected before restoring anything
+            os.remove(snapshots[-1])
+            self.connection.create_message('new title', 'new body')
+            self.assertFalse(ENGINE.restore(BACKUP_PATH))
+            self.assertEqual(len(self.connection.get_messages()),
+                             INITIAL_SIZE + 1)
+        finally:
+            for path in snapshots:
+                if os.path.exists(path):
+                    os.remove(path)
+        with self.assertRaises(NotImplementedError):
+            ENGINE.archive_messages(DUMP_TIMESTAMP + 1)
+
+    def test_versions_and_changes(self):
+        '''
+        Checks the conditional reads and modifications and the changelog of
+        the messages stored in the shards.
+        '''
+        print('('+self.test_versions_and_changes.__name__+')', \
+                  self.test_versions_and_changes.__doc__)
+        message = self.connection.get_message_if_changed('msg-1')
+        version = message.pop('version')
+        self.assertEqual(message, self.connection.get_message('msg-1'))
+        self.assertIs(self.connection.get_message_if_changed('msg-1',
+                                                             version),
+                      database.NOT_MODIFIED)
+        self.assertEqual(len(self.connection.get_changed_messages(0)),
+                         INITIAL_SIZE)
+        self.assertEqual(self.connection.modify_message(
+                             'msg-1', 'a', 'b', version=version), 'msg-1')
+        self.assertIs(self.connection.modify_message(
+                          'msg-1', 'c', 'd', version=version),
+                      database.VERSION_CONFLICT)
+        self.assertEqual(self.connection.get_message('msg-1')['title'], 'a')
+        new_version = self.connection.get_message_if_changed(
+            'msg-1', version)['version']
+        self.assertGreater(new_version, version)
+        self.assertIsNone(self.connection.modify_message('msg-200', 'a', 'b',
+                                                         version=1))
+        seq = self.connection.read_changes(0, 1000)[-1]['seq']
+        messageid = self.connection.create_message('new title', 'new body')
+        self.connection.delete_message(messageid)
+        self.assertEqual(self.connection.get_changed_messages(
+                             new_version, ['msg-1', messageid]),
+                         {messageid: None})
+        changes = self.connection.read_changes(seq)
+        self.assertEqual([(c['operation'], c['messageid']) for c in changes],
+                         [('insert', messageid), ('delete', messageid)])
+
+    def test_attach_shard_and_rebalance(self):
+        '''
+        Checks that rebalance moves the threads to a new shard.
+        '''
+        print('('+self.test_attach_shard_and_rebalance.__name__+')', \
+                  self.test_attach_shard_and_rebalance.__doc__)
+        ENGINE.attach_shard(NEW_SHARD_PATH)
+        paths = SHARD_PATHS + [NEW_SHARD_PATH]
+        self.assertEqual(shard_sizes(paths)[2], 0)
+        self.assertTrue(ENGINE.rebalance() > 0)
+        sizes = shard_sizes(paths)
+        self.assertTrue(all(sizes))
+        self.assertEqual(sum(sizes), INITIAL_SIZE)
+        self.assertEqual(ENGINE.rebalance(), 0)
+        self.assertEqual(len(self.connection.get_thread('msg-1')), 12)
+        self.assertEqual(len(self.connection.get_messages()), INITIAL_SIZE)
+
+    def test_clear(self):
+        '''
+        Checks that clear empties the shards but keeps the shard registry.
+        '''
+        print('('+self.test_clear.__name__+')', \
+                  self.test_clear.__doc__)
+        ENGINE.clear(fast=True)
+        self.assertEqual(shard_sizes(SHARD_PATHS), [0, 0])
+        self.assertEqual(len(ENGINE.get_shards()), 2)
+        self.assertEqual(self.connection.get_messages(), [])
+        self.assertIsNotNone(self.connection.create_message('a', 'b'))
+
+    def test_time_strategy(self):
+        '''
+        Checks that with the time strategy the messages are stored by
+        timestamp and the shards out of range are not queried.
+        '''
+        print('('+self.test_time_strategy.__name__+')', \
+                  self.test_time_strategy.__doc__)
+        engine = sharding.ShardedEngine(DB_PATH,
+                                        [(SHARD_PATHS[0], 0),
+                                         (SHARD_PATHS[1],
+                                          DUMP_TIMESTAMP + 1)],
+                                        sharding.TIME_STRATEGY)
+        self.connection.close()
+        engine.remove_database()
+        engine.create_tables()
+        engine.populate_tables()
+        self.connection = engine.connect()
+        self.assertEqual(shard_sizes(SHARD_PATHS), [INITIAL_SIZE, 0])
+        messageid = self.connection.create_message('new title', 'new body')
+        self.assertEqual(shard_sizes(SHARD_PATHS), [INITIAL_SIZE, 1])
+        messages = self.connection.get_messages(after=DUMP_TIMESTAMP)
+        self.assertEqual([m['messageid'] for m in messages], [messageid])
+        self.assertEqual(len(self.connection.get_messages(
+                             before=DUMP_TIMESTAMP + 1)), INITIAL_SIZE)
+        with self.assertRaises(ValueError):
+            engine.attach_shard(NEW_SHARD_PATH)
+
+if __name__ == '__main__':
+    print('Start running sharding tests')
+    unittest.main()
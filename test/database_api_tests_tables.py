@@ -6,13 +6,40 @@ Database interface testing to check tables has been created correctly.
 @author: ivan
 '''
 
-import sqlite3, unittest, collections
+import sqlite3, unittest, collections, os, re, csv, json, pickle, threading, \
+       time, shutil, gc
 
-from forum import database
+from forum import database, queryplan
 
 #Path to the database file, different from the deployment db
 DB_PATH = 'db/forum_test.db'
 ENGINE = database.Engine(DB_PATH)
+#Path to the snapshot created in the backup tests
+BACKUP_PATH = 'db/forum_test_backup.db'
+#Prefix of the data files created in the bulk load tests
+BULK_PATH = 'db/forum_test_bulk'
+#Path where the memory database is persisted
+MEMORY_PATH = 'db/forum_test_memory.db'
+#Paths of the read replicas
+REPLICA_PATHS = ['db/forum_test_replica1.db', 'db/forum_test_replica2.db']
+#Directory of the migration scripts
+MIGRATIONS_PATH = 'db/forum_test_migrations'
+MIGRATION_SCRIPTS = {
+    '0101_create_tags.sql': '''
+CREATE TABLE IF NOT EXISTS tags(message_id INTEGER PRIMARY KEY, tag TEXT);
+''',
+    '0102_backfill_tags.sql': '''
+/* Tag every message with the nickname of the sender */
+-- batch
+INSERT INTO tags(message_id, tag)
+SELECT message_id, user_nickname FROM messages
+WHERE message_id NOT IN (SELECT message_id FROM tags)
+LIMIT :batch_size;
+CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag);
+''',
+    'README': 'Not a migration'}
+#Copy of the deployment db upgraded by the migration tests
+UPGRADE_PATH = 'db/forum_test_upgrade.db'
 
 INITIAL_SIZE = 20
 
@@ -32,21 +59,25 @@ class CreatedTablesTestCase(unittest.TestCase):
         '''
         print("Testing ", cls.__name__)
         ENGINE.remove_database()
-        ENGINE.create_tables()
+        #Creates and populates the database structure only once. Each test
+        #starts from a copy of this template.
+        ENGINE.create_template()
 
     @classmethod
     def tearDownClass(cls):
         '''Remove the testing database'''
         print("Testing ENDED for ", cls.__name__)
         ENGINE.remove_database()
+        ENGINE.remove_template()
 
     def setUp(self):
         '''
         Populates the database
         '''
         try:
-          #This method load the initial values from forum_data_dump.sql
-          ENGINE.populate_tables()
+          #Copies the template with the initial values from
+          #forum_data_dump.sql
+          ENGINE.clone_template()
           #Creates a Connection instance to use the API
           self.connection = ENGINE.connect()
         except Exception as e: 
@@ -55,10 +86,10 @@ class CreatedTablesTestCase(unittest.TestCase):
 
     def tearDown(self):
         '''
-        Close underlying connection and remove all records from database
+        Close underlying connection. The next test starts from a new copy of
+        the template.
         '''
         self.connection.close()
-        ENGINE.clear()
 
     def test_messages_table_schema(self):
         '''
@@ -123,7 +154,687 @@ class CreatedTablesTestCase(unittest.TestCase):
             #Assert
             self.assertEqual(len(users), INITIAL_SIZE)
 
-    
+    def test_user_stats_table_created(self):
+        '''
+        Checks that the user_stats table matches the messages loaded from
+        forum_data_dump.sql.
+
+        NOTE: Do not use Connection instance but
+        call directly SQL.
+        '''
+        print('('+self.test_user_stats_table_created.__name__+')', \
+                  self.test_user_stats_table_created.__doc__)
+        query1 = 'SELECT user_id, message_count, last_post FROM user_stats \
+                  WHERE message_count > 0 ORDER BY user_id'
+        query2 = 'SELECT user_id, COUNT(*), MAX(timestamp) FROM messages \
+                  WHERE user_id IS NOT NULL GROUP BY user_id ORDER BY user_id'
+        con = self.connection.con
+        with con:
+            cur = con.cursor()
+            cur.execute(query1)
+            stats = cur.fetchall()
+            cur.execute(query2)
+            self.assertEqual(stats, cur.fetchall())
+
+    def test_create_tables_programmatically(self):
+        '''
+        Checks that create_user_stats_table and create_threads_table create
+        the triggers of the schema file, so that archiving the messages of a
+        database built by them does not modify the statistics.
+
+        NOTE: Do not use Connection instance but
+        call directly SQL.
+        '''
+        print('('+self.test_create_tables_programmatically.__name__+')', \
+                  self.test_create_tables_programmatically.__doc__)
+        triggers = 'SELECT name, sql FROM sqlite_master \
+                    WHERE type = \'trigger\' AND (name LIKE \'user_stats_%\' \
+                    OR name LIKE \'threads_%\') ORDER BY name'
+        stats = ['SELECT * FROM user_stats ORDER BY user_id',
+                 'SELECT * FROM threads ORDER BY root_id',
+                 'SELECT * FROM thread_participants \
+                  ORDER BY root_id, nickname',
+                 'SELECT * FROM message_threads ORDER BY message_id']
+        self.connection.close()
+        con = sqlite3.connect(DB_PATH)
+        try:
+            cur = con.cursor()
+            cur.execute(triggers)
+            expected_triggers = cur.fetchall()
+            expected = [cur.execute(query).fetchall() for query in stats]
+            cur.execute('SELECT MAX(timestamp) FROM messages')
+            cutoff = cur.fetchone()[0] + 1
+            for name, _ in expected_triggers:
+                cur.execute('DROP TRIGGER %s' % name)
+            for table in ('user_stats', 'threads', 'thread_participants',
+                          'message_threads'):
+                cur.execute('DROP TABLE %s' % table)
+            con.commit()
+        finally:
+            con.close()
+        self.assertTrue(ENGINE.create_user_stats_table())
+        self.assertTrue(ENGINE.create_threads_table())
+        con = sqlite3.connect(DB_PATH)
+        try:
+            cur = con.cursor()
+            cur.execute(triggers)
+            self.assertEqual(cur.fetchall(), expected_triggers)
+            self.assertEqual([cur.execute(query).fetchall()
+                              for query in stats], expected)
+            con.close()
+            ENGINE.archive_messages(cutoff)
+            con = sqlite3.connect(DB_PATH)
+            cur = con.cursor()
+            cur.execute('SELECT COUNT(*) FROM messages')
+            self.assertEqual(cur.fetchone()[0], 0)
+            self.assertEqual([cur.execute(query).fetchall()
+                              for query in stats], expected)
+        finally:
+            con.close()
+        self.connection = ENGINE.connect()
+
+    def test_backup_and_restore(self):
+        '''
+        Checks that a snapshot created with backup is valid and that restore
+        brings back the deleted messages.
+        '''
+        print('('+self.test_backup_and_restore.__name__+')', \
+                  self.test_backup_and_restore.__doc__)
+        steps = []
+        try:
+            ENGINE.backup(BACKUP_PATH, pages_per_step=1, sleep=0,
+                          progress=lambda *args: steps.append(args))
+            self.assertTrue(steps)
+            self.assertTrue(ENGINE.verify_backup(BACKUP_PATH))
+            self.connection.delete_message('msg-1')
+            self.assertIsNone(self.connection.get_message('msg-1'))
+            #The open connections see the restored database
+            self.assertTrue(ENGINE.restore(BACKUP_PATH))
+            self.assertIsNotNone(self.connection.get_message('msg-1'))
+            self.assertFalse([name for name in os.listdir('db')
+                              if name.startswith('forum_test.db-')])
+        finally:
+            if os.path.exists(BACKUP_PATH):
+                os.remove(BACKUP_PATH)
+        self.assertFalse(ENGINE.verify_backup(BACKUP_PATH))
+        self.assertFalse(ENGINE.restore(BACKUP_PATH))
+
+    def test_bulk_load(self):
+        '''
+        Checks that bulk_load loads CSV, JSON Lines and binary files and
+        rebuilds the indexes of the loaded table.
+        '''
+        print('('+self.test_bulk_load.__name__+')', \
+                  self.test_bulk_load.__doc__)
+        con = self.connection.con
+        cur = con.cursor()
+        cur.execute('SELECT * FROM users')
+        users = cur.fetchall()
+        cur.execute('SELECT * FROM users_profile')
+        profiles = cur.fetchall()
+        cur.execute('SELECT * FROM messages')
+        messages = cur.fetchall()
+        message_columns = [d[0] for d in cur.description]
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' \
+                     AND tbl_name = 'messages' ORDER BY name")
+        indexes = cur.fetchall()
+        self.connection.close()
+        ENGINE.clear()
+        #A user_id cached before users is loaded is not used after it
+        connection = ENGINE.connect()
+        ENGINE.user_ids.put('Mystery', 100)
+        self.assertEqual(connection.get_user_id('Mystery'), 100)
+        paths = [BULK_PATH + ext for ext in ('.csv', '.jsonl', '.bin')]
+        try:
+            with open(paths[0], 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(['user_id', 'nickname', 'regDate',
+                                 'lastLogin', 'timesviewed'])
+                writer.writerows(users)
+            with open(paths[1], 'wb') as f:
+                for profile in profiles:
+                    f.write(json.dumps({'user_id': profile[0],
+                                        'firstname': profile[1],
+                                        'email': profile[3]}) + '\n')
+            with open(paths[2], 'wb') as f:
+                pickle.dump(message_columns, f)
+                pickle.dump(messages[:10], f)
+                pickle.dump(messages[10:], f)
+            stats = ENGINE.bulk_load('users', paths[0], batch_size=2)
+            self.assertEqual(stats['rows'], len(users))
+            self.assertGreater(stats['rows_per_second'], 0)
+            self.assertEqual(connection.get_user_id('Mystery'), 1)
+            connection.close()
+            stats = ENGINE.bulk_load('users_profile', paths[1])
+            self.assertEqual(stats['rows'], len(profiles))
+            stats = ENGINE.bulk_load('messages', paths[2])
+            self.assertEqual(stats['rows'], INITIAL_SIZE)
+            self.assertEqual(stats['foreign_key_errors'], 0)
+            with self.assertRaises(ValueError):
+                ENGINE.bulk_load('messages', paths[0])
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.connection = ENGINE.connect()
+        cur = self.connection.con.cursor()
+        cur.execute('SELECT * FROM users')
+        self.assertEqual(cur.fetchall(), users)
+        cur.execute('SELECT * FROM messages')
+        self.assertEqual(cur.fetchall(), messages)
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' \
+                     AND tbl_name = 'messages' ORDER BY name")
+        self.assertEqual(cur.fetchall(), indexes)
+        self.assertEqual(self.connection.get_user('Mystery')
+                         ['restricted_profile']['email'],
+                         'jane@imaginecompany.com')
+
+    def test_export(self):
+        '''
+        Checks that export writes all the rows and that incremental exports
+        only write the rows after the watermark.
+        '''
+        print('('+self.test_export.__name__+')', \
+                  self.test_export.__doc__)
+        paths = [BULK_PATH + ext for ext in ('.jsonl', '.csv', '.bin')]
+        try:
+            result = ENGINE.export('messages_users', paths[0], chunk_size=3)
+            self.assertEqual(result['rows'], INITIAL_SIZE)
+            self.assertEqual(result['watermark'], INITIAL_SIZE)
+            with open(paths[0]) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(len(lines), INITIAL_SIZE)
+            self.assertEqual(lines[0]['user_nickname'], 'AxelW')
+            self.assertEqual(lines[0]['regDate'], 1357724086)
+            #Incremental export
+            self.connection.create_message('new title', 'new body', 'AxelW')
+            result = ENGINE.export('messages', paths[1], since=INITIAL_SIZE)
+            self.assertEqual(result['rows'], 1)
+            self.assertEqual(result['watermark'], INITIAL_SIZE + 1)
+            result = ENGINE.export('messages', paths[1],
+                                   since=result['watermark'])
+            self.assertEqual(result['rows'], 0)
+            #Exported files can be loaded again
+            result = ENGINE.export('users', paths[2])
+            self.assertEqual(result['rows'], 5)
+            with self.assertRaises(ValueError):
+                ENGINE.export('users', paths[2], watermark='nickname')
+            self.connection.close()
+            ENGINE.clear()
+            self.assertEqual(ENGINE.bulk_load('users', paths[2])['rows'], 5)
+            self.connection = ENGINE.connect()
+            self.assertEqual(self.connection.get_user_id('HockeyFan'), 5)
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_fast_clear(self):
+        '''
+        Checks that clear with fast=True empties all the tables and keeps
+        the triggers working.
+        '''
+        print('('+self.test_fast_clear.__name__+')', \
+                  self.test_fast_clear.__doc__)
+        con = self.connection.con
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' \
+                     ORDER BY name")
+        triggers = cur.fetchall()
+        self.connection.close()
+        ENGINE.clear(fast=True)
+        self.connection = ENGINE.connect()
+        cur = self.connection.con.cursor()
+        for table in ('messages', 'users', 'users_profile', 'friends',
+                      'user_stats', 'threads', 'message_threads'):
+            cur.execute('SELECT COUNT(*) FROM %s' % table)
+            self.assertEqual(cur.fetchone()[0], 0)
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' \
+                     ORDER BY name")
+        self.assertEqual(cur.fetchall(), triggers)
+        self.connection.create_message('new title', 'new body')
+        threads, cursor = self.connection.get_threads()
+        self.assertEqual(len(threads), 1)
+
+    def test_compact_changelog(self):
+        '''
+        Checks that the compaction keeps the newest change of each row and
+        that consumers are asked to read again after deletes are purged.
+        '''
+        print('('+self.test_compact_changelog.__name__+')', \
+                  self.test_compact_changelog.__doc__)
+        self.connection.delete_user('Mystery')
+        changes = self.connection.read_changes(0, 1000)
+        last = changes[-1]['seq']
+        rows = set((c['table'], c.get('messageid'), c.get('userid'),
+                    c.get('friendid')) for c in changes)
+        removed = ENGINE.compact_changelog(last)
+        self.assertEqual(removed, len(changes) - len(rows))
+        compacted = self.connection.read_changes(0, 1000)
+        self.assertEqual(len(compacted), len(rows))
+        self.assertEqual(compacted[-1], changes[-1])
+        deletes = [c for c in compacted if c['operation'] == 'delete']
+        self.assertTrue(deletes)
+        self.assertEqual(ENGINE.compact_changelog(last, drop_deletes=True),
+                         len(deletes))
+        self.assertIsNone(self.connection.read_changes(0))
+        self.assertEqual(self.connection.read_changes(last), [])
+        #The sequence never goes back
+        self.connection.create_message('new title', 'new body')
+        self.assertGreater(self.connection.read_changes(last)[0]['seq'], last)
+
+    def test_memory_engine(self):
+        '''
+        Checks that a MemoryEngine seeded from the test database is shared by
+        its connections and persisted when it is closed.
+        '''
+        print('('+self.test_memory_engine.__name__+')', \
+                  self.test_memory_engine.__doc__)
+        engine = database.MemoryEngine(source=DB_PATH,
+                                       persist_path=MEMORY_PATH,
+                                       persist_interval=0.01)
+        try:
+            con1 = engine.connect()
+            con2 = engine.connect()
+            self.assertEqual(len(con1.get_messages()), INITIAL_SIZE)
+            messageid = con1.create_message('new title', 'new body', 'AxelW')
+            self.assertIsNotNone(con2.get_message(messageid))
+            self.assertEqual(con2.get_user_stats('AxelW')['messages'], 3)
+            con1.close()
+            con2.close()
+            #The file of the seed is not modified
+            self.assertEqual(len(self.connection.get_messages()),
+                             INITIAL_SIZE)
+            engine.close()
+            self.assertTrue(engine.verify_backup(MEMORY_PATH))
+            persisted = database.Engine(MEMORY_PATH).connect()
+            self.assertEqual(len(persisted.get_messages()), INITIAL_SIZE + 1)
+            persisted.close()
+        finally:
+            engine.close()
+            if os.path.exists(MEMORY_PATH):
+                os.remove(MEMORY_PATH)
+
+    def test_memory_engine_from_scripts(self):
+        '''
+        Checks that a MemoryEngine can be created and populated from the
+        .sql scripts and cloned from a template.
+        '''
+        print('('+self.test_memory_engine_from_scripts.__name__+')', \
+                  self.test_memory_engine_from_scripts.__doc__)
+        engine = database.MemoryEngine()
+        try:
+            engine.create_tables()
+            engine.populate_tables()
+            con = engine.connect()
+            self.assertEqual(len(con.get_messages()), INITIAL_SIZE)
+            con.delete_message('msg-1')
+            con.close()
+            engine.clone_template(ENGINE.create_template())
+            con = engine.connect()
+            self.assertEqual(len(con.get_messages()), INITIAL_SIZE)
+            con.close()
+            engine.remove_database()
+            con = engine.connect()
+            with self.assertRaises(sqlite3.Error):
+                con.get_messages()
+            con.close()
+        finally:
+            engine.close()
+
+    def test_read_replicas(self):
+        '''
+        Checks that reads are sent to the replicas, writes to the primary
+        and that read_your_writes connections see their own writes.
+        '''
+        print('('+self.test_read_replicas.__name__+')', \
+                  self.test_read_replicas.__doc__)
+        engine = database.Engine(DB_PATH, replicas=REPLICA_PATHS)
+        try:
+            staleness = engine.replica_staleness()
+            self.assertIsNone(staleness[REPLICA_PATHS[0]]['age'])
+            engine.refresh_replicas()
+            staleness = engine.replica_staleness()
+            self.assertEqual(staleness[REPLICA_PATHS[1]]['refreshes'], 1)
+            self.assertGreaterEqual(staleness[REPLICA_PATHS[1]]['age'], 0)
+            writer = engine.connect(read_your_writes=True)
+            reader = engine.connect()
+            messageid = writer.create_message('new title', 'new body')
+            self.assertIsNotNone(writer.get_message(messageid))
+            self.assertIsNone(reader.get_message(messageid))
+            engine.refresh_replicas()
+            self.assertIsNotNone(reader.get_message(messageid))
+            self.assertEqual(len(reader.get_messages()), INITIAL_SIZE + 1)
+            #The users read from a stale replica are not cached
+            self.assertTrue(writer.delete_user('Mystery'))
+            self.assertIsNotNone(reader.get_user_id('Mystery'))
+            self.assertIsNotNone(reader.get_user('Mystery'))
+            messageid = reader.create_message('new title', 'new body',
+                                              'Mystery')
+            self.assertIsNotNone(messageid)
+            self.assertIsNone(writer.get_user_id('Mystery'))
+            writer.close()
+            reader.close()
+        finally:
+            for path in REPLICA_PATHS:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_thread_connections(self):
+        '''
+        Checks that each thread gets its own Connection, which is reused by
+        the thread and closed when the thread exits.
+        '''
+        print('('+self.test_thread_connections.__name__+')', \
+                  self.test_thread_connections.__doc__)
+        engine = database.Engine(DB_PATH)
+        connection = engine.thread_connection()
+        self.assertIs(engine.thread_connection(), connection)
+        self.assertEqual(engine.live_connections(), 1)
+        results = []
+        ready = threading.Event()
+        done = threading.Event()
+
+        def worker():
+            con = engine.thread_connection()
+            results.append((con, len(con.get_messages())))
+            ready.set()
+            done.wait()
+        threads = [threading.Thread(target=worker) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+            ready.wait()
+            ready.clear()
+        self.assertEqual(engine.live_connections(), 4)
+        self.assertEqual(len(set(con for con, _ in results)), 3)
+        self.assertNotIn(connection, [con for con, _ in results])
+        self.assertEqual([size for _, size in results], [INITIAL_SIZE] * 3)
+        done.set()
+        for thread in threads:
+            thread.join()
+        #The thread state is released after join returns
+        deadline = time.time() + 5
+        while engine.live_connections() > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(engine.live_connections(), 1)
+        engine.close_thread_connection()
+        self.assertEqual(engine.live_connections(), 0)
+        self.assertIsNot(engine.thread_connection(), connection)
+        engine.close_thread_connection()
+        #An engine dropped with live thread connections leaves no garbage
+        dropped = database.Engine(DB_PATH)
+        dropped.thread_connection()
+        del dropped
+        gc.collect()
+        self.assertEqual(gc.garbage, [])
+
+    def test_metrics(self):
+        '''
+        Checks that the calls to the Connection methods of every thread are
+        recorded and exported.
+        '''
+        print('('+self.test_metrics.__name__+')', \
+                  self.test_metrics.__doc__)
+        engine = database.Engine(DB_PATH)
+        connection = engine.connect()
+        connection.get_messages()
+        connection.get_message('msg-1')
+        with self.assertRaises(ValueError):
+            connection.get_message('1')
+        #Only the outermost call is recorded
+        connection.append_answer('msg-1', 'title', 'body', 'AxelW')
+        thread = threading.Thread(
+            target=lambda: engine.thread_connection().get_user('AxelW'))
+        thread.start()
+        thread.join()
+        connection.close()
+        #The counters of the thread are kept after the thread exits
+        deadline = time.time() + 5
+        while len(engine.metrics._counters) > 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(engine.metrics._counters), 1)
+        snapshot = engine.metrics.snapshot()
+        operations = snapshot['operations']
+        self.assertEqual(operations['get_messages']['calls'], 1)
+        self.assertEqual(operations['get_messages']['rows'], INITIAL_SIZE)
+        self.assertEqual(operations['get_message']['calls'], 2)
+        self.assertEqual(operations['get_message']['errors'], 1)
+        self.assertEqual(operations['get_message']['rows'], 1)
+        self.assertEqual(operations['append_answer']['calls'], 1)
+        self.assertNotIn('create_message', operations)
+        self.assertEqual(operations['get_user']['calls'], 1)
+        latency = operations['get_message']['latency']
+        self.assertEqual(latency[-1], (float('inf'), 2))
+        self.assertEqual(len(latency),
+                         len(database.DEFAULT_LATENCY_BUCKETS) + 1)
+        self.assertEqual(snapshot['gauges']['user_id_cache_hits_total'], 1)
+        text = engine.metrics.prometheus()
+        self.assertIn('forum_db_calls_total{operation="get_messages"} 1\n',
+                      text)
+        self.assertIn('# TYPE forum_db_latency_seconds histogram\n', text)
+        self.assertIn('forum_db_latency_seconds_bucket{operation="get_message"'
+                      ',le="+Inf"} 2\n', text)
+        self.assertIn('# TYPE forum_db_user_id_cache_hits_total counter\n',
+                      text)
+        #The gauges of another Engine would replace the ones of this Engine
+        with self.assertRaises(ValueError):
+            database.Engine(DB_PATH, metrics=engine.metrics)
+
+    def test_query_plans(self):
+        '''
+        Checks that no statement of the Connection methods scans messages or
+        users unexpectedly.
+        '''
+        print('('+self.test_query_plans.__name__+')', \
+                  self.test_query_plans.__doc__)
+        report = queryplan.check(DB_PATH)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual([(s['operation'], s['sql'], s['plan'])
+                          for s in report['statements'] if not s['expected']],
+                         [])
+        self.assertEqual(report['unexpected_scans'], 0)
+        self.assertEqual(report['failed_statements'], 0)
+        operations = set(s['operation'] for s in report['statements'])
+        triggers = set(operation for operation in operations
+                       if operation.startswith(queryplan.TRIGGER_OPERATION))
+        self.assertEqual(operations - triggers,
+                         set(name for name, _ in queryplan.WORKLOAD))
+        #The statements run by the triggers of the mutators are explained
+        self.assertIn(queryplan.TRIGGER_OPERATION + 'threads_message_delete',
+                      triggers)
+        #A database created before the migrations is upgraded in the copy
+        report = queryplan.check(database.DEFAULT_DB_PATH)
+        self.assertEqual(report['errors'], {})
+        self.assertEqual(report['failed_statements'], 0)
+        #The listings are answered from covering indexes
+        for statement in report['statements']:
+            if statement['operation'] not in ('get_messages',
+                                              'get_messages_by_nickname',
+                                              'get_messages_limit') \
+               and not statement['operation'].startswith('get_users'):
+                continue
+            for detail in statement['plan']:
+                if re.match(r'(SCAN|SEARCH) (messages|users)\b', detail):
+                    self.assertIn('COVERING INDEX', detail)
+        #The database is not modified
+        self.assertIsNotNone(self.connection.get_message('msg-4'))
+        plan, scans = queryplan.explain(self.connection.con,
+                                        'SELECT * FROM users WHERE lastLogin = ?',
+                                        (0,))
+        self.assertEqual(scans, ['users'])
+
+    def test_migrations(self):
+        '''
+        Checks that the migrations are applied in order, once, and that the
+        batched statements process all the rows.
+        '''
+        print('('+self.test_migrations.__name__+')', \
+                  self.test_migrations.__doc__)
+        #The migrations of db/migrations are in the schema file
+        applied = ENGINE.applied_migrations()
+        self.assertEqual(sorted(applied),
+                         [version for version, _, _ in ENGINE.migrations()])
+        os.mkdir(MIGRATIONS_PATH)
+        try:
+            for filename, script in MIGRATION_SCRIPTS.items():
+                with open(os.path.join(MIGRATIONS_PATH, filename), 'w') as f:
+                    f.write(script)
+            self.assertEqual([(v, n) for v, n, _ in
+                              ENGINE.migrations(MIGRATIONS_PATH)],
+                             [(101, 'create_tags'), (102, 'backfill_tags')])
+            pending = ENGINE.migrate(MIGRATIONS_PATH, dry_run=True)
+            self.assertEqual(pending, [(101, 'create_tags'),
+                                       (102, 'backfill_tags')])
+            cur = self.connection.con.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE name = 'tags'")
+            self.assertIsNone(cur.fetchone())
+            self.assertEqual(ENGINE.migrate(MIGRATIONS_PATH, target=101),
+                             [(101, 'create_tags')])
+            self.assertEqual(ENGINE.migrate(MIGRATIONS_PATH, batch_size=3),
+                             [(102, 'backfill_tags')])
+            self.assertEqual(ENGINE.migrate(MIGRATIONS_PATH), [])
+            cur.execute('SELECT COUNT(*) FROM tags')
+            self.assertEqual(cur.fetchone()[0], INITIAL_SIZE)
+            cur.execute("SELECT name FROM sqlite_master \
+                         WHERE name = 'tags_tag'")
+            self.assertIsNotNone(cur.fetchone())
+            #An applied migration cannot be modified
+            with open(os.path.join(MIGRATIONS_PATH, '0101_create_tags.sql'),
+                      'a') as f:
+                f.write('SELECT 1;')
+            with self.assertRaises(ValueError):
+                ENGINE.migrate(MIGRATIONS_PATH)
+            #The migrations table survives a fast clear
+            ENGINE.clear(fast=True)
+            self.assertIn(102, ENGINE.applied_migrations())
+        finally:
+            for filename in os.listdir(MIGRATIONS_PATH):
+                os.remove(os.path.join(MIGRATIONS_PATH, filename))
+            os.rmdir(MIGRATIONS_PATH)
+
+    def test_upgrade_deployment_database(self):
+        '''
+        Checks that the migrations upgrade a database created before them,
+        filling the statistics and thread summaries, and that the API works
+        on the upgraded database.
+        '''
+        print('('+self.test_upgrade_deployment_database.__name__+')', \
+                  self.test_upgrade_deployment_database.__doc__)
+        shutil.copy(database.DEFAULT_DB_PATH, UPGRADE_PATH)
+        engine = database.Engine(UPGRADE_PATH)
+        #The baseline fills the summaries and creates their triggers in one
+        #transaction, so no write falls between them
+        with open(engine.migrations()[0][2]) as f:
+            statements = engine._split_migration(f.read())
+        self.assertFalse([batched for batched, _ in statements if batched])
+        try:
+            versions = [(version, name) for version, name, _ in
+                        engine.migrations()]
+            self.assertEqual(engine.migrate(target=7, batch_size=2),
+                             versions[:-1])
+            #Log before 0008 the changes of a user whose id is then reused
+            con = sqlite3.connect(UPGRADE_PATH)
+            try:
+                with con:
+                    cur = con.cursor()
+                    cur.execute('PRAGMA foreign_keys = ON')
+                    cur.execute('SELECT MAX(user_id) FROM users')
+                    reused = cur.fetchone()[0]
+                    cur.execute('DELETE FROM users WHERE user_id = ?',
+                                (reused,))
+                    cur.execute("INSERT INTO users(user_id, nickname) \
+                                 VALUES(?, 'sully')", (reused,))
+                    cur.execute('SELECT MAX(seq) FROM changelog')
+                    reinserted = cur.fetchone()[0]
+                    cur.execute('INSERT INTO users_profile(user_id) \
+                                 VALUES(?)', (reused,))
+                    cur.execute('INSERT INTO friends(user_id, friend_id) \
+                                 VALUES(?, 1)', (reused,))
+            finally:
+                con.close()
+            self.assertEqual(engine.migrate(batch_size=2), versions[-1:])
+            connection = engine.connect()
+            try:
+                cur = connection.con.cursor()
+                cur.execute('SELECT COUNT(*), COUNT(user_id), \
+                                    COUNT(*) - COUNT(reply_to) FROM messages')
+                count, with_user, roots = cur.fetchone()
+                cur.execute('SELECT SUM(message_count) FROM user_stats')
+                self.assertEqual(cur.fetchone()[0], with_user)
+                cur.execute('SELECT COUNT(*), SUM(reply_count) FROM threads')
+                self.assertEqual(cur.fetchone(), (roots, count - roots))
+                #The changes logged before 0008 get the nicknames
+                cur.execute("SELECT COUNT(*) FROM changelog \
+                             WHERE table_name != 'messages' AND row_id != ? \
+                             AND (nickname IS NULL OR (table_name = 'friends' \
+                                  AND friend_nickname IS NULL))", (reused,))
+                self.assertEqual(cur.fetchone()[0], 0)
+                #but only when they follow the insert of the current user
+                #with that id
+                cur.execute("SELECT seq >= ?, nickname, friend_nickname \
+                             FROM changelog WHERE table_name != 'messages' \
+                             AND row_id = ? ORDER BY seq", (reinserted, reused))
+                changes = cur.fetchall()
+                self.assertTrue([change for change in changes
+                                 if not change[0]])
+                self.assertEqual(set(change[1:] for change in changes
+                                     if not change[0]), set([(None, None)]))
+                self.assertEqual([change[1:] for change in changes
+                                  if change[0]],
+                                 [('sully', None), ('sully', None),
+                                  ('sully', 'Mystery')])
+                #The API works on the upgraded database
+                self.assertEqual(len(connection.get_messages()), count)
+                threads, _ = connection.get_threads(count)
+                self.assertEqual(len(threads), roots)
+                self.assertEqual(connection.get_user_stats('AxelW')['messages'],
+                                 len(connection.get_messages('AxelW')))
+                self.assertEqual(connection.modify_message(
+                                     'msg-1', 'new title', 'new body'),
+                                 'msg-1')
+                self.assertEqual(connection.modify_user(
+                                     'AxelW', connection.get_user('AxelW')),
+                                 'AxelW')
+                messageid = connection.append_answer('msg-1', 'title',
+                                                     'x' * 2000, 'AxelW')
+                self.assertEqual(connection.get_message(messageid)['body'],
+                                 'x' * 2000)
+                self.assertEqual(connection.get_threads(count)[0][0]
+                                 ['messageid'], 'msg-1')
+                self.assertTrue(connection.read_changes())
+            finally:
+                connection.close()
+        finally:
+            engine.remove_database()
+
+    def test_connect_upgrades_database(self):
+        '''
+        Checks that connect applies the pending migrations of a database
+        created before them, unless auto_migrate is False.
+        '''
+        print('('+self.test_connect_upgrades_database.__name__+')', \
+                  self.test_connect_upgrades_database.__doc__)
+        shutil.copy(database.DEFAULT_DB_PATH, UPGRADE_PATH)
+        engine = database.Engine(UPGRADE_PATH, auto_migrate=False)
+        try:
+            connection = engine.connect()
+            with self.assertRaises(sqlite3.OperationalError):
+                connection.get_message('msg-1')
+            connection.close()
+            engine = database.Engine(UPGRADE_PATH)
+            connection = engine.connect()
+            try:
+                self.assertEqual(sorted(engine.applied_migrations()),
+                                 [version for version, _, _ in
+                                  engine.migrations()])
+                self.assertIsNotNone(connection.get_message('msg-1'))
+                self.assertEqual(connection.modify_message(
+                                     'msg-1', 'new title', 'new body'),
+                                 'msg-1')
+            finally:
+                connection.close()
+        finally:
+            engine.remove_database()
 
 if __name__ == '__main__':
     print('Start running database tests')
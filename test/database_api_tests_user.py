@@ -109,21 +109,25 @@ class UserDBAPITestCase(unittest.TestCase):
         '''
         print("Testing ", cls.__name__)
         ENGINE.remove_database()
-        ENGINE.create_tables()
+        #Creates and populates the database structure only once. Each test
+        #starts from a copy of this template.
+        ENGINE.create_template()
 
     @classmethod
     def tearDownClass(cls):
         '''Remove the testing database'''
         print("Testing ENDED for ", cls.__name__)
         ENGINE.remove_database()
+        ENGINE.remove_template()
 
     def setUp(self):
         '''
         Populates the database
         '''
         try:
-          #This method load the initial values from forum_data_dump.sql
-          ENGINE.populate_tables()
+          #Copies the template with the initial values from
+          #forum_data_dump.sql
+          ENGINE.clone_template()
           #Creates a Connection instance to use the API
           self.connection = ENGINE.connect()
         except Exception as e: 
@@ -133,10 +137,10 @@ class UserDBAPITestCase(unittest.TestCase):
 
     def tearDown(self):
         '''
-        Close underlying connection and remove all records from database
+        Close underlying connection. The next test starts from a new copy of
+        the template.
         '''
         self.connection.close()
-        ENGINE.clear()
 
     def test_users_table_created(self):
         '''
@@ -244,6 +248,57 @@ class UserDBAPITestCase(unittest.TestCase):
             elif user['nickname'] == USER2_NICKNAME:
                 self.assertDictContainsSubset(user, USER2['public_profile'])
 
+    def test_get_users_page(self):
+        '''
+        Test that get_users_page paginates the users by nickname and by
+        registration date and searches nickname prefixes
+        '''
+        print('('+self.test_get_users_page.__name__+')', \
+              self.test_get_users_page.__doc__)
+        nicknames = []
+        cursor = None
+        while True:
+            users, cursor = self.connection.get_users_page(2, cursor)
+            self.assertLessEqual(len(users), 2)
+            nicknames.extend(user['nickname'] for user in users)
+            if cursor is None:
+                break
+        self.assertEqual(nicknames, sorted((user['nickname'] for user in
+                                            self.connection.get_users()),
+                                           key=lambda n: n.lower()))
+        #Most recent first
+        users, cursor = self.connection.get_users_page(
+            3, order='registrationdate')
+        self.assertEqual(users[0]['nickname'], USER2_NICKNAME)
+        dates = [user['registrationdate'] for user in users]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+        users, cursor = self.connection.get_users_page(
+            3, cursor, 'registrationdate')
+        self.assertEqual(len(users), INITIAL_SIZE - 3)
+        self.assertIsNone(cursor)
+        #Prefix search, case insensitive
+        users, cursor = self.connection.get_users_page(prefix='hOCK')
+        self.assertEqual(users, [{'nickname': USER2_NICKNAME,
+                                  'registrationdate': USER2['public_profile']
+                                                      ['registrationdate']}])
+        self.assertEqual(self.connection.get_users_page(prefix='zz'),
+                         ([], None))
+        #Characters which sort near the folded letters and non-ASCII
+        #prefixes given as byte strings
+        for nickname in ('_under', '@home', u'j\xf6rg', 'jo%'):
+            self.connection.append_user(nickname, NEW_USER)
+        for prefix, nicknames in (('@', ['@home']), ('_', ['_under']),
+                                  ('j\xc3\xb6', [u'j\xf6rg']),
+                                  ('J', ['jo%', u'j\xf6rg']),
+                                  ('jo%', ['jo%']), ('jo_', [])):
+            users, cursor = self.connection.get_users_page(prefix=prefix)
+            self.assertEqual([user['nickname'] for user in users], nicknames)
+        with self.assertRaises(ValueError):
+            self.connection.get_users_page(order='age')
+        with self.assertRaises(ValueError):
+            self.connection.get_users_page(cursor='Mystery',
+                                           order='registrationdate')
+
     def test_delete_user(self):
         '''
         Test that the user Mystery is deleted
@@ -259,6 +314,29 @@ class UserDBAPITestCase(unittest.TestCase):
         resp3 = self.connection.get_messages(nickname=USER1_NICKNAME)
         self.assertEqual(len(resp3), 0)
 
+    def test_delete_user_changes(self):
+        '''
+        Test that the changes logged when Mystery is deleted include the
+        nicknames, also for the profile and friends deleted in cascade
+        '''
+        print('('+self.test_delete_user_changes.__name__+')', \
+              self.test_delete_user_changes.__doc__)
+        last = self.connection.read_changes(0, 1000)[-1]['seq']
+        self.connection.delete_user(USER1_NICKNAME)
+        changes = [change for change in self.connection.read_changes(last)
+                   if change['table'] != 'messages']
+        self.assertEqual(sorted((change['table'], change['operation'],
+                                 change['userid'], change['nickname'])
+                                for change in changes),
+                         [('friends', 'delete', 4, 'Koodari'),
+                          ('users', 'delete', USER1_ID, USER1_NICKNAME),
+                          ('users_profile', 'delete', USER1_ID,
+                           USER1_NICKNAME)])
+        friend = [change for change in changes
+                  if change['table'] == 'friends'][0]
+        self.assertEqual(friend['friendid'], USER1_ID)
+        self.assertEqual(friend['friendnickname'], USER1_NICKNAME)
+
     def test_delete_user_noexistingnickname(self):
         '''
         Test delete_user with  Batty (no-existing)
@@ -269,6 +347,31 @@ class UserDBAPITestCase(unittest.TestCase):
         resp = self.connection.delete_user(USER_WRONG_NICKNAME)
         self.assertFalse(resp)
 
+    def test_get_user_if_changed(self):
+        '''
+        Test that get_user_if_changed only returns the user after it is
+        modified
+        '''
+        print('('+self.test_get_user_if_changed.__name__+')', \
+              self.test_get_user_if_changed.__doc__)
+        user = self.connection.get_user_if_changed(USER1_NICKNAME)
+        version = user.pop('version')
+        self.assertEqual(user, USER1)
+        self.assertIs(self.connection.get_user_if_changed(USER1_NICKNAME,
+                                                          version),
+                      database.NOT_MODIFIED)
+        self.connection.modify_user(USER1_NICKNAME, MODIFIED_USER1)
+        user = self.connection.get_user_if_changed(USER1_NICKNAME, version)
+        self.assertGreater(user.pop('version'), version)
+        self.assertEqual(user, self.connection.get_user(USER1_NICKNAME))
+        #Other users keep their version
+        user2 = self.connection.get_user_if_changed(USER2_NICKNAME)
+        self.assertIs(self.connection.get_user_if_changed(
+                          USER2_NICKNAME, user2['version']),
+                      database.NOT_MODIFIED)
+        self.assertIsNone(self.connection.get_user_if_changed(
+                              USER_WRONG_NICKNAME))
+
     def test_modify_user(self):
         '''
         Test that the user Mystery is modifed
@@ -297,6 +400,28 @@ class UserDBAPITestCase(unittest.TestCase):
         self.assertEqual(r_profile['picture'], resp_r_profile['picture'])
         self.assertDictContainsSubset(resp2, MODIFIED_USER1)
 
+    def test_modify_user_version(self):
+        '''
+        Test that modify_user with a version reports the conflicts
+        '''
+        print('('+self.test_modify_user_version.__name__+')', \
+              self.test_modify_user_version.__doc__)
+        version = self.connection.get_user_if_changed(
+            USER1_NICKNAME)['version']
+        self.assertIs(self.connection.modify_user(USER1_NICKNAME,
+                                                  MODIFIED_USER1,
+                                                  version - 1),
+                      database.VERSION_CONFLICT)
+        self.assertEqual(self.connection.get_user(USER1_NICKNAME), USER1)
+        self.assertEqual(self.connection.modify_user(USER1_NICKNAME,
+                                                     MODIFIED_USER1, version),
+                         USER1_NICKNAME)
+        self.assertIs(self.connection.modify_user(USER1_NICKNAME, USER1,
+                                                  version),
+                      database.VERSION_CONFLICT)
+        self.assertIsNone(self.connection.modify_user(USER_WRONG_NICKNAME,
+                                                      USER1, version))
+
     def test_modify_user_noexistingnickname(self):
         '''
         Test modify_user with  user Batty (no-existing)
@@ -331,6 +456,10 @@ class UserDBAPITestCase(unittest.TestCase):
               self.test_append_existing_user.__doc__)
         nickname = self.connection.append_user(USER1_NICKNAME, NEW_USER)
         self.assertIsNone(nickname)
+        #Check that the existing user has not been modified
+        user = self.connection.get_user(USER1_NICKNAME)
+        self.assertDictContainsSubset(user, USER1)
+        self.assertEqual(len(self.connection.get_users()), INITIAL_SIZE)
 
     def test_get_user_id(self):
         '''
@@ -352,6 +481,97 @@ class UserDBAPITestCase(unittest.TestCase):
         id = self.connection.get_user_id(USER_WRONG_NICKNAME)
         self.assertIsNone(id)
 
+    def test_user_id_cache(self):
+        '''
+        Test that the nickname->user_id cache is filled by get_user_id and
+        invalidated by delete_user and append_user
+        '''
+        print('('+self.test_user_id_cache.__name__+')', \
+              self.test_user_id_cache.__doc__)
+        cache = self.connection.user_ids
+        self.assertIs(cache, ENGINE.user_ids)
+        self.assertEqual(self.connection.get_user_id(USER1_NICKNAME), USER1_ID)
+        self.assertEqual(cache.get(USER1_NICKNAME), USER1_ID)
+        #Nicknames which are not users are not cached, another Engine may
+        #register them
+        self.assertIsNone(self.connection.get_user_id(NEW_USER_NICKNAME))
+        self.assertIs(cache.get(NEW_USER_NICKNAME), database.NOT_CACHED)
+        other = database.Engine(DB_PATH).connect()
+        try:
+            other.append_user(NEW_USER_NICKNAME, NEW_USER)
+        finally:
+            other.close()
+        self.assertIsNotNone(self.connection.get_user(NEW_USER_NICKNAME))
+        self.assertIsNotNone(cache.get(NEW_USER_NICKNAME))
+        self.connection.delete_user(USER1_NICKNAME)
+        self.assertIs(cache.get(USER1_NICKNAME), database.NOT_CACHED)
+        self.assertIsNone(self.connection.get_user_id(USER1_NICKNAME))
+
+    def test_user_id_reused(self):
+        '''
+        Test that a cached user_id given by another Engine to a new user is
+        not used to read or modify the new user
+        '''
+        print('('+self.test_user_id_reused.__name__+')', \
+              self.test_user_id_reused.__doc__)
+        self.assertEqual(self.connection.get_user_id(USER2_NICKNAME), USER2_ID)
+        other = database.Engine(DB_PATH).connect()
+        try:
+            self.assertTrue(other.delete_user(USER2_NICKNAME))
+            other.append_user(NEW_USER_NICKNAME, NEW_USER)
+            self.assertEqual(other.get_user_id(NEW_USER_NICKNAME), USER2_ID)
+        finally:
+            other.close()
+        self.assertIsNone(self.connection.get_user(USER2_NICKNAME))
+        self.assertIsNone(self.connection.modify_user(USER2_NICKNAME, USER2))
+        self.assertEqual(self.connection.get_user(NEW_USER_NICKNAME)
+                         ['restricted_profile']['firstname'], 'Jake')
+
+    def test_preload_user_ids(self):
+        '''
+        Test that preload_user_ids loads all users in the cache
+        '''
+        print('('+self.test_preload_user_ids.__name__+')', \
+              self.test_preload_user_ids.__doc__)
+        self.assertEqual(ENGINE.preload_user_ids(), INITIAL_SIZE)
+        self.assertEqual(ENGINE.user_ids.get(USER2_NICKNAME), USER2_ID)
+
+    def test_get_user_stats(self):
+        '''
+        Test that get_user_stats follows the messages of HockeyFan
+        '''
+        print('('+self.test_get_user_stats.__name__+')', \
+              self.test_get_user_stats.__doc__)
+        stats = self.connection.get_user_stats(USER2_NICKNAME)
+        self.assertEqual(stats, {'nickname': USER2_NICKNAME, 'messages': 3,
+                                 'lastpost': 1362017481})
+        msgid = self.connection.create_message('title', 'body',
+                                               USER2_NICKNAME)
+        stats = self.connection.get_user_stats(USER2_NICKNAME)
+        self.assertEqual(stats['messages'], 4)
+        self.assertGreater(stats['lastpost'], 1362017481)
+        self.connection.delete_message(msgid)
+        stats = self.connection.get_user_stats(USER2_NICKNAME)
+        self.assertEqual(stats['messages'], 3)
+        self.assertEqual(stats['lastpost'], 1362017481)
+        #A user without messages
+        stats = self.connection.get_user_stats('LinuxPenguin')
+        self.assertEqual(stats['messages'], 0)
+        self.assertIsNone(stats['lastpost'])
+
+    def test_get_user_stats_deleted_user(self):
+        '''
+        Test that the statistics of a deleted user are removed
+        '''
+        print('('+self.test_get_user_stats_deleted_user.__name__+')', \
+              self.test_get_user_stats_deleted_user.__doc__)
+        self.connection.delete_user(USER2_NICKNAME)
+        self.assertIsNone(self.connection.get_user_stats(USER2_NICKNAME))
+        self.assertIsNone(self.connection.get_user_stats(USER_WRONG_NICKNAME))
+        cur = self.connection.con.cursor()
+        cur.execute('SELECT * FROM user_stats WHERE user_id = ?', (USER2_ID,))
+        self.assertIsNone(cur.fetchone())
+
     def test_not_contains_user(self):
         '''
         Check if the database does not contain users with id Batty